@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import functools
+import subprocess
+import statistics
+import importlib.util
+
+# Offline benchmark for the analysis pipeline: runs generate_reports (or the
+# whole SMTP handler) over an .eml corpus, with every DNS query answered by
+# the local fake DNS server and MariaDB replaced by a stub connection.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_dns import start_server
+import make_corpus
+
+timings = {}
+
+def record(stage, elapsed):
+  timings.setdefault(stage, []).append(elapsed)
+
+def timed(stage, func):
+  if asyncio.iscoroutinefunction(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return await func(*args, **kwargs)
+      finally:
+        record(stage, time.perf_counter() - start)
+  else:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return func(*args, **kwargs)
+      finally:
+        record(stage, time.perf_counter() - start)
+  return wrapper
+
+class StubCursor:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+  def execute(self, sql, params=None):
+    if sql.startswith("INSERT INTO reports"):
+      StubConnection.rows += sql.count("(%s")
+
+  # Every recipient is a known account.
+  def fetchall(self):
+    return [{"id": 1}]
+
+class StubConnection:
+  rows = 0
+
+  def cursor(self):
+    return StubCursor()
+
+  def commit(self):
+    pass
+
+  def ping(self, reconnect=False):
+    pass
+
+  def close(self):
+    pass
+
+def instrument():
+  import utils.config
+  import utils.report
+  import utils.authentication
+  import utils.database
+  import utils.store
+  import utils.checkcache
+
+  utils.config.logger.target = os.devnull
+  # Every iteration analyses the same messages again.
+  utils.checkcache.cache.max_size = 0
+
+  utils.report.MessageView = timed("parse", utils.report.MessageView)
+  utils.report.get_trace = timed("trace", utils.report.get_trace)
+  utils.report.check_spamassassin = timed("spamassassin", utils.report.check_spamassassin)
+  utils.report.check_rbl = timed("rbl", utils.report.check_rbl)
+  for check in ("spf", "dkim", "arc", "dmarc", "domain_mx", "rdns"):
+    name = f"verify_{check}"
+    setattr(utils.authentication, name, timed(check, getattr(utils.authentication, name)))
+
+  utils.database.ConnectionPool.connect = lambda self: StubConnection()
+  spool_dir = tempfile.mkdtemp(prefix="xray-bench-spool-")
+
+  def get_writer():
+    if utils.database.writer is None:
+      utils.database.writer = utils.database.ReportWriter(spool_dir=spool_dir)
+      utils.database.writer.start()
+    return utils.database.writer
+
+  utils.database.get_writer = get_writer
+  utils.database.ReportWriter.insert = timed("db_write", utils.database.ReportWriter.insert)
+  utils.store.store.directory = tempfile.mkdtemp(prefix="xray-bench-store-")
+
+def use_resolver(port, timeout):
+  import utils.misc
+  from utils.resolver import HedgedResolver, Upstream
+
+  utils.misc.DNS.cache.resolver = HedgedResolver([Upstream("127.0.0.1", port)], timeout=timeout)
+
+def load_corpus(directory):
+  if not os.path.isdir(directory) or not any(name.endswith(".eml") for name in os.listdir(directory)):
+    make_corpus.main([directory])
+
+  corpus = []
+  for name in sorted(os.listdir(directory)):
+    if name.endswith(".eml"):
+      with open(os.path.join(directory, name), "rb") as eml:
+        corpus.append((name, eml.read()))
+  return corpus
+
+class Envelope:
+  def __init__(self, content):
+    self.mail_from = "bench@sender.example"
+    self.rcpt_tos = ["test@xray.test"]
+    self.content = content
+
+async def run_pipeline(corpus, iterations, concurrency):
+  from utils.report import generate_reports
+  from utils import database
+  from utils.database import save_report
+
+  semaphore = asyncio.Semaphore(concurrency)
+  errors = []
+
+  async def process(name, content):
+    async with semaphore:
+      start = time.perf_counter()
+      try:
+        general_report, spamassassin_report, authentication_report, rbl_report = await generate_reports(Envelope(content))
+        await save_report(general_report['sent_to'], general_report, spamassassin_report, authentication_report, rbl_report)
+      except Exception as e:
+        errors.append(f"{name}: {e!r}")
+      record("total", time.perf_counter() - start)
+
+  await asyncio.gather(*[process(name, content) for _ in range(iterations) for name, content in corpus])
+  await database.get_writer().stop()
+  return errors
+
+async def run_smtp(corpus, iterations, concurrency):
+  import smtplib
+  from aiosmtpd.controller import Controller
+
+  spec = importlib.util.spec_from_file_location("xray_main", os.path.join(ROOT_DIR, "x-ray.py"))
+  xray = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(xray)
+
+  with socket.socket() as probe:
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+
+  controller = Controller(xray.CustomHandler(), hostname="127.0.0.1", port=port, data_size_limit=0)
+  controller.start()
+  errors = []
+
+  def send(name, content):
+    start = time.perf_counter()
+    try:
+      with smtplib.SMTP("127.0.0.1", port) as client:
+        client.sendmail("bench@sender.example", ["test@xray.test"], content)
+    except Exception as e:
+      errors.append(f"{name}: {e!r}")
+    record("total", time.perf_counter() - start)
+
+  loop = asyncio.get_running_loop()
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def process(name, content):
+    async with semaphore:
+      await loop.run_in_executor(None, send, name, content)
+
+  await asyncio.gather(*[process(name, content) for _ in range(iterations) for name, content in corpus])
+
+  from utils import database
+  if database.writer is not None:
+    asyncio.run_coroutine_threadsafe(database.writer.stop(), controller.loop).result()
+  controller.stop()
+  return errors
+
+def percentile(values, fraction):
+  ordered = sorted(values)
+  index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+  return ordered[index]
+
+def summarize(values):
+  return {
+    "count": len(values),
+    "mean": statistics.fmean(values),
+    "p50": percentile(values, 0.50),
+    "p95": percentile(values, 0.95),
+    "p99": percentile(values, 0.99),
+    "max": max(values),
+  }
+
+def git_revision():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+  except OSError:
+    return None
+
+async def benchmark(args):
+  dns_server, transport = await start_server(args.zone, latency=args.latency, jitter=args.jitter, timeout_rate=args.timeout_rate, nxdomain_rate=args.nxdomain_rate, seed=args.seed)
+  use_resolver(transport.get_extra_info("sockname")[1], args.dns_timeout)
+
+  corpus = load_corpus(args.corpus)
+  messages = len(corpus) * args.iterations
+
+  start = time.perf_counter()
+  if args.smtp:
+    errors = await run_smtp(corpus, args.iterations, args.concurrency)
+  else:
+    errors = await run_pipeline(corpus, args.iterations, args.concurrency)
+  elapsed = time.perf_counter() - start
+
+  transport.close()
+
+  from utils.misc import DNS
+
+  return {
+    "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    "revision": git_revision(),
+    "mode": "smtp" if args.smtp else "pipeline",
+    "settings": {
+      "corpus": sorted(name for name, _ in corpus),
+      "iterations": args.iterations,
+      "concurrency": args.concurrency,
+      "latency": args.latency,
+      "jitter": args.jitter,
+      "timeout_rate": args.timeout_rate,
+      "nxdomain_rate": args.nxdomain_rate,
+      "dns_timeout": args.dns_timeout,
+    },
+    "messages": messages,
+    "errors": errors,
+    "elapsed": elapsed,
+    "messages_per_second": messages / elapsed if elapsed else 0.0,
+    "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "stages": {stage: summarize(values) for stage, values in sorted(timings.items())},
+    "dns_cache": DNS.cache.get_stats(),
+    "dns_server": dns_server.stats,
+    "db_rows": StubConnection.rows,
+  }
+
+def print_result(result):
+  print(f"{result['messages']} messages in {result['elapsed']:.2f}s: {result['messages_per_second']:.2f} msg/s, peak RSS {result['peak_rss_kb'] / 1024:.1f} MiB")
+  print(f"{'stage':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+  for stage, summary in result["stages"].items():
+    print(f"{stage:<14}{summary['count']:>8}{summary['p50'] * 1000:>10.2f}{summary['p95'] * 1000:>10.2f}{summary['p99'] * 1000:>10.2f}")
+  for error in result["errors"][:10]:
+    print(f"error: {error}")
+
+def compare(old_file, new_file):
+  with open(old_file) as old, open(new_file) as new:
+    old_result, new_result = json.load(old), json.load(new)
+
+  def change(old_value, new_value):
+    return f"{(new_value - old_value) / old_value * 100:+.1f}%" if old_value else "n/a"
+
+  print(f"msg/s: {old_result['messages_per_second']:.2f} -> {new_result['messages_per_second']:.2f} ({change(old_result['messages_per_second'], new_result['messages_per_second'])})")
+  print(f"peak RSS KiB: {old_result['peak_rss_kb']} -> {new_result['peak_rss_kb']} ({change(old_result['peak_rss_kb'], new_result['peak_rss_kb'])})")
+  for stage in sorted(set(old_result["stages"]) | set(new_result["stages"])):
+    old_p95 = old_result["stages"].get(stage, {}).get("p95")
+    new_p95 = new_result["stages"].get(stage, {}).get("p95")
+    if old_p95 is None or new_p95 is None:
+      print(f"{stage}: only in {'new' if old_p95 is None else 'old'} run")
+    else:
+      print(f"{stage}: p95 {old_p95 * 1000:.2f}ms -> {new_p95 * 1000:.2f}ms ({change(old_p95, new_p95)})")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark the X-Ray analysis pipeline offline")
+  parser.add_argument("--corpus", default=os.path.join(BENCH_DIR, "corpus"), help="directory with .eml files (generated if empty)")
+  parser.add_argument("--zone", default=os.path.join(BENCH_DIR, "zone.json"), help="records served by the fake DNS server")
+  parser.add_argument("--iterations", type=int, default=20, help="times the whole corpus is processed")
+  parser.add_argument("--concurrency", type=int, default=10, help="messages processed at the same time")
+  parser.add_argument("--latency", type=float, default=0.005, help="fake DNS answer delay in seconds")
+  parser.add_argument("--jitter", type=float, default=0.005, help="random extra delay added to each answer")
+  parser.add_argument("--timeout-rate", type=float, default=0.0, help="fraction of DNS queries never answered")
+  parser.add_argument("--nxdomain-rate", type=float, default=0.0, help="fraction of DNS queries answered with NXDOMAIN")
+  parser.add_argument("--dns-timeout", type=float, default=2.0, help="resolver timeout in seconds")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--smtp", action="store_true", help="send messages over SMTP to CustomHandler instead of calling generate_reports")
+  parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results"), help="directory where the JSON result is stored")
+  parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two stored results and exit")
+  args = parser.parse_args(argv)
+
+  if args.compare:
+    compare(*args.compare)
+    return
+
+  instrument()
+
+  result = asyncio.run(benchmark(args))
+  print_result(result)
+
+  os.makedirs(args.output, exist_ok=True)
+  path = os.path.join(args.output, time.strftime("%Y%m%d-%H%M%S") + f"-{result['mode']}.json")
+  with open(path, "w") as output:
+    json.dump(result, output, indent=2)
+  print(f"Result stored in {path}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,101 @@
+import json
+import random
+import asyncio
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+# Local stand-in DNS server for benchmarks. It answers from a JSON zone file
+# and can add latency, drop queries (so the client times out) or answer
+# NXDOMAIN at random, to reproduce slow or unreliable upstreams offline.
+class FakeDNSServer(asyncio.DatagramProtocol):
+  def __init__(self, zone_file, latency=0.0, jitter=0.0, timeout_rate=0.0, nxdomain_rate=0.0, seed=None):
+    with open(zone_file) as zone:
+      config = json.load(zone)
+
+    self.ttl = config.get("ttl", 300)
+    self.records = {name.lower().rstrip("."): types for name, types in config.get("records", {}).items()}
+    self.suffix_latency = config.get("latency", {})
+    self.latency = latency
+    self.jitter = jitter
+    self.timeout_rate = timeout_rate
+    self.nxdomain_rate = nxdomain_rate
+    self.random = random.Random(seed)
+    self.transport = None
+    self.stats = {"queries": 0, "answered": 0, "nxdomain": 0, "dropped": 0}
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def datagram_received(self, data, address):
+    try:
+      query = dns.message.from_wire(data)
+    except Exception:
+      return
+
+    self.stats["queries"] += 1
+    asyncio.get_running_loop().create_task(self.answer(query, address))
+
+  async def answer(self, query, address):
+    question = query.question[0]
+    name = question.name.to_text(omit_final_dot=True).lower()
+
+    delay = self.get_latency(name)
+    if delay:
+      await asyncio.sleep(delay)
+
+    if self.random.random() < self.timeout_rate:
+      self.stats["dropped"] += 1
+      return
+
+    response = dns.message.make_response(query)
+    response.flags |= dns.flags.AA
+    types = self.records.get(name)
+
+    if types is None or self.random.random() < self.nxdomain_rate:
+      response.set_rcode(dns.rcode.NXDOMAIN)
+      self.stats["nxdomain"] += 1
+    else:
+      values = types.get(dns.rdatatype.to_text(question.rdtype), [])
+      if values:
+        response.answer.append(dns.rrset.from_text_list(question.name, self.ttl, "IN", question.rdtype, values))
+      self.stats["answered"] += 1
+
+    self.transport.sendto(response.to_wire(), address)
+
+  def get_latency(self, name):
+    latency = self.latency
+    for suffix, suffix_latency in self.suffix_latency.items():
+      if name == suffix or name.endswith("." + suffix):
+        latency = suffix_latency
+    if self.jitter:
+      latency += self.random.uniform(0, self.jitter)
+    return latency
+
+async def start_server(zone_file, host="127.0.0.1", port=0, **options):
+  server = FakeDNSServer(zone_file, **options)
+  transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(lambda: server, local_addr=(host, port))
+  return server, transport
+
+if __name__ == "__main__":
+  import argparse
+
+  parser = argparse.ArgumentParser(description="Run the benchmark DNS server standalone")
+  parser.add_argument("--zone", default="benchmarks/zone.json")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=5353)
+  parser.add_argument("--latency", type=float, default=0.0)
+  parser.add_argument("--jitter", type=float, default=0.0)
+  parser.add_argument("--timeout-rate", type=float, default=0.0)
+  parser.add_argument("--nxdomain-rate", type=float, default=0.0)
+  args = parser.parse_args()
+
+  async def main():
+    await start_server(args.zone, args.host, args.port, latency=args.latency, jitter=args.jitter, timeout_rate=args.timeout_rate, nxdomain_rate=args.nxdomain_rate)
+    print(f"Fake DNS server listening on {args.host}:{args.port}")
+    await asyncio.Event().wait()
+
+  asyncio.run(main())
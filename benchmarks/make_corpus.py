@@ -0,0 +1,87 @@
+import os
+import sys
+import base64
+import random
+import argparse
+import email.utils
+import dkim
+
+# Generates the benchmark message corpus. Messages are signed with
+# benchmarks/bench.key, whose public key is published in benchmarks/zone.json.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+KEY = open(os.path.join(BENCH_DIR, "bench.key"), "rb").read()
+
+def received(helo, ip):
+  date = email.utils.formatdate(localtime=False)
+  return (f"Received: from {helo} ({helo} [{ip}])\r\n"
+          f"\tby mx.xray.test (Postfix) with ESMTPS id 4XRAY1\r\n"
+          f"\tfor <test@xray.test>; {date}\r\n").encode()
+
+def headers(sender, subject, extra=""):
+  return (f"From: Sender <{sender}>\r\n"
+          f"To: test@xray.test\r\n"
+          f"Subject: {subject}\r\n"
+          f"Date: {email.utils.formatdate(localtime=False)}\r\n"
+          f"Message-ID: {email.utils.make_msgid(domain=sender.split('@')[1])}\r\n"
+          f"MIME-Version: 1.0\r\n{extra}").encode()
+
+def text_body(paragraphs=5):
+  words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+  rng = random.Random(paragraphs)
+  return ("\r\n\r\n".join(" ".join(rng.choice(words) for _ in range(80)) for _ in range(paragraphs)) + "\r\n").encode()
+
+def plain(sender, subject, extra=""):
+  return headers(sender, subject, "Content-Type: text/plain; charset=utf-8\r\n" + extra) + b"\r\n" + text_body()
+
+def sign(message, domain, selector=b"bench"):
+  return dkim.sign(message, selector, domain.encode(), KEY, include_headers=[b"from", b"to", b"subject", b"date", b"message-id"])
+
+def with_attachment(sender, subject, size):
+  boundary = "xray-bench-boundary"
+  payload = base64.encodebytes(os.urandom(size)).replace(b"\n", b"\r\n")
+  body = (f"--{boundary}\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n").encode() + text_body(2) + \
+         (f"--{boundary}\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n"
+          f"Content-Disposition: attachment; filename=\"data.bin\"\r\n\r\n").encode() + payload + f"--{boundary}--\r\n".encode()
+  return headers(sender, subject, f"Content-Type: multipart/mixed; boundary=\"{boundary}\"\r\n") + b"\r\n" + body
+
+def build_corpus(attachment_size):
+  corpus = {}
+
+  message = plain("alice@sender.example", "Signed message")
+  corpus["signed.eml"] = received("mail.sender.example", "192.0.2.10") + sign(message, "sender.example") + message
+
+  corpus["unsigned.eml"] = received("mail.sender.example", "192.0.2.10") + plain("bob@sender.example", "Unsigned message")
+
+  message = plain("carol@sender.example", "Message with two signatures")
+  signed = sign(message, "sender.example") + message
+  corpus["multi_signature.eml"] = received("mail.sender.example", "192.0.2.10") + sign(signed, "other.example") + signed
+
+  message = with_attachment("dave@sender.example", "Large attachment", attachment_size)
+  corpus["large_attachment.eml"] = received("mail.sender.example", "192.0.2.10") + sign(message, "sender.example") + message
+
+  spam_headers = ("X-Spam-Checker-Version: SpamAssassin 4.0.0 (2022-12-13) on mx.xray.test\r\n"
+                  "X-Spam-Flag: YES\r\n"
+                  "X-Spam-Score: 7.1\r\n"
+                  "X-Spam-Status: YES\r\n"
+                  "X-Spam-Report: \r\n"
+                  "\t*  3.0 BAYES_99 BODY: Bayes spam probability is 99 to 100%\r\n"
+                  "\t*  2.5 URIBL_BLACK Contains an URL listed in the URIBL blacklist\r\n"
+                  "\t*  1.6 RDNS_DYNAMIC Delivered to internal network by host with dynamic-looking rDNS\r\n")
+  corpus["spamassassin_tagged.eml"] = received("dynamic-203-0-113-5.isp.example", "203.0.113.5") + plain("eve@other.example", "Spam tagged message", spam_headers)
+
+  return corpus
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Generate the benchmark .eml corpus")
+  parser.add_argument("directory", nargs="?", default=os.path.join(BENCH_DIR, "corpus"))
+  parser.add_argument("--attachment-size", type=int, default=5 * 1024 * 1024, help="size in bytes of the large attachment")
+  args = parser.parse_args(argv)
+
+  os.makedirs(args.directory, exist_ok=True)
+  for name, content in build_corpus(args.attachment_size).items():
+    with open(os.path.join(args.directory, name), "wb") as eml:
+      eml.write(content)
+    print(f"Wrote {name} ({len(content)} bytes)")
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -26,12 +26,34 @@ CREATE TABLE `domains` (
 CREATE TABLE `reports` (
   `id` char(36) NOT NULL,
   `account_id` bigint(20) UNSIGNED NOT NULL,
+  `results_id` char(36) DEFAULT NULL,
+  `score` decimal(5,2) DEFAULT NULL,
+  `score_outcomes` varchar(255) CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL,
+  `source_ip` varchar(45) DEFAULT NULL,
+  `sender_domain` varchar(255) DEFAULT NULL,
+  `spf_status` varchar(16) DEFAULT NULL,
+  `dkim_status` varchar(16) DEFAULT NULL,
+  `dmarc_status` varchar(16) DEFAULT NULL,
+  `rbl_status` varchar(16) DEFAULT NULL,
+  `spamassassin_status` varchar(16) DEFAULT NULL,
+  `message_sha256` char(64) CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL,
   `general` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL CHECK (json_valid(`general`)),
+  `spamassassin` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL CHECK (json_valid(`spamassassin`)),
+  `authentication` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL CHECK (json_valid(`authentication`)),
+  `rbl` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL CHECK (json_valid(`rbl`)),
+  `created_at` timestamp NOT NULL DEFAULT current_timestamp(),
+  `updated_at` timestamp NULL DEFAULT current_timestamp()
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+-- Check results of a message sent to several accounts, stored once and
+-- referenced by the report of each recipient (reports.results_id), whose own
+-- spamassassin, authentication and rbl columns are then NULL.
+CREATE TABLE `report_results` (
+  `id` char(36) NOT NULL,
   `spamassassin` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL CHECK (json_valid(`spamassassin`)),
   `authentication` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL CHECK (json_valid(`authentication`)),
   `rbl` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL CHECK (json_valid(`rbl`)),
-  `created_at` timestamp NULL DEFAULT current_timestamp(),
-  `updated_at` timestamp NULL DEFAULT current_timestamp()
+  `created_at` timestamp NOT NULL DEFAULT current_timestamp()
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 
@@ -45,8 +67,43 @@ ALTER TABLE `domains`
   ADD UNIQUE KEY `domains_name_unique` (`name`);
 
 ALTER TABLE `reports`
-  ADD PRIMARY KEY (`id`),
-  ADD KEY `reports_account_id_foreign` (`account_id`);
+  ADD PRIMARY KEY (`id`,`created_at`),
+  ADD KEY `reports_account_id_created_at_index` (`account_id`,`created_at`),
+  ADD KEY `reports_account_id_id_index` (`account_id`,`id`),
+  ADD KEY `reports_created_at_index` (`created_at`),
+  ADD KEY `reports_score_index` (`score`),
+  ADD KEY `reports_source_ip_index` (`source_ip`),
+  ADD KEY `reports_sender_domain_index` (`sender_domain`,`created_at`),
+  ADD KEY `reports_spf_status_index` (`spf_status`,`created_at`),
+  ADD KEY `reports_dkim_status_index` (`dkim_status`,`created_at`),
+  ADD KEY `reports_dmarc_status_index` (`dmarc_status`,`created_at`),
+  ADD KEY `reports_rbl_status_index` (`rbl_status`,`created_at`),
+  ADD KEY `reports_results_id_index` (`results_id`),
+  ADD KEY `reports_message_sha256_index` (`message_sha256`);
+
+ALTER TABLE `report_results`
+  ADD PRIMARY KEY (`id`);
+
+-- One partition per month from now to two months ahead; the next ones are
+-- added by utils/retention.py while pmax is still empty.
+-- Partitioned tables can't have foreign keys, so reports of deleted accounts
+-- are removed by the retention job instead of ON DELETE CASCADE.
+SET SESSION group_concat_max_len = 1000000;
+SELECT CONCAT('ALTER TABLE `reports` PARTITION BY RANGE (UNIX_TIMESTAMP(`created_at`)) (',
+    GROUP_CONCAT(CONCAT('PARTITION `p', DATE_FORMAT(`month`, '%Y%m'), '` VALUES LESS THAN (', UNIX_TIMESTAMP(`month` + INTERVAL 1 MONTH), ')') ORDER BY `month` SEPARATOR ', '),
+    ', PARTITION `pmax` VALUES LESS THAN MAXVALUE);')
+  INTO @partition_reports
+  FROM (
+    WITH RECURSIVE `months` AS (
+      SELECT CAST(DATE_FORMAT(current_timestamp(), '%Y-%m-01') AS DATE) AS `month`
+      UNION ALL
+      SELECT `month` + INTERVAL 1 MONTH FROM `months` WHERE `month` < CAST(DATE_FORMAT(current_timestamp(), '%Y-%m-01') AS DATE) + INTERVAL 2 MONTH
+    )
+    SELECT `month` FROM `months`
+  ) AS `months`;
+PREPARE `partition_reports` FROM @partition_reports;
+EXECUTE `partition_reports`;
+DEALLOCATE PREPARE `partition_reports`;
 
 
 ALTER TABLE `accounts`
@@ -58,9 +115,6 @@ ALTER TABLE `domains`
 
 ALTER TABLE `accounts`
   ADD CONSTRAINT `accounts_domain_id_foreign` FOREIGN KEY (`domain_id`) REFERENCES `domains` (`id`) ON DELETE CASCADE ON UPDATE CASCADE;
-
-ALTER TABLE `reports`
-  ADD CONSTRAINT `reports_account_id_foreign` FOREIGN KEY (`account_id`) REFERENCES `accounts` (`id`) ON DELETE CASCADE ON UPDATE CASCADE;
 COMMIT;
 
 /*!40101 SET CHARACTER_SET_CLIENT=@OLD_CHARACTER_SET_CLIENT */;
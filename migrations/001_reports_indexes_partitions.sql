@@ -0,0 +1,65 @@
+-- Adds the indexed report columns and monthly partitioning to an existing
+-- reports table (new installs get them from database.sql). The table is
+-- rebuilt, so run it in a quiet moment and stop x-ray first: the writer
+-- needs the new columns.
+
+SET time_zone = "+00:00";
+
+-- Partitioned tables can't have foreign keys; reports of deleted accounts
+-- are removed by the retention job (utils/retention.py) instead.
+ALTER TABLE `reports` DROP FOREIGN KEY `reports_account_id_foreign`;
+
+UPDATE `reports` SET `created_at` = COALESCE(`updated_at`, current_timestamp()) WHERE `created_at` IS NULL;
+
+ALTER TABLE `reports`
+  ADD COLUMN `score` decimal(5,2) DEFAULT NULL AFTER `account_id`,
+  ADD COLUMN `source_ip` varchar(45) DEFAULT NULL AFTER `score`,
+  ADD COLUMN `sender_domain` varchar(255) DEFAULT NULL AFTER `source_ip`,
+  ADD COLUMN `spf_status` varchar(16) DEFAULT NULL AFTER `sender_domain`,
+  ADD COLUMN `dkim_status` varchar(16) DEFAULT NULL AFTER `spf_status`,
+  ADD COLUMN `dmarc_status` varchar(16) DEFAULT NULL AFTER `dkim_status`,
+  ADD COLUMN `rbl_status` varchar(16) DEFAULT NULL AFTER `dmarc_status`,
+  ADD COLUMN `spamassassin_status` varchar(16) DEFAULT NULL AFTER `rbl_status`,
+  MODIFY `created_at` timestamp NOT NULL DEFAULT current_timestamp(),
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (`id`,`created_at`),
+  DROP KEY `reports_account_id_foreign`,
+  ADD KEY `reports_account_id_created_at_index` (`account_id`,`created_at`),
+  ADD KEY `reports_created_at_index` (`created_at`),
+  ADD KEY `reports_score_index` (`score`),
+  ADD KEY `reports_source_ip_index` (`source_ip`),
+  ADD KEY `reports_sender_domain_index` (`sender_domain`,`created_at`),
+  ADD KEY `reports_spf_status_index` (`spf_status`,`created_at`),
+  ADD KEY `reports_dkim_status_index` (`dkim_status`,`created_at`),
+  ADD KEY `reports_dmarc_status_index` (`dmarc_status`,`created_at`),
+  ADD KEY `reports_rbl_status_index` (`rbl_status`,`created_at`);
+
+UPDATE `reports` SET
+  `score` = JSON_VALUE(`general`, '$.score'),
+  `source_ip` = JSON_VALUE(`general`, '$.source_ip'),
+  `sender_domain` = NULLIF(LOWER(SUBSTRING_INDEX(JSON_VALUE(`general`, '$.sent_from'), '@', -1)), ''),
+  `spf_status` = JSON_VALUE(`authentication`, '$.spf.status'),
+  `dkim_status` = JSON_VALUE(`authentication`, '$.dkim.status'),
+  `dmarc_status` = JSON_VALUE(`authentication`, '$.dmarc.status'),
+  `rbl_status` = JSON_VALUE(`rbl`, '$.status'),
+  `spamassassin_status` = JSON_VALUE(`spamassassin`, '$.status');
+
+-- One partition per month from the oldest report to two months ahead, so
+-- pmax is empty and the retention job adds the next months instantly; it
+-- also deletes expired rows in small batches.
+SET SESSION group_concat_max_len = 1000000;
+SELECT CONCAT('ALTER TABLE `reports` PARTITION BY RANGE (UNIX_TIMESTAMP(`created_at`)) (',
+    GROUP_CONCAT(CONCAT('PARTITION `p', DATE_FORMAT(`month`, '%Y%m'), '` VALUES LESS THAN (', UNIX_TIMESTAMP(`month` + INTERVAL 1 MONTH), ')') ORDER BY `month` SEPARATOR ', '),
+    ', PARTITION `pmax` VALUES LESS THAN MAXVALUE);')
+  INTO @partition_reports
+  FROM (
+    WITH RECURSIVE `months` AS (
+      SELECT CAST(DATE_FORMAT(COALESCE(MIN(`created_at`), current_timestamp()), '%Y-%m-01') AS DATE) AS `month` FROM `reports`
+      UNION ALL
+      SELECT `month` + INTERVAL 1 MONTH FROM `months` WHERE `month` < CAST(DATE_FORMAT(current_timestamp(), '%Y-%m-01') AS DATE) + INTERVAL 2 MONTH
+    )
+    SELECT `month` FROM `months`
+  ) AS `months`;
+PREPARE `partition_reports` FROM @partition_reports;
+EXECUTE `partition_reports`;
+DEALLOCATE PREPARE `partition_reports`;
@@ -0,0 +1,7 @@
+-- Adds the check outcomes each score was computed from, so reports can be
+-- scored again with other weights (python3.11 -m utils.rescore). Reports
+-- saved before this have NULL here; the rescoring job derives their outcomes
+-- from the stored check results the first time it goes through them.
+
+ALTER TABLE `reports`
+  ADD COLUMN `score_outcomes` varchar(255) CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL AFTER `score`;
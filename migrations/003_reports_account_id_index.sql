@@ -0,0 +1,5 @@
+-- Index for the report API (utils/api.py), which lists the reports of an
+-- account paginating on their id.
+
+ALTER TABLE `reports`
+  ADD KEY `reports_account_id_id_index` (`account_id`,`id`);
@@ -0,0 +1,20 @@
+-- Messages sent to several accounts are analysed once and get a report per
+-- recipient. Their check results are stored once, in report_results, and the
+-- reports refer to them (results_id) instead of keeping a copy each; those
+-- reports have NULL spamassassin, authentication and rbl columns.
+
+CREATE TABLE `report_results` (
+  `id` char(36) NOT NULL,
+  `spamassassin` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL CHECK (json_valid(`spamassassin`)),
+  `authentication` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL CHECK (json_valid(`authentication`)),
+  `rbl` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL CHECK (json_valid(`rbl`)),
+  `created_at` timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+ALTER TABLE `reports`
+  ADD COLUMN `results_id` char(36) DEFAULT NULL AFTER `account_id`,
+  MODIFY `spamassassin` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL CHECK (json_valid(`spamassassin`)),
+  MODIFY `authentication` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL CHECK (json_valid(`authentication`)),
+  MODIFY `rbl` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_bin DEFAULT NULL CHECK (json_valid(`rbl`)),
+  ADD KEY `reports_results_id_index` (`results_id`);
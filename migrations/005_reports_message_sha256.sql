@@ -0,0 +1,9 @@
+-- The digest of the raw message in the message store (general.message_sha256)
+-- gets its own indexed column, so the retention job can find stored messages
+-- no report refers to any more and remove them.
+
+ALTER TABLE `reports`
+  ADD COLUMN `message_sha256` char(64) CHARACTER SET ascii COLLATE ascii_bin DEFAULT NULL AFTER `spamassassin_status`,
+  ADD KEY `reports_message_sha256_index` (`message_sha256`);
+
+UPDATE `reports` SET `message_sha256` = JSON_VALUE(`general`, '$.message_sha256') WHERE `message_sha256` IS NULL;
@@ -0,0 +1,141 @@
+import asyncio
+from types import SimpleNamespace
+import dns.resolver
+import pytest
+from utils import spf
+from utils.misc import DNS
+
+# Zone served instead of the resolver: {(name, type): [record, ...]}. TXT
+# records are strings, A/AAAA addresses, MX exchange names.
+@pytest.fixture
+def zone(monkeypatch):
+  records = {}
+  lookups = []
+
+  async def query(name, record_type):
+    name = str(name).lower().rstrip(".")
+    lookups.append((name, record_type))
+    answer = records.get((name, record_type))
+    if answer is None:
+      if any(key[0] == name for key in records):
+        raise dns.resolver.NoAnswer()
+      raise dns.resolver.NXDOMAIN()
+    return [to_rdata(record_type, value) for value in answer]
+
+  monkeypatch.setattr(DNS, "query", query)
+  return SimpleNamespace(records=records, lookups=lookups)
+
+def to_rdata(record_type, value):
+  if record_type == "TXT":
+    return SimpleNamespace(strings=[value[i:i + 255].encode("utf-8") for i in range(0, len(value), 255)] or [b""])
+  if record_type == "MX":
+    return SimpleNamespace(exchange=SimpleNamespace(to_text=lambda omit_final_dot=False: value))
+  return SimpleNamespace(address=value)
+
+def check(ip, sender="user@example.com", helo="mail.example.com"):
+  return asyncio.run(spf.check_spf(ip, sender, helo))
+
+def test_pass(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 -all"]
+  assert check("192.0.2.10")[0] == "pass"
+
+def test_fail(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 -all"]
+  result, explanation = check("198.51.100.1")
+  assert result == "fail"
+  assert explanation == "example.com does not designate 198.51.100.1 as permitted sender"
+
+def test_softfail(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 a mx ~all"]
+  zone.records[("example.com", "A")] = ["192.0.2.1"]
+  zone.records[("example.com", "MX")] = ["mx.example.com"]
+  zone.records[("mx.example.com", "A")] = ["192.0.2.2"]
+  assert check("192.0.2.2")[0] == "pass"
+  assert check("198.51.100.1")[0] == "softfail"
+
+def test_no_record(zone):
+  zone.records[("example.com", "TXT")] = ["google-site-verification=abc"]
+  assert check("192.0.2.10")[0] == "none"
+
+def test_include(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 include:_spf.provider.net -all"]
+  zone.records[("_spf.provider.net", "TXT")] = ["v=spf1 ip4:203.0.113.0/24 ~all"]
+  assert check("203.0.113.5")[0] == "pass"
+  # A softfail inside the include is just "no match" for the includer.
+  assert check("198.51.100.1")[0] == "fail"
+
+def test_include_without_record(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 include:missing.net -all"]
+  assert check("192.0.2.10")[0] == "permerror"
+
+def test_redirect(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 redirect=_spf.example.net"]
+  zone.records[("_spf.example.net", "TXT")] = ["v=spf1 ip6:2001:db8::/32 -all"]
+  assert check("2001:db8::1")[0] == "pass"
+  assert check("2001:db9::1")[0] == "fail"
+
+def test_redirect_without_record(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 redirect=missing.net"]
+  assert check("192.0.2.10")[0] == "permerror"
+
+def test_include_loop(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 include:loop.example.net -all"]
+  zone.records[("loop.example.net", "TXT")] = ["v=spf1 include:example.com -all"]
+  result, explanation = check("192.0.2.10")
+  assert result == "permerror"
+  assert "DNS lookups exceeded" in explanation
+  assert len([lookup for lookup in zone.lookups if lookup[1] == "TXT"]) == spf.MAX_DNS_LOOKUPS + 1
+
+def test_redirect_loop(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 redirect=example.com"]
+  assert check("192.0.2.10")[0] == "permerror"
+
+def test_lookup_limit(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 " + " ".join(f"a:host{i}.example.com" for i in range(11)) + " -all"]
+  for i in range(11):
+    zone.records[(f"host{i}.example.com", "A")] = [f"198.51.100.{i}"]
+  assert check("198.51.100.9")[0] == "pass"
+  assert check("198.51.100.10")[0] == "permerror"
+
+def test_multiple_records(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 -all", "v=spf1 +all"]
+  result, explanation = check("192.0.2.10")
+  assert result == "permerror"
+  assert "More than one SPF record" in explanation
+
+def test_void_lookups(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 a:void1.example.com a:void2.example.com ~all"]
+  assert check("192.0.2.10")[0] == "softfail"
+
+  zone.records[("example.com", "TXT")] = ["v=spf1 a:void1.example.com a:void2.example.com a:void3.example.com ~all"]
+  result, explanation = check("192.0.2.10")
+  assert result == "permerror"
+  assert "void" in explanation
+
+def test_unknown_mechanism(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 foo:bar -all"]
+  result, explanation = check("192.0.2.10")
+  assert result == "permerror"
+  assert "Unknown mechanism" in explanation
+
+def test_unknown_modifier_is_ignored(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 ip4:192.0.2.0/24 foo=bar -all"]
+  assert check("192.0.2.10")[0] == "pass"
+
+def test_explanation(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 -all exp=explain._spf.%{d}"]
+  zone.records[("explain._spf.example.com", "TXT")] = ["%{i} is not one of %{d}'s mail servers (sender %{s}, helo %{h})"]
+  result, explanation = check("198.51.100.1")
+  assert result == "fail"
+  assert explanation == "198.51.100.1 is not one of example.com's mail servers (sender user@example.com, helo mail.example.com)"
+
+def test_explanation_lookup_failure(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 -all exp=missing.example.com"]
+  result, explanation = check("198.51.100.1")
+  assert result == "fail"
+  assert explanation == "example.com does not designate 198.51.100.1 as permitted sender"
+
+def test_macros(zone):
+  zone.records[("example.com", "TXT")] = ["v=spf1 exists:%{ir}.%{l1r-}.%{d2}._spf.example.net -all"]
+  zone.records[("10.2.0.192.first.example.com._spf.example.net", "A")] = ["127.0.0.2"]
+  assert check("192.0.2.10", "first-user@example.com")[0] == "pass"
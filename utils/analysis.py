@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import uuid_utils as uuid
+from utils import metrics
+from utils.config import log, ANALYSIS_QUEUE_SIZE, ANALYSIS_CONCURRENCY, ANALYSIS_SPOOL_DIR, MESSAGE_DEADLINE
+
+class QueuedMessage:
+  def __init__(self, path, mail_from, rcpt_tos, content=None):
+    self.path = path
+    self.mail_from = mail_from
+    self.rcpt_tos = rcpt_tos
+    self.content = content
+    self.queued_at = time.monotonic()
+
+# Accept-then-analyze mode: messages are written to a spool directory and
+# acknowledged right away, then analysed by a fixed number of workers. When
+# ANALYSIS_QUEUE_SIZE messages are waiting, new ones get a 4xx so Postfix
+# retries later. A spooled message is only removed once its reports are
+# committed or spooled by the report writer; those left by a crash are queued
+# again on start.
+# Each queue holds a lock on its spool directory while it runs. The one
+# spooling to ANALYSIS_SPOOL_DIR itself (the only one, or the first worker's)
+# also takes over the messages of the workers' directories in it that are
+# not locked, e.g. after WORKERS was lowered.
+class AnalysisQueue:
+  def __init__(self, analyze, size=ANALYSIS_QUEUE_SIZE, concurrency=ANALYSIS_CONCURRENCY, spool_dir=ANALYSIS_SPOOL_DIR):
+    self.analyze = analyze
+    self.size = size
+    self.concurrency = concurrency
+    self.spool_dir = spool_dir
+    self.failed_dir = os.path.join(spool_dir, "failed")
+    self.queue = asyncio.Queue()
+    self.lock = None
+    self.accepted = 0
+    self.workers = []
+    self.active = set()
+    # Messages analysed whose reports are not saved yet.
+    self.saving = set()
+
+  def start(self):
+    os.makedirs(self.failed_dir, exist_ok=True)
+    self.lock = open(os.path.join(self.spool_dir, ".lock"), "w")
+    fcntl.flock(self.lock, fcntl.LOCK_EX)
+    if os.path.abspath(self.spool_dir) == os.path.abspath(ANALYSIS_SPOOL_DIR):
+      self.adopt()
+
+    recovered = sorted(name for name in os.listdir(self.spool_dir) if name.endswith(".msg"))
+    for name in recovered:
+      self.accepted += 1
+      self.queue.put_nowait(QueuedMessage(os.path.join(self.spool_dir, name), None, None))
+    if recovered:
+      log(f"Queued {len(recovered)} spooled messages again")
+
+    self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+  def adopt(self):
+    adopted = 0
+    for entry in os.scandir(self.spool_dir):
+      if not entry.is_dir() or entry.path == self.failed_dir:
+        continue
+      try:
+        lock = open(os.path.join(entry.path, ".lock"), "w")
+      except OSError:
+        continue
+      with lock:
+        try:
+          fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+          continue
+        for name in os.listdir(entry.path):
+          if name.endswith(".msg"):
+            os.replace(os.path.join(entry.path, name), os.path.join(self.spool_dir, name))
+            adopted += 1
+    if adopted:
+      log(f"Took over {adopted} spooled messages of workers that are not running")
+
+  # Messages being analysed get some time to finish; anything else stays in
+  # the spool directory for the next start.
+  async def stop(self, timeout=MESSAGE_DEADLINE):
+    for worker in self.workers:
+      worker.cancel()
+    if self.active:
+      await asyncio.wait(self.active, timeout=timeout)
+    for task in list(self.active):
+      task.cancel()
+    # The report writer is still running, so these are done after its next
+    # batch; any left keep their spool file.
+    if self.saving:
+      await asyncio.wait(self.saving, timeout=timeout)
+    for task in list(self.saving):
+      task.cancel()
+    self.lock.close()
+
+  async def submit(self, envelope):
+    if self.accepted >= self.size:
+      metrics.analysis_deferred.inc()
+      log(f"Analysis queue full, deferring message from {envelope.mail_from}", "warning")
+      return "451 4.3.2 Analysis queue full, try again later"
+
+    self.accepted += 1
+    try:
+      message = await asyncio.get_running_loop().run_in_executor(None, self.spool, envelope)
+    except OSError as e:
+      self.accepted -= 1
+      log(f"Could not spool message from {envelope.mail_from}: {e}", "error")
+      return "451 4.3.0 Could not queue message, try again later"
+
+    self.queue.put_nowait(message)
+    return "250 OK"
+
+  def spool(self, envelope):
+    path = os.path.join(self.spool_dir, f"{uuid.uuid7()}.msg")
+    header = json.dumps({"mail_from": envelope.mail_from, "rcpt_tos": envelope.rcpt_tos})
+
+    with open(path + ".tmp", "wb") as spooled:
+      spooled.write(header.encode("utf-8") + b"\n" + envelope.content)
+      spooled.flush()
+      os.fsync(spooled.fileno())
+    os.replace(path + ".tmp", path)
+
+    return QueuedMessage(path, envelope.mail_from, envelope.rcpt_tos, envelope.content)
+
+  def load(self, message):
+    with open(message.path, "rb") as spooled:
+      header, message.content = spooled.read().split(b"\n", 1)
+    header = json.loads(header)
+    message.mail_from, message.rcpt_tos = header["mail_from"], header["rcpt_tos"]
+
+  async def work(self):
+    while True:
+      message = await self.queue.get()
+      task = asyncio.create_task(self.process(message))
+      self.active.add(task)
+      task.add_done_callback(self.active.discard)
+      # Shielded so stopping the worker doesn't cancel the message it is on.
+      await asyncio.shield(task)
+
+  async def process(self, message):
+    metrics.stage_duration.observe(time.monotonic() - message.queued_at, stage="queue")
+    name = os.path.basename(message.path)
+    try:
+      if message.content is None:
+        await asyncio.get_running_loop().run_in_executor(None, self.load, message)
+      saved = await self.analyze(message)
+    except Exception as e:
+      # Kept aside so a message that always fails is not retried forever.
+      log(f"Error analysing queued message {name}, moving it to {self.failed_dir}: {e}", "error")
+      try:
+        os.replace(message.path, os.path.join(self.failed_dir, name))
+      except OSError as e:
+        log(f"Could not move queued message {name}: {e}", "error")
+    else:
+      # Waiting for the report writer doesn't hold up the next message.
+      task = asyncio.create_task(self.remove(message, saved))
+      self.saving.add(task)
+      task.add_done_callback(self.saving.discard)
+    finally:
+      self.accepted -= 1
+
+  async def remove(self, message, saved):
+    try:
+      await saved
+    except Exception as e:
+      log(f"Reports of queued message {os.path.basename(message.path)} could not be saved, keeping it for the next start: {e}", "error")
+      return
+    try:
+      os.remove(message.path)
+    except OSError as e:
+      log(f"Could not remove queued message {os.path.basename(message.path)}: {e}", "error")
+
+queue = None
+# Each worker process (see utils/supervisor.py) spools to its own directory.
+spool_dir = ANALYSIS_SPOOL_DIR
+
+metrics.registry.gauge("xray_analysis_queue_depth", "Accepted messages waiting for or under analysis", lambda: queue.accepted if queue else 0)
+
+def start_queue(analyze):
+  global queue
+  if queue is None:
+    queue = AnalysisQueue(analyze, spool_dir=spool_dir)
+    queue.start()
+  return queue
@@ -0,0 +1,185 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+import datetime
+import pymysql
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics, database
+from utils.http import Response, etag_matches
+from utils.database import ConnectionPool
+from utils.config import log, DB_POOL_SIZE, REPORT_CACHE_SIZE, REPORT_CACHE_TTL
+
+PARTS = ("general", "spamassassin", "authentication", "rbl")
+SUMMARY_COLUMNS = "id, UNIX_TIMESTAMP(created_at) AS created_at, score, source_ip, sender_domain, spf_status, dkim_status, dmarc_status, rbl_status, spamassassin_status"
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+pattern_report_id = "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+pattern_part = "|".join(PARTS)
+
+# Recently written reports, kept as the JSON text of each part so they can be
+# served without querying the database. Entries expire after
+# REPORT_CACHE_TTL seconds, so reports changed in the database (e.g. by
+# utils/rescore.py) are not served stale for long.
+class ReportCache:
+  def __init__(self, size=REPORT_CACHE_SIZE, ttl=REPORT_CACHE_TTL):
+    self.size = size
+    self.ttl = ttl
+    self.entries = OrderedDict()
+
+  def add(self, row):
+    self.put(row["id"], {part: row[part] for part in PARTS})
+
+  def put(self, report_id, parts):
+    if not self.size:
+      return
+    expires, texts = self.entries.pop(report_id, (None, {}))
+    # Parts of saved reports are serialized the first time they are requested.
+    texts.update(parts)
+    self.entries[report_id] = (expires or time.monotonic() + self.ttl, texts)
+    while len(self.entries) > self.size:
+      self.entries.popitem(last=False)
+
+  def get(self, report_id, parts):
+    entry = self.entries.get(report_id)
+    if entry is None:
+      return None
+    expires, texts = entry
+    if expires <= time.monotonic():
+      del self.entries[report_id]
+      return None
+    if any(part not in texts for part in parts):
+      return None
+
+    self.entries.move_to_end(report_id)
+    for part in parts:
+      if texts[part] is not None and not isinstance(texts[part], str):
+        texts[part] = json.dumps(texts[part])
+    return {part: texts[part] for part in parts}
+
+# Read side for the webapp: report lists per account straight from the
+# indexed columns (no JSON), paginated on the uuid7 id, and single reports
+# or sub-reports from the cache or by primary key.
+class ReportAPI:
+  def __init__(self):
+    self.cache = ReportCache()
+    self.pool = ConnectionPool()
+    self.executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="xray-api")
+    self.cache_results = metrics.registry.counter("xray_api_report_cache_total", "Report API lookups by cache result", ("result",))
+
+  def start(self):
+    database.listeners.append(self.cache.add)
+
+  def query(self, sql, params=None):
+    connection = self.pool.acquire()
+    try:
+      with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+      connection.commit()
+    except Exception:
+      self.pool.discard(connection)
+      raise
+    self.pool.release(connection)
+    return rows
+
+  async def run_query(self, sql, params=None):
+    return await asyncio.get_running_loop().run_in_executor(self.executor, self.query, sql, params)
+
+  async def list_endpoint(self, request, account):
+    try:
+      limit = min(int(request.query.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+      return Response("Invalid limit\n", 400)
+    before, after = request.query.get("before"), request.query.get("after")
+    for cursor in (before, after):
+      if cursor is not None and not is_report_id(cursor):
+        return Response("Invalid cursor\n", 400)
+
+    account = urllib.parse.unquote(account)
+    try:
+      account_id = await database.accounts.lookup(account)
+      if account_id is None:
+        return Response("Not found\n", 404)
+
+      # Newest first; with after=, the reports newer than that one, oldest
+      # first, for polling.
+      if after is not None:
+        sql = f"SELECT {SUMMARY_COLUMNS} FROM reports WHERE account_id = %s AND id > %s ORDER BY id LIMIT %s;"
+        rows = await self.run_query(sql, (account_id, after, limit))
+      elif before is not None:
+        sql = f"SELECT {SUMMARY_COLUMNS} FROM reports WHERE account_id = %s AND id < %s ORDER BY id DESC LIMIT %s;"
+        rows = await self.run_query(sql, (account_id, before, limit))
+      else:
+        sql = f"SELECT {SUMMARY_COLUMNS} FROM reports WHERE account_id = %s ORDER BY id DESC LIMIT %s;"
+        rows = await self.run_query(sql, (account_id, limit))
+    except pymysql.err.MySQLError as e:
+      log(f"Could not list reports of {account}: {e}", "warning")
+      return Response("Database unavailable\n", 503)
+
+    reports = [summary(row) for row in rows]
+    body = json.dumps({"reports": reports, "next": reports[-1]["id"] if len(reports) == limit else None})
+    return cached_response(request, body.encode("utf-8"), weak=True)
+
+  async def report_endpoint(self, request, report_id, part=None):
+    parts = (part,) if part else PARTS
+    texts = self.cache.get(report_id, parts)
+    self.cache_results.inc(result="hit" if texts is not None else "miss")
+
+    if texts is None:
+      try:
+        rows = await self.run_query(f"SELECT {', '.join(map(select_part, parts))} FROM reports LEFT JOIN report_results ON report_results.id = reports.results_id WHERE reports.id = %s;", (report_id,))
+      except pymysql.err.MySQLError as e:
+        log(f"Could not read report {report_id}: {e}", "warning")
+        return Response("Database unavailable\n", 503)
+      if not rows:
+        return Response("Not found\n", 404)
+      texts = rows[0]
+      self.cache.put(report_id, texts)
+
+    # Stored parts are already JSON; they are sent as they are. Parts can be
+    # missing, e.g. shared check results removed by the retention job.
+    if part:
+      if texts[part] is None:
+        return Response("Not found\n", 404)
+      body = texts[part]
+    else:
+      body = f'{{"id": "{report_id}", ' + ", ".join(f'"{name}": {texts[name] if texts[name] is not None else "null"}' for name in PARTS) + "}"
+    return cached_response(request, body.encode("utf-8"))
+
+# Reports of messages sent to several accounts share their check results.
+def select_part(part):
+  if part == "general":
+    return "reports.general"
+  return f"COALESCE(reports.{part}, report_results.{part}) AS {part}"
+
+def summary(row):
+  report = dict(row)
+  report["created_at"] = datetime.datetime.fromtimestamp(int(row["created_at"]), datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+  report["score"] = float(row["score"]) if row["score"] is not None else None
+  return report
+
+def cached_response(request, body, weak=False):
+  etag = f'"{hashlib.sha1(body).hexdigest()}"'
+  if weak:
+    etag = "W/" + etag
+  # Clients keep the response but check it is still current each time.
+  headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+  if etag_matches(request, etag):
+    return Response(status=304, headers=headers)
+  return Response(body, content_type="application/json", headers=headers)
+
+def is_report_id(value):
+  return re.fullmatch(pattern_report_id, value) is not None
+
+api = ReportAPI()
+
+def add_routes(server):
+  api.start()
+  server.route("GET", "/accounts/(?P<account>[^/]+)/reports", api.list_endpoint)
+  server.route("GET", f"/reports/(?P<report_id>{pattern_report_id})", api.report_endpoint)
+  server.route("GET", f"/reports/(?P<report_id>{pattern_report_id})/(?P<part>{pattern_part})", api.report_endpoint)
@@ -1,31 +1,30 @@
-import subprocess
 import re
 import dkim
-import socket
-from utils.scoring import Score
 from utils.misc import DNS
+from utils.spf import check_spf, SPF_RESULT_CODES
+from utils.dkimpool import get_key_names, fetch_key_records, verify_dkim_signature, verify_arc_chain
+from utils.scheduler import CheckScheduler
 
-async def check_authentication(mail_from, data, received_msg, ip, helo, score):
+async def check_authentication(mail_from, data, received_msg, ip, helo, score, deadline=None, timings=None):
   domain = mail_from.split("@")[-1]
 
-  try:
-    rdns = socket.gethostbyaddr(ip)
-  except socket.error:
-    rdns = "none"
-  
+  scheduler = CheckScheduler(deadline, timings)
+  scheduler.add("dkim", verify_dkim, domain, data, received_msg, score)
+  scheduler.add("arc", verify_arc, data, received_msg)
+  scheduler.add("spf", verify_spf, mail_from, ip, helo, score)
+  scheduler.add("rdns", verify_rdns, ip, helo, score)
+  scheduler.add("dmarc", verify_dmarc, domain)
+  scheduler.add("domain_mx", verify_domain_mx, domain, score)
+
   return {
     "message": "auth:info",
-    "dkim": await verify_dkim(domain, data, received_msg, score),
-    "arc": await verify_arc(data),
-    "spf": await verify_spf(mail_from, ip, helo, score),
-    "rdns": await verify_rdns(ip, helo, rdns[0], score),
-    "dmarc": await verify_dmarc(domain),
-    "domain_mx": await verify_domain_mx(domain, score),
+    **await scheduler.run(),
   }
 
 
 async def verify_spf(mail_from, ip_address, helo, score):
-  query_result = subprocess.run(["spfquery", "--scope", "mfrom", "--id", mail_from, "--ip", ip_address, "--helo-id", helo], capture_output=True, text=True)
+  spf_result, spf_explanation = await check_spf(ip_address, mail_from, helo)
+  returncode = SPF_RESULT_CODES[spf_result]
   spf_results = {
     0: "spf:ok",
     1: "spf:notAuthorized",
@@ -37,25 +36,25 @@ async def verify_spf(mail_from, ip_address, helo, score):
   }
 
   verify_result = {
-    "output": query_result.returncode,
-    "message": spf_results.get(query_result.returncode, "spf:unexpectedResult") ,
+    "output": returncode,
+    "message": spf_results.get(returncode, "spf:unexpectedResult") ,
     "status": "success",
     "tests": [],
   }
 
   verify_result['tests'].append({
-    "name": "spfquery",
-    "result": query_result.stdout
+    "name": "spf",
+    "result": f"{spf_result}\n{spf_explanation}"
   })
 
-  if query_result.returncode == 1 or query_result.returncode == 2:
+  if returncode == 1 or returncode == 2:
     verify_result["status"] = "error"
-    verify_result["subtract"] = score.subtract("spf", Score.SPF_ERR.value)
-  elif query_result.returncode == 3:
+    verify_result["subtract"] = score.subtract("SPF_ERR")
+  elif returncode == 3:
     verify_result["status"] = "warning"
-  elif query_result.returncode > 0:
+  elif returncode > 0:
     verify_result["status"] = "warning"
-    verify_result["subtract"] = score.subtract("spf", Score.SPF_WARN.value)
+    verify_result["subtract"] = score.subtract("SPF_WARN")
 
   dns_test = {
     'name': "dns",
@@ -78,13 +77,18 @@ async def verify_spf(mail_from, ip_address, helo, score):
     if spf_count >= 2:
       verify_result["message"] = "spf:moreThanOne"
       verify_result["status"] = "error"
-      verify_result["subtract"] = score.subtract("spf", Score.SPF_ERR.value)
+      verify_result["subtract"] = score.subtract("SPF_ERR")
 
   verify_result['tests'].append(dns_test)
 
   return verify_result
 
-async def verify_rdns(ip, helo, rdns, score):
+async def verify_rdns(ip, helo, score):
+  try:
+    ptr_names, confirmed_names = await DNS.reverse(ip)
+  except Exception:
+    ptr_names, confirmed_names = [], []
+
   verify_result = {
     "message": "rdns:ok",
     "status": "success",
@@ -93,15 +97,16 @@ async def verify_rdns(ip, helo, rdns, score):
       'result' : [
         ['IP:', ip],
         ['HELO:', helo],
-        ['rDNS:', rdns]
+        ['rDNS:', ", ".join(ptr_names) or "none"],
+        ['FCrDNS:', ", ".join(confirmed_names) or "none"]
       ]
     }]
   }
 
-  if helo != rdns:
+  if helo.lower().rstrip('.') not in confirmed_names:
     verify_result["message"] = "rdns:nok"
     verify_result["status"] = "warning"
-    verify_result["subtract"] = score.subtract("rdns", Score.RDNS_WARN.value)
+    verify_result["subtract"] = score.subtract("RDNS_WARN")
 
   return verify_result
 
@@ -150,7 +155,7 @@ async def verify_domain_mx(domain, score):
   if mx_dns_result["status"] != "success":
     mx_check['result'] = mx_dns_result["message"] 
     verify_result['status'] = "error"
-    verify_result["subtract"] = score.subtract("mx", Score.MX_WARN.value)
+    verify_result["subtract"] = score.subtract("MX_WARN")
 
     verify_result['tests'].append(mx_check)
     return verify_result
@@ -180,19 +185,30 @@ async def verify_dkim(domain, email, email_str, score):
       "name": 'dkimpy',
       "result": 'No DKIM-Signature header present'
     })
-    verify_result["subtract"] = score.subtract("dkim", Score.DKIM_NO.value)
+    verify_result["subtract"] = score.subtract("DKIM_NO")
     return verify_result
   
-  try:
-    if dkim.verify(email) == True:
-      verify_result['tests'].append({
-        "name": 'dkimpy',
-        "result": 'Message passed DKIM validation'
-      })
-    else:
+  # The body hash can't be checked on a truncated message, and sending a
+  # huge message to the DKIM workers would copy it twice more.
+  if email_str.truncated:
+    verify_result['message'] = "dkim:notVerified"
+    verify_result['status'] = "warning"
+    verify_result['tests'].append({
+      "name": 'dkimpy',
+      "result": f'Message larger than {email_str.max_size} bytes, signature not verified'
+    })
+  else:
+    try:
+      key_records = await fetch_key_records(get_key_names(email_str.header_bytes))
+      if await verify_dkim_signature(email, key_records) == True:
+        verify_result['tests'].append({
+          "name": 'dkimpy',
+          "result": 'Message passed DKIM validation'
+        })
+      else:
+        bad_dkim = True
+    except dkim.DKIMException as e:
       bad_dkim = True
-  except dkim.DKIMException as e:
-    bad_dkim = True
 
   if bad_dkim:
     verify_result['message'] = "dkim:nok"
@@ -201,7 +217,7 @@ async def verify_dkim(domain, email, email_str, score):
       "name": 'dkimpy',
       "result": 'Message did not pass DKIM validation'
     })
-    verify_result["subtract"] = score.subtract("dkim", Score.DKIM_ERR.value)
+    verify_result["subtract"] = score.subtract("DKIM_ERR")
 
   pattern_dkim = r"v=((?P<version>[^;]+))|a=((?P<algorithm>[^;]+))|c=((?P<canonicalization>[^;]+))|d=((?P<domain>[^;]+))|s=((?P<selector>[^;]+))|t=((?P<timestamp>[^;]+))|bh=((?P<body_hash>[^;]+))|h=((?P<signed_headers>[^;]+))|b=((?P<signature>[^;]+))"
   
@@ -229,7 +245,8 @@ async def verify_dkim(domain, email, email_str, score):
     'result' : []
   }
 
-  dkim_dns_result = await DNS.resolve(dkim_selector + "._domainkey." + domain, 'TXT', 'dkim')
+  # Already cached by fetch_key_records, so this doesn't hit the network again.
+  dkim_dns_result = await DNS.resolve(dkim_selector + "._domainkey." + header_result.get('domain', domain), 'TXT', 'dkim')
 
   if dkim_dns_result["status"] != "success":
     dns_test['result'].append(dkim_dns_result["message"])
@@ -244,16 +261,26 @@ async def verify_dkim(domain, email, email_str, score):
   
   return verify_result
 
-async def verify_arc(email):
+async def verify_arc(email, email_str):
   verify_result = {
     "message": "arc:nok",
     "status": "error",
     "tests": []
   }
 
+  if email_str.truncated:
+    verify_result['message'] = "arc:notVerified"
+    verify_result['status'] = "warning"
+    verify_result['tests'].append({
+      "name": 'dkimpy',
+      "result": f'Message larger than {email_str.max_size} bytes, ARC chain not verified'
+    })
+    return verify_result
+
   #TODO: this doesn't seem to work...
   try:
-    cv, res, reason = dkim.arc_verify(email)
+    key_records = await fetch_key_records(get_key_names(email_str.header_bytes, (b"arc-seal", b"arc-message-signature")))
+    cv, res, reason = await verify_arc_chain(email, key_records)
 
     if isinstance(cv, bytes):
       cv = cv.decode('utf-8')
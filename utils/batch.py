@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import signal
+import asyncio
+import mailbox
+import argparse
+import threading
+import multiprocessing
+from email.utils import parseaddr
+from utils.config import logger, check_db, DB_SPOOL_DIR
+from utils.report import generate_reports
+from utils.database import save_report
+from utils.message import MessageView
+from utils import database, dkimpool
+
+PROGRESS_INTERVAL = 5
+CHECKPOINT_INTERVAL = 1
+
+class Envelope:
+  def __init__(self, content, mail_from, rcpt_tos):
+    self.mail_from = mail_from
+    self.rcpt_tos = rcpt_tos
+    self.content = content
+
+# Messages of an mbox file, a Maildir or a directory of .eml files (a single
+# .eml file works too). Keys are strings, so they can be kept in a checkpoint.
+class Source:
+  def __init__(self, path, source_format=None):
+    self.path = path
+    self.format = source_format or detect_format(path)
+    if self.format == "mbox":
+      self.mailbox = mailbox.mbox(path, create=False)
+    elif self.format == "maildir":
+      self.mailbox = mailbox.Maildir(path, factory=None, create=False)
+
+  def keys(self):
+    if self.format != "eml":
+      return [str(key) for key in self.mailbox.keys()]
+    if os.path.isfile(self.path):
+      return [os.path.basename(self.path)]
+
+    keys = []
+    for directory, _, names in os.walk(self.path):
+      keys.extend(os.path.relpath(os.path.join(directory, name), self.path) for name in names if name.endswith(".eml"))
+    return sorted(keys)
+
+  def get(self, key):
+    if self.format == "mbox":
+      return self.mailbox.get_bytes(int(key))
+    if self.format == "maildir":
+      return self.mailbox.get_bytes(key)
+
+    path = self.path if os.path.isfile(self.path) else os.path.join(self.path, key)
+    with open(path, "rb") as eml:
+      return eml.read()
+
+def detect_format(path):
+  if os.path.isdir(path):
+    if all(os.path.isdir(os.path.join(path, name)) for name in ("cur", "new", "tmp")):
+      return "maildir"
+    return "eml"
+  return "eml" if path.endswith(".eml") else "mbox"
+
+# Stored messages have no SMTP envelope, so it is taken from the headers
+# unless given on the command line.
+def get_envelope(content, mail_from=None, rcpt_to=None):
+  headers = MessageView(content)
+  if mail_from is None:
+    mail_from = parseaddr(str(headers.get('Return-Path') or headers.get('From') or ""))[1]
+  if rcpt_to is None:
+    rcpt_to = parseaddr(str(headers.get('Delivered-To') or headers.get('X-Original-To') or headers.get('To') or ""))[1]
+  return mail_from, rcpt_to
+
+def load_checkpoint(path):
+  if not path or not os.path.exists(path):
+    return set()
+  with open(path) as checkpoint:
+    return set(line.rstrip("\n") for line in checkpoint if line.strip())
+
+# Each worker process has its own event loop (and so its own DNS cache, DKIM
+# pool and database writer) and analyses up to `concurrency` messages at a
+# time, like a single x-ray worker does with SMTP traffic.
+def run_worker(index, messages, results, concurrency, save):
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  database.spool_dir = os.path.join(DB_SPOOL_DIR, f"batch-{index}")
+  asyncio.run(work(messages, results, concurrency, save))
+  results.put({"worker": index})
+  logger.flush()
+
+async def work(messages, results, concurrency, save):
+  loop = asyncio.get_running_loop()
+  pending = asyncio.Queue(maxsize=concurrency)
+
+  # Reads from the process queue in a thread so the event loop never blocks.
+  def read():
+    while True:
+      item = messages.get()
+      asyncio.run_coroutine_threadsafe(pending.put(item), loop).result()
+      if item is None:
+        break
+
+  threading.Thread(target=read, name="xray-batch-reader", daemon=True).start()
+
+  # With --db, a result is only passed on (and so checkpointed) once its
+  # report is committed or spooled, without holding up the next message.
+  saving = set()
+
+  async def consume():
+    while (item := await pending.get()) is not None:
+      result, saved = await analyze(*item, save)
+      if saved is None:
+        results.put(result)
+      else:
+        task = asyncio.create_task(report_saved(result, saved, results))
+        saving.add(task)
+        task.add_done_callback(saving.discard)
+    # Pass the end mark on to the other consumers.
+    await pending.put(None)
+
+  await asyncio.gather(*[consume() for _ in range(concurrency)])
+  # Flushes the last batch, which completes the pending results.
+  if database.writer is not None:
+    await database.writer.stop()
+  await asyncio.gather(*saving)
+  await loop.run_in_executor(None, dkimpool.shutdown)
+
+async def report_saved(result, saved, results):
+  try:
+    await saved
+  except Exception as e:
+    # Not checkpointed, so the next run analyses it again.
+    result = {"source": result["source"], "error": f"Report not saved: {e}", "retry": True}
+  results.put(result)
+
+async def analyze(key, mail_from, rcpt_to, content, save):
+  try:
+    general_report, spamassassin_report, authentication_report, rbl_report = await generate_reports(Envelope(content, mail_from, [rcpt_to]))
+  except Exception as e:
+    return {"source": key, "error": f"{type(e).__name__}: {e}"}, None
+
+  result, saved = {"source": key}, None
+  if save:
+    result["report_id"], saved = await save_report(general_report['sent_to'], general_report, spamassassin_report, authentication_report, rbl_report)
+  result.update(general=general_report, spamassassin=spamassassin_report, authentication=authentication_report, rbl=rbl_report)
+  return result, saved
+
+# Messages from the same sender domain go to the same worker, so its DNS
+# cache answers the SPF, DMARC and DKIM key lookups they have in common.
+def feed(source, keys, queues, processes, results, stopping, mail_from, rcpt_to):
+  for key in keys:
+    if stopping.is_set():
+      break
+    try:
+      content = source.get(key)
+    except (OSError, KeyError) as e:
+      results.put({"source": key, "error": f"{type(e).__name__}: {e}"})
+      continue
+
+    sender, recipient = get_envelope(content, mail_from, rcpt_to)
+    index = zlib.crc32(sender.rpartition("@")[2].lower().encode("utf-8")) % len(queues)
+    put(queues[index], (key, sender, recipient, content), processes[index], stopping)
+
+  for messages, process in zip(queues, processes):
+    put(messages, None, process)
+
+def put(messages, item, process, stopping=None):
+  while process.is_alive() and not (stopping and stopping.is_set()):
+    try:
+      messages.put(item, timeout=1)
+      return
+    except queue.Full:
+      pass
+
+class Progress:
+  def __init__(self, total):
+    self.total = total
+    self.done = 0
+    self.errors = 0
+    self.start = self.shown = time.monotonic()
+
+  def add(self, result):
+    self.done += 1
+    if "error" in result:
+      self.errors += 1
+
+  def show(self, force=False):
+    now = time.monotonic()
+    if not force and now - self.shown < PROGRESS_INTERVAL:
+      return
+    self.shown = now
+
+    elapsed = now - self.start
+    rate = self.done / elapsed if elapsed else 0
+    line = f"{self.done}/{self.total} messages, {self.errors} errors, {rate:.1f} msg/s, {elapsed:.0f}s elapsed"
+    if rate and self.done < self.total:
+      line += f", about {(self.total - self.done) / rate:.0f}s left"
+    print(line, file=sys.stderr, flush=True)
+
+def run(args):
+  source = Source(args.source, args.format)
+  done = load_checkpoint(args.checkpoint)
+  keys = [key for key in source.keys() if key not in done]
+  if done:
+    print(f"Skipping {len(done)} messages already in {args.checkpoint}", file=sys.stderr)
+
+  output = None
+  if args.output == "-":
+    output = sys.stdout
+  elif args.output:
+    output = open(args.output, "a")
+  checkpoint = open(args.checkpoint, "a") if args.checkpoint else None
+  checkpoint_keys = []
+  checkpoint_at = time.monotonic()
+
+  context = multiprocessing.get_context("spawn")
+  results = context.Queue()
+  queues = [context.Queue(maxsize=args.concurrency * 2) for _ in range(args.workers)]
+  processes = [context.Process(target=run_worker, args=(index, queues[index], results, args.concurrency, args.db), name=f"xray-batch-{index}") for index in range(args.workers)]
+  for process in processes:
+    process.start()
+
+  stopping = threading.Event()
+  threading.Thread(target=feed, args=(source, keys, queues, processes, results, stopping, args.mail_from, args.rcpt_to), name="xray-batch-feeder", daemon=True).start()
+
+  progress = Progress(len(keys))
+  running = set(range(args.workers))
+  while running:
+    try:
+      result = results.get(timeout=1)
+    except queue.Empty:
+      for index in list(running):
+        if processes[index].exitcode:
+          print(f"Worker {index} exited with code {processes[index].exitcode}, its messages are left for the next run", file=sys.stderr)
+          running.discard(index)
+      result = None
+    except KeyboardInterrupt:
+      if stopping.is_set():
+        raise
+      print("Interrupted, finishing the messages in progress (Ctrl-C again to abort)", file=sys.stderr)
+      stopping.set()
+      continue
+
+    if result is not None and "worker" in result:
+      running.discard(result["worker"])
+    elif result is not None:
+      progress.add(result)
+      if output is not None:
+        output.write(json.dumps(result) + "\n")
+      if not result.get("retry"):
+        checkpoint_keys.append(result["source"])
+
+    # Keys are only checkpointed once their results are on disk.
+    if checkpoint_keys and (not running or time.monotonic() - checkpoint_at >= CHECKPOINT_INTERVAL):
+      if output is not None:
+        output.flush()
+      if checkpoint is not None:
+        checkpoint.write("".join(f"{key}\n" for key in checkpoint_keys))
+        checkpoint.flush()
+      checkpoint_keys.clear()
+      checkpoint_at = time.monotonic()
+    progress.show()
+
+  for process in processes:
+    process.join()
+  progress.show(force=True)
+  for file in (output, checkpoint):
+    if file is not None and file is not sys.stdout:
+      file.close()
+
+# python3.11 -m utils.batch SOURCE --output reports.jsonl [--db] [--checkpoint FILE]
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python3.11 -m utils.batch", description="Analyse the messages of an mbox, a Maildir or a directory of .eml files")
+  parser.add_argument("source", help="mbox file, Maildir, directory with .eml files or a single .eml file")
+  parser.add_argument("--format", choices=("mbox", "maildir", "eml"), help="format of the source (detected if not given)")
+  parser.add_argument("--output", help="JSONL file the reports are appended to, or - for stdout")
+  parser.add_argument("--db", action="store_true", help="save the reports to the database too")
+  parser.add_argument("--checkpoint", help="file with the messages already processed; they are skipped and new ones are added")
+  parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+  parser.add_argument("--concurrency", type=int, default=20, help="messages analysed at the same time by each worker")
+  parser.add_argument("--mail-from", help="envelope sender (by default, from Return-Path or From)")
+  parser.add_argument("--rcpt-to", help="envelope recipient (by default, from Delivered-To, X-Original-To or To)")
+  args = parser.parse_args(argv)
+
+  if not args.output and not args.db:
+    parser.error("use --output and/or --db")
+  if args.db:
+    check_db()
+
+  run(args)
+
+if __name__ == "__main__":
+  main()
+  logger.flush()
@@ -0,0 +1,91 @@
+import re
+import time
+import hashlib
+from collections import OrderedDict
+import dkim
+from utils import metrics
+from utils.dkimpool import pattern_tag
+from utils.config import CHECK_CACHE_SIZE, CHECK_CACHE_TTL
+
+# Headers whose signatures the DKIM and ARC checks verify.
+SIGNATURE_HEADERS = (b"dkim-signature", b"arc-seal", b"arc-message-signature", b"arc-authentication-results")
+# Signatures listing the other headers they cover in their h= tag.
+SIGNED_HEADER_LISTS = (b"dkim-signature", b"arc-message-signature")
+
+# Authentication and RBL results of recently analysed messages. The same
+# message is often sent again within minutes (to the same or another
+# account), and these checks only depend on what the fingerprint covers:
+# the DKIM/ARC signatures and the headers they sign, the body, the source IP, the HELO and the envelope
+# sender. Results with timed out checks are not kept, and entries expire
+# after CHECK_CACHE_TTL seconds so listings and DNS changes are picked up.
+class CheckCache:
+  def __init__(self, max_size=CHECK_CACHE_SIZE, ttl=CHECK_CACHE_TTL):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.stats = {"hits": 0, "misses": 0, "skipped": 0, "evictions": 0}
+
+  def get(self, key):
+    entry = self.entries.get(key)
+    if entry is not None:
+      expires, results = entry
+      if expires > time.monotonic():
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return results
+      del self.entries[key]
+
+    self.stats["misses"] += 1
+    return None
+
+  def put(self, key, authentication_report, rbl_report, outcomes):
+    if self.max_size <= 0:
+      return
+    if not cacheable(authentication_report, rbl_report):
+      self.stats["skipped"] += 1
+      return
+
+    self.entries[key] = (time.monotonic() + self.ttl, (authentication_report, rbl_report, tuple(outcomes)))
+    self.entries.move_to_end(key)
+
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+      self.stats["evictions"] += 1
+
+  def get_stats(self):
+    lookups = self.stats["hits"] + self.stats["misses"]
+    return {
+      **self.stats,
+      "size": len(self.entries),
+      "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+    }
+
+# Signed headers are taken in relaxed canonical form (RFC 6376 3.4.2), in
+# message order, so rewrapping them doesn't change the key but editing them
+# does.
+def fingerprint(received_msg, ip, helo, mail_from):
+  headers, _ = dkim.rfc822_parse(received_msg.header_bytes)
+  signed = set(SIGNATURE_HEADERS)
+  for name, value in headers:
+    if name.lower() in SIGNED_HEADER_LISTS:
+      for match in pattern_tag.finditer(value):
+        if match.group("name").lower() == b"h":
+          signed.update(header.lower() for header in re.sub(rb"\s+", b"", match.group("value")).split(b":"))
+
+  digest = hashlib.sha256()
+  for name, value in headers:
+    if name.lower() in signed:
+      digest.update(name.lower() + b":" + re.sub(rb"\s+", b" ", value).strip() + b"\0")
+  digest.update(hashlib.sha256(memoryview(received_msg.data)[len(received_msg.header_bytes):]).digest())
+  digest.update(f"\0{ip}\0{helo}\0{mail_from.lower()}\0{received_msg.truncated}".encode("utf-8", errors="replace"))
+  return digest.hexdigest()
+
+def cacheable(authentication_report, rbl_report):
+  parts = [rbl_report, authentication_report] + [part for part in authentication_report.values() if isinstance(part, dict)]
+  return not any(part.get("timed_out") for part in parts)
+
+cache = CheckCache()
+
+metrics.registry.gauge("xray_check_cache_hits_total", "Messages whose authentication and RBL results came from the check cache", lambda: cache.stats["hits"], "counter")
+metrics.registry.gauge("xray_check_cache_misses_total", "Messages whose authentication and RBL checks had to run", lambda: cache.stats["misses"], "counter")
+metrics.registry.gauge("xray_check_cache_entries", "Check results currently cached", lambda: len(cache.entries))
@@ -1,7 +1,8 @@
 from dotenv import dotenv_values
+import os
 import sys
 import importlib.util
-import subprocess
+from utils.logger import AsyncLogger
 
 dependencies = ["aiosmtpd", "pymysql", "asyncio", "dkim", "dns", "uuid_utils", "dotenv"]
 
@@ -16,12 +17,45 @@ config = dotenv_values(".env")
 VERSION=0.8
 PORT = int(config.get("PORT", 10031))
 HOSTNAME = config.get("HOSTNAME", "127.0.0.1")
+HTTP_HOSTNAME = config.get("HTTP_HOSTNAME", "127.0.0.1")
+HTTP_PORT = int(config.get("HTTP_PORT", 10033))
+WORKERS = int(config.get("WORKERS", 1)) or os.cpu_count()
+
+LOG_TARGET = config.get("LOG_TARGET", "syslog")
+LOG_LEVEL = config.get("LOG_LEVEL", "info")
+LOG_QUEUE_SIZE = int(config.get("LOG_QUEUE_SIZE", 10000))
+LOG_QUEUE_POLICY = config.get("LOG_QUEUE_POLICY", "drop")
 
 DB_HOST = config.get("DB_HOST", "127.0.0.1")
 DB_PORT = int(config.get("DB_PORT", 3306))
 DB_DATABASE = config.get("DB_DATABASE")
 DB_USERNAME = config.get("DB_USERNAME")
 DB_PASSWORD = config.get("DB_PASSWORD")
+DB_POOL_SIZE = int(config.get("DB_POOL_SIZE", 2))
+DB_BATCH_SIZE = int(config.get("DB_BATCH_SIZE", 50))
+DB_BATCH_INTERVAL = float(config.get("DB_BATCH_INTERVAL", 0.5))
+DB_QUEUE_SIZE = int(config.get("DB_QUEUE_SIZE", 1000))
+DB_SPOOL_DIR = config.get("DB_SPOOL_DIR", "spool/reports")
+DB_REPLAY_INTERVAL = float(config.get("DB_REPLAY_INTERVAL", 30))
+REPORT_RETENTION_DAYS = int(config.get("REPORT_RETENTION_DAYS", 0))
+RETENTION_INTERVAL = float(config.get("RETENTION_INTERVAL", 3600))
+RETENTION_BATCH_SIZE = int(config.get("RETENTION_BATCH_SIZE", 1000))
+RETENTION_BATCH_PAUSE = float(config.get("RETENTION_BATCH_PAUSE", 0.1))
+REPORT_CACHE_SIZE = int(config.get("REPORT_CACHE_SIZE", 1000))
+REPORT_CACHE_TTL = float(config.get("REPORT_CACHE_TTL", 300))
+ACCOUNTS_REFRESH_INTERVAL = float(config.get("ACCOUNTS_REFRESH_INTERVAL", 10))
+ACCOUNTS_NEGATIVE_TTL = float(config.get("ACCOUNTS_NEGATIVE_TTL", 60))
+EVENTS_BUFFER_SIZE = int(config.get("EVENTS_BUFFER_SIZE", 1000))
+EVENTS_BUFFER_TTL = float(config.get("EVENTS_BUFFER_TTL", 300))
+EVENTS_QUEUE_SIZE = int(config.get("EVENTS_QUEUE_SIZE", 100))
+EVENTS_KEEPALIVE = float(config.get("EVENTS_KEEPALIVE", 15))
+
+ANALYSIS_QUEUE_SIZE = int(config.get("ANALYSIS_QUEUE_SIZE", 0))
+ANALYSIS_CONCURRENCY = int(config.get("ANALYSIS_CONCURRENCY", 10))
+ANALYSIS_SPOOL_DIR = config.get("ANALYSIS_SPOOL_DIR", "spool/messages")
+
+MESSAGE_STORE_DIR = config.get("MESSAGE_STORE_DIR", "store/messages")
+MESSAGE_STORE_LEVEL = int(config.get("MESSAGE_STORE_LEVEL", 6))
 
 SCORE_SPAMASSASSIN_SPAM = float(config.get("SCORE_SPAMASSASSIN_SPAM", 3))
 SCORE_SPF_ERR = float(config.get("SCORE_SPF_ERR", 3))
@@ -32,12 +66,58 @@ SCORE_DKIM_NO = float(config.get("SCORE_DKIM_NO", 1))
 SCORE_DKIM_ERR = float(config.get("SCORE_DKIM_ERR", 3))
 SCORE_RBL_ERR = float(config.get("SCORE_RBL_ERR", 1.5))
 
+DNS_CACHE_SIZE = int(config.get("DNS_CACHE_SIZE", 10000))
+DNS_CACHE_MIN_TTL = int(config.get("DNS_CACHE_MIN_TTL", 0))
+DNS_CACHE_MAX_TTL = int(config.get("DNS_CACHE_MAX_TTL", 86400))
+DNS_NEGATIVE_TTL = int(config.get("DNS_NEGATIVE_TTL", 300))
+DNS_UPSTREAMS = config.get("DNS_UPSTREAMS")
+DNS_TIMEOUT = float(config.get("DNS_TIMEOUT", 5))
+DNS_MAX_ATTEMPTS = int(config.get("DNS_MAX_ATTEMPTS", 3))
+DNS_HEDGE_PERCENTILE = float(config.get("DNS_HEDGE_PERCENTILE", 95))
+DNS_HEDGE_MIN_DELAY = float(config.get("DNS_HEDGE_MIN_DELAY", 0.01))
+DNS_HEDGE_MAX_DELAY = float(config.get("DNS_HEDGE_MAX_DELAY", 0.5))
+
+CHECK_CACHE_SIZE = int(config.get("CHECK_CACHE_SIZE", 1000))
+CHECK_CACHE_TTL = float(config.get("CHECK_CACHE_TTL", 300))
+
+DKIM_WORKERS = int(config.get("DKIM_WORKERS", 2))
+DKIM_KEY_CACHE_SIZE = int(config.get("DKIM_KEY_CACHE_SIZE", 1024))
+
+RBL_ZONES_FILE = config.get("RBL_ZONES_FILE")
+RBL_TIMEOUT = float(config.get("RBL_TIMEOUT", 3))
+RBL_BREAKER_THRESHOLD = int(config.get("RBL_BREAKER_THRESHOLD", 5))
+RBL_BREAKER_COOLDOWN = float(config.get("RBL_BREAKER_COOLDOWN", 60))
+
+SPAMD_HOST = config.get("SPAMD_HOST")
+SPAMD_PORT = int(config.get("SPAMD_PORT", 783))
+SPAMD_USER = config.get("SPAMD_USER")
+SPAMD_COMMAND = config.get("SPAMD_COMMAND", "REPORT")
+SPAMD_TIMEOUT = float(config.get("SPAMD_TIMEOUT", 8))
+SPAMD_MAX_CONNECTIONS = int(config.get("SPAMD_MAX_CONNECTIONS", 5))
+SPAMD_MAX_SIZE = int(config.get("SPAMD_MAX_SIZE", 512000))
+
+PROFILE_ENABLED = int(config.get("PROFILE_ENABLED", 0)) == 1
+PROFILE_SAMPLE_RATE = float(config.get("PROFILE_SAMPLE_RATE", 0.01))
+PROFILE_DIR = config.get("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(config.get("PROFILE_KEEP", 50))
+PROFILE_TRACEMALLOC_FRAMES = int(config.get("PROFILE_TRACEMALLOC_FRAMES", 10))
+SLOW_CALLBACK_THRESHOLD = float(config.get("SLOW_CALLBACK_THRESHOLD", 0.1))
+
+MAX_MESSAGE_SIZE = int(config.get("MAX_MESSAGE_SIZE", 10 * 1024 * 1024))
+MESSAGE_DEADLINE = float(config.get("MESSAGE_DEADLINE", 30))
+CHECK_TIMEOUT = float(config.get("CHECK_TIMEOUT", 10))
+# Per-check overrides, e.g. CHECK_TIMEOUT_SPF=5 or CHECK_TIMEOUT_RBL=8
+CHECK_TIMEOUTS = {key[len("CHECK_TIMEOUT_"):].lower(): float(value) for key, value in config.items() if key.startswith("CHECK_TIMEOUT_") and value}
+
 def check_db():
   if not DB_USERNAME or not DB_PASSWORD:
     message="ERROR: DB_USERNAME and DB_PASSWORD must be defined in '.env' file."
     print(message)
     sys.exit(1)
 
-# This function lets us output data into the postfix log file.
-def log(message, priority='info'):
-  subprocess.run(['postlog', '-p', priority, '-t', 'xray', message])
\ No newline at end of file
+logger = AsyncLogger(LOG_TARGET, LOG_LEVEL, LOG_QUEUE_SIZE, LOG_QUEUE_POLICY)
+
+# This function lets us output data into the postfix log file. Extra keyword
+# arguments are appended as key=value pairs (message id, stage timings...).
+def log(message, priority='info', **fields):
+  logger.log(message, priority, **fields)
\ No newline at end of file
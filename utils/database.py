@@ -1,22 +1,544 @@
+import os
+import json
+import time
+import fcntl
+import queue
+import asyncio
 import pymysql.cursors
 import uuid_utils as uuid
-import json
-from utils.config import log, DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD, DB_DATABASE
-# Connect to the database
+from utils import metrics
+from concurrent.futures import ThreadPoolExecutor
+from utils.config import log, DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD, DB_DATABASE, DB_POOL_SIZE, DB_BATCH_SIZE, DB_BATCH_INTERVAL, DB_QUEUE_SIZE, DB_SPOOL_DIR, DB_REPLAY_INTERVAL, ACCOUNTS_REFRESH_INTERVAL, ACCOUNTS_NEGATIVE_TTL
 
-async def save_report(sent_to, general_report, spamassassin_report, authentication_report, rbl_report):
-   
-  connection = pymysql.connect(host=DB_HOST,
-                              user=DB_USERNAME,
-                              password=DB_PASSWORD,
-                              database=DB_DATABASE,
-                              charset='utf8mb4',
-                              cursorclass=pymysql.cursors.DictCursor)
-  
-  try:
-    with connection.cursor() as cursor:
-      sql = "INSERT INTO reports (id, account_id, general, spamassassin, authentication, rbl) VALUES (%s, (SELECT id FROM accounts WHERE name = %s), %s, %s, %s, %s);"
-      cursor.execute(sql, (str(uuid.uuid7()), sent_to, json.dumps(general_report), json.dumps(spamassassin_report), json.dumps(authentication_report), json.dumps(rbl_report)))
+REPORT_COLUMNS = "(id, account_id, results_id, score, score_outcomes, source_ip, sender_domain, spf_status, dkim_status, dmarc_status, rbl_status, spamassassin_status, message_sha256, general, spamassassin, authentication, rbl, created_at)"
+REPORT_VALUES = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FROM_UNIXTIME(%s))"
+# For reports whose account was not in the account cache.
+REPORT_VALUES_BY_NAME = "(%s, (SELECT id FROM accounts WHERE name = %s), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FROM_UNIXTIME(%s))"
+# Check results shared by the reports of a message sent to several accounts.
+RESULTS_COLUMNS = "(id, spamassassin, authentication, rbl)"
+RESULTS_VALUES = "(%s, %s, %s, %s)"
+MAX_MISSING_ACCOUNTS = 10000
+
+# Keeps a few open connections so reports don't pay a connect/auth handshake
+# each time. Connections are only used from the writer's worker threads.
+class ConnectionPool:
+  def __init__(self, size=DB_POOL_SIZE):
+    self.connections = queue.LifoQueue(maxsize=size)
+
+  def connect(self):
+    return pymysql.connect(host=DB_HOST,
+                           port=DB_PORT,
+                           user=DB_USERNAME,
+                           password=DB_PASSWORD,
+                           database=DB_DATABASE,
+                           charset='utf8mb4',
+                           cursorclass=pymysql.cursors.DictCursor)
+
+  def acquire(self):
+    try:
+      connection = self.connections.get_nowait()
+      connection.ping(reconnect=True)
+      return connection
+    except queue.Empty:
+      return self.connect()
+
+  def release(self, connection):
+    try:
+      self.connections.put_nowait(connection)
+    except queue.Full:
+      connection.close()
+
+  def discard(self, connection):
+    try:
+      connection.close()
+    except Exception:
+      pass
+
+# In-memory index of accounts.name -> id. A cheap query checks every
+# ACCOUNTS_REFRESH_INTERVAL seconds whether the table changed, and only then
+# is it loaded again. Names not found are looked up once in the database and
+# remembered as missing for ACCOUNTS_NEGATIVE_TTL seconds.
+class AccountCache:
+  def __init__(self, refresh_interval=ACCOUNTS_REFRESH_INTERVAL, negative_ttl=ACCOUNTS_NEGATIVE_TTL):
+    self.refresh_interval = refresh_interval
+    self.negative_ttl = negative_ttl
+    self.pool = ConnectionPool(size=1)
+    self.ids = {}
+    self.missing = {}
+    self.version = None
+    self.retry_at = 0
+    self.task = None
+    self.stats = {"hits": 0, "misses": 0, "negative_hits": 0, "reloads": 0}
+
+  async def start(self):
+    try:
+      await asyncio.get_running_loop().run_in_executor(None, self.refresh)
+    except Exception as e:
+      log(f"Could not load accounts, they will be looked up one by one: {e}", "warning")
+    self.task = asyncio.create_task(self.refresh_periodically())
+
+  def stop(self):
+    if self.task is not None:
+      self.task.cancel()
+
+  async def refresh_periodically(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      await asyncio.sleep(self.refresh_interval)
+      try:
+        await loop.run_in_executor(None, self.refresh)
+      except Exception as e:
+        log(f"Could not refresh accounts: {e}", "warning")
+
+  def query(self, sql, params=None):
+    connection = self.pool.acquire()
+    try:
+      with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+      # Ends the transaction, so the next query sees new accounts.
       connection.commit()
-  finally:
-    connection.close()
\ No newline at end of file
+    except Exception:
+      self.pool.discard(connection)
+      raise
+    self.pool.release(connection)
+    return rows
+
+  def refresh(self):
+    version = self.query("SELECT COUNT(*) AS count, MAX(id) AS max_id, MAX(updated_at) AS updated_at FROM accounts;")[0]
+    version = (version["count"], version["max_id"], str(version["updated_at"]))
+    if version == self.version:
+      return
+
+    rows = self.query("SELECT id, name FROM accounts;")
+    self.ids = {row["name"].lower(): row["id"] for row in rows}
+    self.missing = {}
+    self.version = version
+    self.stats["reloads"] += 1
+
+  def get(self, name):
+    return self.ids.get(name.lower())
+
+  # Account id, or None if there is no such account. Database errors are
+  # raised, so callers can tell "unknown" from "could not check".
+  async def lookup(self, name):
+    key = name.lower()
+    if key in self.ids:
+      self.stats["hits"] += 1
+      return self.ids[key]
+
+    now = time.monotonic()
+    if self.missing.get(key, 0) > now:
+      self.stats["negative_hits"] += 1
+      return None
+
+    # After a database error, lookups are not retried for a while so RCPT
+    # commands don't each wait for a connection timeout.
+    if self.retry_at > now:
+      raise pymysql.err.OperationalError("Account lookups paused after a database error")
+
+    self.stats["misses"] += 1
+    try:
+      rows = await asyncio.get_running_loop().run_in_executor(None, self.query, "SELECT id FROM accounts WHERE name = %s;", (name,))
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+      self.retry_at = time.monotonic() + self.refresh_interval
+      raise
+    if rows:
+      self.ids[key] = rows[0]["id"]
+      return rows[0]["id"]
+
+    if len(self.missing) >= MAX_MISSING_ACCOUNTS:
+      self.missing = {missing: expires for missing, expires in self.missing.items() if expires > now}
+    self.missing[key] = now + self.negative_ttl
+    return None
+
+# Write-behind pipeline for reports. save_reports only enqueues; batches are
+# flushed by size or time as multi-row INSERTs from a thread pool. While the
+# database is unavailable (or the queue is full) batches are spooled to disk
+# and replayed once it is back, so SMTP deliveries are never stalled or lost.
+# Queue items are groups: the reports of one message (one per recipient) and,
+# for several recipients, the check results they share. A group is always
+# written in the same transaction. Rows carry their own created_at, so one
+# written again after an uncertain commit (e.g. the connection dropped before
+# the OK came back) hits the primary key and is skipped instead of duplicated.
+class ReportWriter:
+  def __init__(self, batch_size=DB_BATCH_SIZE, batch_interval=DB_BATCH_INTERVAL, queue_size=DB_QUEUE_SIZE, spool_dir=DB_SPOOL_DIR):
+    self.batch_size = batch_size
+    self.batch_interval = batch_interval
+    self.spool_dir = spool_dir
+    self.queue = asyncio.Queue(maxsize=queue_size)
+    self.pool = ConnectionPool()
+    self.executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="xray-db")
+    self.slots = asyncio.Semaphore(DB_POOL_SIZE)
+    self.pending = set()
+    # Groups taken from the queue for the next batch, flushed by stop() too.
+    self.batch = []
+    self.stopping = False
+    # Futures of the queued groups, by the id of their first report.
+    self.waiters = {}
+    self.tasks = []
+    self.db_available = True
+    self.stats = {"written": 0, "spooled": 0, "replayed": 0, "dropped": 0, "batches": 0}
+
+  def start(self):
+    os.makedirs(self.spool_dir, exist_ok=True)
+    self.tasks = [asyncio.create_task(self.collect()), asyncio.create_task(self.replay_spool())]
+
+  # Whatever is still in memory is written (or spooled, if that fails)
+  # before returning.
+  async def stop(self):
+    self.stopping = True
+    for task in self.tasks:
+      task.cancel()
+    await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    batch, self.batch = self.batch, []
+    while not self.queue.empty():
+      batch.append(self.queue.get_nowait())
+    if batch:
+      await self.dispatch(batch)
+    if self.pending:
+      await asyncio.gather(*self.pending)
+
+    self.executor.shutdown(wait=True)
+
+  # Returns a future, done once the group has been committed or spooled to
+  # disk (or dropped as invalid), i.e. once it no longer depends on this
+  # process staying up. Its exception is set if even spooling failed. Groups
+  # put after stop() (e.g. by an analysis that outlived the shutdown) are
+  # spooled right away.
+  async def put(self, group):
+    loop = asyncio.get_running_loop()
+    saved = loop.create_future()
+    if self.stopping:
+      log("Report writer stopped, spooling report to disk", "warning")
+      try:
+        self.spool([group])
+      except Exception as e:
+        saved.set_exception(e)
+      else:
+        saved.set_result(None)
+      return saved
+
+    try:
+      self.queue.put_nowait(group)
+    except asyncio.QueueFull:
+      log("Report queue is full, spooling report to disk", "warning")
+      try:
+        await loop.run_in_executor(self.executor, self.spool, [group])
+      except Exception as e:
+        saved.set_exception(e)
+      else:
+        saved.set_result(None)
+      return saved
+
+    self.waiters[group["rows"][0]["id"]] = saved
+    return saved
+
+  # Also checks self.stopping, as asyncio.wait_for can swallow the
+  # cancellation when the queue.get() it wraps completes at the same time.
+  async def collect(self):
+    while not self.stopping:
+      self.batch.append(await self.queue.get())
+      size = len(self.batch[0]["rows"])
+      flush_at = time.monotonic() + self.batch_interval
+
+      while size < self.batch_size and not self.stopping:
+        timeout = flush_at - time.monotonic()
+        if timeout <= 0:
+          break
+        try:
+          self.batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+        size += len(self.batch[-1]["rows"])
+
+      if self.stopping:
+        break
+      # Only handed over once dispatched, so a batch still waiting for a
+      # slot when the writer stops is flushed by stop().
+      await self.dispatch(self.batch)
+      self.batch = []
+
+  async def dispatch(self, batch):
+    await self.slots.acquire()
+    task = asyncio.get_running_loop().run_in_executor(self.executor, self.write_batch, batch)
+    self.pending.add(task)
+
+    def done(future):
+      self.pending.discard(future)
+      self.slots.release()
+      if future.exception() is not None:
+        log(f"Could not save or spool {count_rows(batch)} reports: {future.exception()}", "error")
+      else:
+        self.notify(future.result())
+
+      for group in batch:
+        saved = self.waiters.pop(group["rows"][0]["id"], None)
+        if saved is None or saved.done():
+          continue
+        if future.exception() is not None:
+          saved.set_exception(future.exception())
+        else:
+          saved.set_result(None)
+
+    task.add_done_callback(done)
+
+  # Returns the groups that were committed; spooled ones are committed (and
+  # returned by replay) later.
+  def write_batch(self, groups):
+    if not self.db_available:
+      self.spool(groups)
+      return []
+
+    committed = []
+    remaining = []
+    try:
+      try:
+        self.insert(groups)
+        self.stats["written"] += count_rows(groups)
+        self.stats["batches"] += 1
+        return groups
+      except pymysql.err.IntegrityError:
+        # One bad row (e.g. unknown account) fails the whole statement; retry
+        # one by one so only that row is lost.
+        remaining = split_rows(groups)
+        self.insert_one_by_one(remaining, committed)
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+      self.db_available = False
+      log(f"Database unavailable, spooling reports to disk: {e}", "warning")
+      self.spool(remaining or groups)
+    except Exception as e:
+      log(f"Unexpected error saving reports, spooling them to disk: {e}", "error")
+      self.spool(remaining or groups)
+    return committed
+
+  # Groups of one row each are taken off the front of remaining once they are
+  # committed (and added to committed) or dropped, so if this raises,
+  # remaining holds the rows still to be written.
+  def insert_one_by_one(self, remaining, committed):
+    while remaining:
+      group = remaining[0]
+      row = group["rows"][0]
+      try:
+        self.insert([group])
+        self.stats["written"] += 1
+        committed.append(group)
+      except pymysql.err.IntegrityError as e:
+        self.stats["dropped"] += 1
+        log(f"Report {row['id']} for {row['sent_to']} could not be saved: {e}", "error")
+      remaining.pop(0)
+
+  # Listeners only hear about reports once they can be read from the
+  # database, with the check results of shared reports filled in.
+  def notify(self, groups):
+    for group in groups:
+      parts = group.get("results")
+      for row in group["rows"]:
+        if parts is not None:
+          row = {**row, "spamassassin": parts["spamassassin"], "authentication": parts["authentication"], "rbl": parts["rbl"]}
+        for listener in listeners:
+          listener(row)
+
+  def insert(self, groups):
+    rows = [(row, group.get("results")) for group in groups for row in group["rows"]]
+    values = [REPORT_VALUES if row.get('account_id') else REPORT_VALUES_BY_NAME for row, _ in rows]
+    sql = f"INSERT INTO reports {REPORT_COLUMNS} VALUES " + ", ".join(values) + " ON DUPLICATE KEY UPDATE id = id;"
+    params = []
+    for row, results in rows:
+      params.extend(serialize(row, results))
+
+    results = [group["results"] for group in groups if group.get("results")]
+    # Results already written by an earlier, partly failed attempt are kept.
+    results_sql = f"INSERT INTO report_results {RESULTS_COLUMNS} VALUES " + ", ".join([RESULTS_VALUES] * len(results)) + " ON DUPLICATE KEY UPDATE id = id;"
+    results_params = []
+    for result in results:
+      results_params.extend((result['id'], json.dumps(result['spamassassin']), json.dumps(result['authentication']), json.dumps(result['rbl'])))
+
+    start = time.monotonic()
+    connection = self.pool.acquire()
+    try:
+      with connection.cursor() as cursor:
+        if results:
+          cursor.execute(results_sql, results_params)
+        cursor.execute(sql, params)
+      connection.commit()
+    except Exception:
+      self.pool.discard(connection)
+      raise
+    self.pool.release(connection)
+    metrics.stage_duration.observe(time.monotonic() - start, stage="db_write")
+
+  def spool(self, groups):
+    name = f"{time.time_ns()}-{uuid.uuid7()}.jsonl"
+    path = os.path.join(self.spool_dir, name)
+
+    with open(path + ".tmp", "w") as journal:
+      for group in groups:
+        journal.write(json.dumps(group) + "\n")
+      journal.flush()
+      os.fsync(journal.fileno())
+    os.replace(path + ".tmp", path)
+
+    self.stats["spooled"] += count_rows(groups)
+
+  async def replay_spool(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      await asyncio.sleep(DB_REPLAY_INTERVAL)
+      committed = []
+      try:
+        await loop.run_in_executor(self.executor, self.replay, committed)
+      except Exception as e:
+        log(f"Replaying spooled reports failed: {e}", "warning")
+      self.notify(committed)
+
+  # Groups written are added to committed, which is kept even if a later
+  # file fails.
+  def replay(self, committed):
+    files = self.spool_files()
+    if not files:
+      return
+
+    if not self.db_available:
+      # Probe the database before replaying anything.
+      self.pool.release(self.pool.acquire())
+      self.db_available = True
+      log("Database available again, replaying spooled reports")
+
+    for path in files:
+      try:
+        journal = open(path)
+      except FileNotFoundError:
+        continue
+
+      with journal:
+        # Several writers may replay the same file (see spool_files), so it is
+        # claimed with a lock, released when it is closed or the process dies.
+        # A file removed meanwhile was replayed by whoever held the lock.
+        try:
+          fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+          continue
+        if os.fstat(journal.fileno()).st_nlink == 0:
+          continue
+        # Older spool files have one report per line.
+        groups = [group if "rows" in group else {"rows": [group]} for group in map(json.loads, filter(str.strip, journal))]
+
+        try:
+          try:
+            self.insert(groups)
+            self.stats["written"] += count_rows(groups)
+            committed.extend(groups)
+          except pymysql.err.IntegrityError:
+            # Should this fail half way, the whole file is replayed again
+            # later, and the rows already committed are skipped then.
+            self.insert_one_by_one(split_rows(groups), committed)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+          self.db_available = False
+          raise
+
+        self.stats["replayed"] += count_rows(groups)
+        os.remove(path)
+
+  # The writer spooling to DB_SPOOL_DIR itself (the only one, or the first
+  # worker's) also replays the directories of the other workers and of batch
+  # runs in it, so reports spooled by workers that no longer exist (e.g.
+  # after WORKERS was lowered) are written too.
+  def spool_files(self):
+    directories = [self.spool_dir]
+    if os.path.abspath(self.spool_dir) == os.path.abspath(DB_SPOOL_DIR):
+      directories += sorted(entry.path for entry in os.scandir(self.spool_dir) if entry.is_dir())
+
+    files = []
+    for directory in directories:
+      files.extend(os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".jsonl"))
+    return files
+
+def count_rows(groups):
+  return sum(len(group["rows"]) for group in groups)
+
+def split_rows(groups):
+  return [{**group, "rows": [row]} for group in groups for row in group["rows"]]
+
+# The indexed columns are extracted here rather than in save_report, so
+# reports spooled by older versions get them too. Reports with shared check
+# results take them from report_results and store none of their own. Reports
+# spooled without a created_at get the time they are written.
+def serialize(row, results=None):
+  general = row['general']
+  parts = results or row
+  authentication = parts['authentication']
+  return (
+    row['id'],
+    row.get('account_id') or row['sent_to'],
+    row.get('results_id'),
+    general.get('score'),
+    ",".join(general['score_outcomes']) if 'score_outcomes' in general else None,
+    general.get('source_ip'),
+    (general.get('sent_from') or "").rpartition("@")[2].lower() or None,
+    authentication.get('spf', {}).get('status'),
+    authentication.get('dkim', {}).get('status'),
+    authentication.get('dmarc', {}).get('status'),
+    parts['rbl'].get('status'),
+    parts['spamassassin'].get('status'),
+    general.get('message_sha256'),
+    json.dumps(general),
+    json.dumps(row['spamassassin']) if results is None else None,
+    json.dumps(authentication) if results is None else None,
+    json.dumps(row['rbl']) if results is None else None,
+    row.get('created_at') or int(time.time()),
+  )
+
+writer = None
+accounts = AccountCache()
+# Called on the event loop with every report written to the database, e.g. to
+# cache it for the report API (see utils/api.py). Worker processes forward
+# reports to the supervisor.
+listeners = []
+# Each worker process (see utils/supervisor.py) spools to its own directory.
+spool_dir = DB_SPOOL_DIR
+
+metrics.registry.gauge("xray_db_queue_depth", "Messages whose reports are waiting to be written", lambda: writer.queue.qsize() if writer else 0)
+metrics.registry.gauge("xray_db_reports_written_total", "Reports written to the database", lambda: writer.stats["written"] if writer else 0, "counter")
+metrics.registry.gauge("xray_db_reports_spooled_total", "Reports spooled to disk", lambda: writer.stats["spooled"] if writer else 0, "counter")
+metrics.registry.gauge("xray_db_reports_dropped_total", "Reports that could not be saved", lambda: writer.stats["dropped"] if writer else 0, "counter")
+
+metrics.registry.gauge("xray_accounts_cached", "Accounts in the account cache", lambda: len(accounts.ids))
+metrics.registry.gauge("xray_account_cache_misses_total", "Account lookups that went to the database", lambda: accounts.stats["misses"], "counter")
+
+def get_writer():
+  global writer
+  if writer is None:
+    writer = ReportWriter(spool_dir=spool_dir)
+    writer.start()
+  return writer
+
+async def save_report(sent_to, general_report, spamassassin_report, authentication_report, rbl_report):
+  report_ids, saved = await save_reports([sent_to], general_report, spamassassin_report, authentication_report, rbl_report)
+  return report_ids[0], saved
+
+# A message is analysed once, whatever its number of recipients, and every
+# recipient gets its own report (general only differs in sent_to). With
+# several recipients the check results are stored once, in report_results,
+# and their reports refer to them. Returns the report ids and a future done
+# once they are committed or spooled (see ReportWriter.put).
+async def save_reports(recipients, general_report, spamassassin_report, authentication_report, rbl_report):
+  # The same address may be given twice, in a different case too.
+  recipients = list({recipient.lower(): recipient for recipient in recipients}.values())
+  created_at = int(time.time())
+  parts = {"spamassassin": spamassassin_report, "authentication": authentication_report, "rbl": rbl_report}
+  results = {"id": str(uuid.uuid7()), **parts} if len(recipients) > 1 else None
+
+  rows = []
+  for sent_to in recipients:
+    rows.append({
+      "id": str(uuid.uuid7()),
+      "sent_to": sent_to,
+      "account_id": accounts.get(sent_to),
+      "general": {**general_report, "sent_to": sent_to},
+      "created_at": created_at,
+      **({"results_id": results["id"]} if results else parts),
+    })
+  saved = await get_writer().put({"rows": rows, "results": results} if results else {"rows": rows})
+  return [row["id"] for row in rows], saved
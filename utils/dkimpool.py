@@ -0,0 +1,87 @@
+import re
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import dkim
+from utils.config import DKIM_WORKERS, DKIM_KEY_CACHE_SIZE
+from utils.misc import DNS
+
+# DKIM and ARC verification run in a worker pool so canonicalization, hashing
+# and signature checks never block the event loop. Key records are fetched
+# beforehand through the shared async resolver and handed to dkimpy through
+# its public dnsfunc argument, so it never touches the network itself.
+executor = None
+
+pattern_tag = re.compile(rb"(?:^|;)\s*(?P<name>[a-z]+)\s*=\s*(?P<value>[^;]*)", re.IGNORECASE)
+
+# Parsed public keys are cached in each process by selector/domain and key
+# record, so rotated keys are picked up right away. dkimpy parses the record
+# dnsfunc returns with dkim.evaluate_pk, which is wrapped here rather than
+# overriding any of its classes; install.sh pins dkimpy to the 1.1 series
+# that does so. Keys are just parsed every time if a version doesn't.
+if DKIM_KEY_CACHE_SIZE > 0 and hasattr(dkim, "evaluate_pk") and not hasattr(dkim.evaluate_pk, "cache_info"):
+  dkim.evaluate_pk = functools.lru_cache(maxsize=DKIM_KEY_CACHE_SIZE)(dkim.evaluate_pk)
+
+def get_executor():
+  global executor
+  if executor is None and DKIM_WORKERS > 0:
+    executor = ProcessPoolExecutor(max_workers=DKIM_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+  return executor
+
+# Called when the worker stops; the pool's processes and semaphores are not
+# cleaned up reliably at interpreter exit otherwise.
+def shutdown():
+  global executor
+  if executor is not None:
+    executor.shutdown(wait=True, cancel_futures=True)
+    executor = None
+
+def get_key_names(message, header_names=(b"dkim-signature",)):
+  names = []
+  headers, _ = dkim.rfc822_parse(message)
+
+  for name, value in headers:
+    if name.lower() not in header_names:
+      continue
+    tags = {match.group("name").lower(): re.sub(rb"\s+", b"", match.group("value")) for match in pattern_tag.finditer(value)}
+    if b"s" in tags and b"d" in tags:
+      key_name = tags[b"s"] + b"._domainkey." + tags[b"d"] + b"."
+      if key_name not in names:
+        names.append(key_name)
+
+  return names
+
+async def fetch_key_records(names):
+  results = await asyncio.gather(*[fetch_key_record(name) for name in names])
+  return dict(zip(names, results))
+
+async def fetch_key_record(name):
+  result = await DNS.resolve(name.decode("utf-8", errors="replace"), "TXT", "dkim")
+  if result["status"] != "success":
+    return None
+  for rdata in result["data"]:
+    return b"".join(rdata.strings)
+  return None
+
+def run_dkim_verify(message, records):
+  dnsfunc = lambda name, timeout=5: records.get(name)
+  d = dkim.DKIM(message)
+  try:
+    return d.verify(dnsfunc=dnsfunc)
+  except dkim.DKIMException:
+    return False
+
+def run_arc_verify(message, records):
+  dnsfunc = lambda name, timeout=5: records.get(name)
+  a = dkim.ARC(message)
+  try:
+    return a.verify(dnsfunc=dnsfunc)
+  except dkim.DKIMException as e:
+    return dkim.CV_Fail, [], "%s" % e
+
+async def verify_dkim_signature(message, records):
+  return await asyncio.get_running_loop().run_in_executor(get_executor(), run_dkim_verify, message, records)
+
+async def verify_arc_chain(message, records):
+  return await asyncio.get_running_loop().run_in_executor(get_executor(), run_arc_verify, message, records)
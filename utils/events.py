@@ -0,0 +1,147 @@
+import json
+import time
+import asyncio
+from collections import deque
+from utils import metrics, database
+from utils.http import Response, write_head
+from utils.api import is_report_id
+from utils.config import log, EVENTS_BUFFER_SIZE, EVENTS_BUFFER_TTL, EVENTS_QUEUE_SIZE, EVENTS_KEEPALIVE
+
+# Milliseconds clients wait before reconnecting.
+RETRY = 3000
+
+class Subscriber:
+  def __init__(self, account):
+    self.account = account
+    self.events = deque()
+    self.ready = asyncio.Event()
+    self.dropped = False
+
+  def matches(self, account):
+    return self.account is None or self.account == account
+
+# "Report ready" notifications for the webapp, so it doesn't have to poll the
+# reports table. Every report written to the database is published as a
+# Server-Sent Event (report id, account, score and header) on GET /events,
+# optionally only those of ?account=. Events are also kept for
+# EVENTS_BUFFER_TTL seconds: new subscribers get the buffered ones first, and
+# reconnecting ones (with the Last-Event-ID header, which is the report id)
+# the ones they missed. If some were already dropped from the buffer, a "gap"
+# event tells the client to catch up with
+# /accounts/<name>/reports?after=<id> instead.
+class ReportEvents:
+  def __init__(self, size=EVENTS_BUFFER_SIZE, ttl=EVENTS_BUFFER_TTL, queue_size=EVENTS_QUEUE_SIZE, keepalive=EVENTS_KEEPALIVE):
+    self.size = size
+    self.ttl = ttl
+    self.queue_size = queue_size
+    self.keepalive = keepalive
+    # (time, report id, account, event text), oldest first.
+    self.buffer = deque()
+    # Id of the newest event dropped from the buffer.
+    self.expired_id = None
+    self.subscribers = set()
+    self.stats = {"published": 0, "dropped_subscribers": 0}
+
+  def start(self):
+    database.listeners.append(self.publish)
+
+  # Database listener, called on the event loop serving the HTTP endpoints.
+  def publish(self, row):
+    general = row["general"]
+    account = row["sent_to"].lower()
+    data = json.dumps({"id": row["id"], "account": row["sent_to"], "score": general.get("score"), "header": general.get("header")})
+    event = format_event(row["id"], "report", data)
+
+    self.stats["published"] += 1
+    self.buffer.append((time.monotonic(), row["id"], account, event))
+    self.expire()
+
+    for subscriber in list(self.subscribers):
+      if not subscriber.matches(account):
+        continue
+      # Too slow to keep up: it is disconnected, and replays from the buffer
+      # when it comes back.
+      if len(subscriber.events) >= self.queue_size:
+        subscriber.dropped = True
+        self.subscribers.discard(subscriber)
+        self.stats["dropped_subscribers"] += 1
+      else:
+        subscriber.events.append(event)
+      subscriber.ready.set()
+
+  def expire(self):
+    expired = time.monotonic() - self.ttl
+    while self.buffer and (len(self.buffer) > self.size or self.buffer[0][0] < expired):
+      self.expired_id = self.buffer.popleft()[1]
+
+  # Report ids are uuid7, so they sort in the order reports were saved (give
+  # or take a few milliseconds between workers), across restarts too.
+  def replay(self, account, last_id):
+    self.expire()
+    events = [entry for entry in self.buffer if account is None or entry[2] == account]
+    if last_id is None:
+      return [event for _, _, _, event in events]
+
+    ids = [report_id for _, report_id, _, _ in events]
+    if last_id in ids:
+      return [event for _, _, _, event in events[ids.index(last_id) + 1:]]
+
+    replayed = [event for _, report_id, _, event in events if report_id > last_id]
+    if self.expired_id is not None and last_id < self.expired_id:
+      replayed.insert(0, format_event(last_id, "gap", json.dumps({"after": last_id})))
+    return replayed
+
+  async def stream_endpoint(self, request):
+    account = request.query.get("account")
+    account = account.lower() if account else None
+    last_id = request.headers.get("last-event-id") or request.query.get("after")
+    if last_id is not None and not is_report_id(last_id):
+      return Response("Invalid event id\n", 400)
+
+    writer = request.writer
+    subscriber = Subscriber(account)
+    # Subscribed before replaying, with no await in between, so that no
+    # event is missed or sent twice.
+    self.subscribers.add(subscriber)
+    try:
+      write_head(writer, 200, "text/event-stream; charset=utf-8", {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+      if request.method == "HEAD":
+        await writer.drain()
+        return None
+      writer.write(f"retry: {RETRY}\n\n".encode("utf-8"))
+      for event in self.replay(account, last_id):
+        writer.write(event)
+      await writer.drain()
+
+      while not subscriber.dropped:
+        try:
+          await asyncio.wait_for(subscriber.ready.wait(), self.keepalive)
+        except asyncio.TimeoutError:
+          # Also how a closed connection is noticed when there is no traffic.
+          writer.write(b": keepalive\n\n")
+        subscriber.ready.clear()
+        while subscriber.events:
+          writer.write(subscriber.events.popleft())
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      self.subscribers.discard(subscriber)
+
+    if subscriber.dropped:
+      log(f"Event subscriber{f' for {account}' if account else ''} could not keep up, disconnected", "warning")
+    return None
+
+def format_event(event_id, name, data):
+  return f"id: {event_id}\nevent: {name}\ndata: {data}\n\n".encode("utf-8")
+
+events = ReportEvents()
+
+metrics.registry.gauge("xray_event_subscribers", "Clients connected to the report event stream", lambda: len(events.subscribers))
+metrics.registry.gauge("xray_events_published_total", "Report ready events published", lambda: events.stats["published"], "counter")
+metrics.registry.gauge("xray_event_subscribers_dropped_total", "Event stream clients disconnected for falling behind", lambda: events.stats["dropped_subscribers"], "counter")
+
+# After the report API's, so reports are in its cache when the events go out.
+def add_routes(server):
+  events.start()
+  server.route("GET", "/events", events.stream_endpoint)
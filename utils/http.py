@@ -0,0 +1,129 @@
+import re
+import json
+import asyncio
+import urllib.parse
+from utils.config import log
+
+STATUS_TEXT = {200: "OK", 204: "No Content", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class Request:
+  def __init__(self, method, target, headers, reader, writer):
+    url = urllib.parse.urlsplit(target)
+    self.method = method
+    self.path = url.path
+    self.query = dict(urllib.parse.parse_qsl(url.query))
+    self.headers = headers
+    self.reader = reader
+    self.writer = writer
+
+class Response:
+  def __init__(self, body=b"", status=200, content_type="text/plain; charset=utf-8", headers=None):
+    if isinstance(body, str):
+      body = body.encode("utf-8")
+    self.body = body
+    self.status = status
+    self.content_type = content_type
+    self.headers = headers or {}
+
+def json_response(data, status=200, headers=None):
+  return Response(json.dumps(data), status, "application/json", headers)
+
+# Small HTTP/1.1 server for the local endpoints (metrics, reports...). Routes
+# are regular expressions; named groups are passed to the handler. A handler
+# returns a Response, or None when it wrote to request.writer itself
+# (e.g. streaming responses).
+class HTTPServer:
+  def __init__(self):
+    self.routes = []
+    self.server = None
+
+  def route(self, method, pattern, handler):
+    self.routes.append((method, re.compile(f"^{pattern}$"), handler))
+
+  async def start(self, host, port):
+    self.server = await asyncio.start_server(self.handle, host, port)
+    return self.server
+
+  async def stop(self):
+    if self.server is not None:
+      self.server.close()
+      await self.server.wait_closed()
+
+  async def handle(self, reader, writer):
+    try:
+      request = await self.read_request(reader, writer)
+      if request is None:
+        return
+      response = await self.dispatch(request)
+      if response is not None:
+        await write_response(writer, response, head_only=request.method == "HEAD")
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      if not writer.is_closing():
+        writer.close()
+
+  async def read_request(self, reader, writer):
+    try:
+      request_line = (await asyncio.wait_for(reader.readline(), 10)).decode("latin-1").split()
+    except asyncio.TimeoutError:
+      return None
+    if len(request_line) != 3:
+      await write_response(writer, Response("Bad request\n", 400))
+      return None
+
+    headers = {}
+    while True:
+      line = (await reader.readline()).decode("latin-1")
+      if line in ("\r\n", "\n", ""):
+        break
+      name, _, value = line.partition(":")
+      headers[name.strip().lower()] = value.strip()
+
+    return Request(request_line[0].upper(), request_line[1], headers, reader, writer)
+
+  async def dispatch(self, request):
+    path_found = False
+    for method, pattern, handler in self.routes:
+      match = pattern.match(request.path)
+      if not match:
+        continue
+      path_found = True
+      if method != request.method and not (method == "GET" and request.method == "HEAD"):
+        continue
+      try:
+        return await handler(request, **match.groupdict())
+      except Exception as e:
+        log(f"HTTP handler for {request.path} failed: {e}", "error")
+        return Response("Internal server error\n", 500)
+
+    if path_found:
+      return Response("Method not allowed\n", 405)
+    return Response("Not found\n", 404)
+
+# HEAD requests are served by the GET handlers; they get the same status and
+# headers (Content-Length included) but no body.
+async def write_response(writer, response, head_only=False):
+  write_head(writer, response.status, response.content_type, {"Content-Length": str(len(response.body)), **response.headers})
+  if not head_only:
+    writer.write(response.body)
+  await writer.drain()
+
+# Status line and headers only, for handlers streaming their own body. As
+# connections are closed after each response, Content-Length is optional.
+def write_head(writer, status, content_type, headers=None):
+  headers = {
+    "Content-Type": content_type,
+    "Connection": "close",
+    **(headers or {}),
+  }
+  head = f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+  head += "".join(f"{name}: {value}\r\n" for name, value in headers.items()) + "\r\n"
+  writer.write(head.encode("latin-1"))
+
+# If-None-Match can list several tags, or be "*".
+def etag_matches(request, etag):
+  tags = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+  return etag in tags or "*" in tags
+
+server = HTTPServer()
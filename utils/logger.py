@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import queue
+import socket
+import threading
+
+SEVERITIES = {"debug": 7, "info": 6, "notice": 5, "warning": 4, "warn": 4, "error": 3, "fatal": 2, "panic": 0}
+FACILITY_MAIL = 2
+
+# Log lines are queued and written by a background thread, so logging never
+# forks or blocks the event loop. Lines go to the local syslog socket (the
+# same destination postlog used) or are appended to a file.
+class AsyncLogger:
+  def __init__(self, target="syslog", level="info", queue_size=10000, policy="drop", batch_size=100, tag="xray"):
+    self.target = target
+    self.level = SEVERITIES.get(level, 6)
+    self.policy = policy
+    self.batch_size = batch_size
+    self.tag = tag
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.dropped = 0
+    self.output = None
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def log(self, message, priority="info", **fields):
+    severity = SEVERITIES.get(priority, 6)
+    if severity > self.level:
+      return
+
+    if fields:
+      message += " " + " ".join(f"{key}={format_value(value)}" for key, value in fields.items())
+
+    self.start()
+    try:
+      self.queue.put((severity, message), block=self.policy == "block")
+    except queue.Full:
+      self.dropped += 1
+
+  def start(self):
+    if self.thread is not None:
+      return
+    with self.lock:
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, name="xray-log", daemon=True)
+        self.thread.start()
+
+  def run(self):
+    while True:
+      batch = [self.queue.get()]
+      while len(batch) < self.batch_size:
+        try:
+          batch.append(self.queue.get_nowait())
+        except queue.Empty:
+          break
+
+      if self.dropped:
+        dropped, self.dropped = self.dropped, 0
+        batch.append((SEVERITIES["warning"], f"Log queue full, {dropped} log lines dropped"))
+
+      try:
+        self.write(batch)
+      except OSError as e:
+        self.output = None
+        print(f"xray: could not write log lines: {e}", file=sys.stderr)
+
+  def write(self, batch):
+    if self.target == "syslog" or self.target.startswith("syslog:"):
+      if self.output is None:
+        self.output = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.output.connect(self.target[7:] or "/dev/log")
+      timestamp = time.strftime("%b %d %H:%M:%S")
+      for severity, message in batch:
+        self.output.send(f"<{FACILITY_MAIL * 8 + severity}>{timestamp} {self.tag}[{os.getpid()}]: {message}".encode("utf-8", errors="replace"))
+    else:
+      if self.output is None:
+        self.output = open(self.target, "a")
+      timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+      self.output.write("".join(f"{timestamp} {self.tag}[{os.getpid()}] {level_name(severity)}: {message}\n" for severity, message in batch))
+      self.output.flush()
+
+  def flush(self, timeout=5):
+    end = time.monotonic() + timeout
+    while not self.queue.empty() and time.monotonic() < end:
+      time.sleep(0.01)
+
+def level_name(severity):
+  for name, value in SEVERITIES.items():
+    if value == severity:
+      return name
+  return "info"
+
+def format_value(value):
+  if isinstance(value, float):
+    value = round(value, 4)
+  value = str(value)
+  if " " in value or value == "":
+    return '"' + value.replace('"', '\\"') + '"'
+  return value
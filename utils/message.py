@@ -0,0 +1,48 @@
+import re
+import email
+from email import policy
+from email.parser import BytesHeaderParser
+from utils.config import MAX_MESSAGE_SIZE
+
+pattern_header_end = re.compile(rb"\r?\n\r?\n")
+
+# Headers-first view of a raw message. Almost every check only reads headers,
+# so only the header block is parsed up front; the whole MIME tree is parsed
+# the first time .message is used. Messages over MAX_MESSAGE_SIZE are marked
+# as truncated: checks that need the complete body (DKIM, ARC) are skipped
+# and anything parsing the body only sees the first MAX_MESSAGE_SIZE bytes.
+class MessageView:
+  def __init__(self, data, max_size=MAX_MESSAGE_SIZE):
+    self.data = data
+    self.size = len(data)
+    self.max_size = max_size
+    self.truncated = bool(max_size) and self.size > max_size
+
+    match = pattern_header_end.search(data, 0, max_size or len(data))
+    self.header_bytes = data[:match.end()] if match else data[:max_size or len(data)]
+    self.headers = BytesHeaderParser(policy=policy.SMTP).parsebytes(self.header_bytes)
+    self.parsed = None
+
+  def __contains__(self, name):
+    return name in self.headers
+
+  def __getitem__(self, name):
+    return self.headers[name]
+
+  def get(self, name, failobj=None):
+    return self.headers.get(name, failobj)
+
+  def get_all(self, name, failobj=None):
+    return self.headers.get_all(name, failobj)
+
+  @property
+  def content(self):
+    if self.truncated:
+      return self.data[:self.max_size]
+    return self.data
+
+  @property
+  def message(self):
+    if self.parsed is None:
+      self.parsed = email.message_from_bytes(self.content, policy=policy.SMTP)
+    return self.parsed
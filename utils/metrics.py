@@ -0,0 +1,158 @@
+import bisect
+from utils.http import Response
+
+# Minimal in-process metrics registry rendered in the Prometheus text format.
+# Metrics are plain counters updated from the event loop (and the database
+# writer threads); gauges are callbacks only evaluated when scraped.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Counter:
+  def __init__(self, name, help_text, labels=()):
+    self.name = name
+    self.help_text = help_text
+    self.labels = labels
+    self.values = {}
+
+  def inc(self, amount=1, **labels):
+    key = label_key(self.labels, labels)
+    self.values[key] = self.values.get(key, 0) + amount
+
+  def snapshot(self):
+    return {"type": "counter", "help": self.help_text, "labels": self.labels, "values": dict(self.values)}
+
+class Histogram:
+  def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.help_text = help_text
+    self.labels = labels
+    self.buckets = buckets
+    self.values = {}
+
+  def observe(self, value, **labels):
+    key = label_key(self.labels, labels)
+    if key not in self.values:
+      self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+    data = self.values[key]
+
+    index = bisect.bisect_left(self.buckets, value)
+    if index < len(self.buckets):
+      data["counts"][index] += 1
+    data["sum"] += value
+    data["count"] += 1
+
+  def snapshot(self):
+    values = {key: {**data, "counts": list(data["counts"])} for key, data in self.values.items()}
+    return {"type": "histogram", "help": self.help_text, "labels": self.labels, "buckets": self.buckets, "values": values}
+
+# Value read from a callback when scraped, e.g. a queue size or cache stats.
+class Gauge:
+  def __init__(self, name, help_text, collect, metric_type="gauge"):
+    self.name = name
+    self.help_text = help_text
+    self.collect = collect
+    self.metric_type = metric_type
+
+  def snapshot(self):
+    try:
+      value = self.collect()
+    except Exception:
+      value = None
+    return {"type": self.metric_type, "help": self.help_text, "labels": (), "values": {} if value is None else {(): value}}
+
+# Snapshots are plain data, so they can be sent from worker processes to the
+# supervisor and merged there (see utils/supervisor.py).
+class Registry:
+  def __init__(self):
+    self.metrics = {}
+
+  def register(self, metric):
+    self.metrics[metric.name] = metric
+    return metric
+
+  def counter(self, name, help_text, labels=()):
+    return self.register(Counter(name, help_text, labels))
+
+  def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+    return self.register(Histogram(name, help_text, labels, buckets))
+
+  def gauge(self, name, help_text, collect, metric_type="gauge"):
+    return self.register(Gauge(name, help_text, collect, metric_type))
+
+  def snapshot(self):
+    return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+  def render(self):
+    return render(self.snapshot())
+
+def render(snapshot):
+  lines = []
+  for name, data in snapshot.items():
+    labels = data["labels"]
+    lines.extend([f"# HELP {name} {data['help']}", f"# TYPE {name} {data['type']}"])
+
+    for key, value in sorted(data["values"].items()):
+      if data["type"] != "histogram":
+        lines.append(f"{name}{format_labels(labels, key)} {value}")
+        continue
+
+      cumulative = 0
+      for bucket, count in zip(data["buckets"], value["counts"]):
+        cumulative += count
+        lines.append(f"{name}_bucket{format_labels(labels + ('le',), key + (str(bucket),))} {cumulative}")
+      lines.append(f"{name}_bucket{format_labels(labels + ('le',), key + ('+Inf',))} {value['count']}")
+      lines.append(f"{name}_sum{format_labels(labels, key)} {value['sum']}")
+      lines.append(f"{name}_count{format_labels(labels, key)} {value['count']}")
+
+  return "\n".join(lines) + "\n"
+
+# Adds up several snapshots (one per worker). Gauges are added up too, which
+# is what we want for queue depths and cache sizes.
+def merge(snapshots):
+  merged = {}
+  for snapshot in snapshots:
+    for name, data in snapshot.items():
+      if name not in merged:
+        merged[name] = {**data, "values": {}}
+      values = merged[name]["values"]
+
+      for key, value in data["values"].items():
+        if data["type"] != "histogram":
+          values[key] = values.get(key, 0) + value
+          continue
+        current = values.get(key, {"counts": [0] * len(data["buckets"]), "sum": 0.0, "count": 0})
+        values[key] = {
+          "counts": [a + b for a, b in zip(current["counts"], value["counts"])],
+          "sum": current["sum"] + value["sum"],
+          "count": current["count"] + value["count"],
+        }
+
+  return merged
+
+# Only the metrics that keep growing; what is left of an exited worker.
+def cumulative(snapshot):
+  return {name: data for name, data in snapshot.items() if data["type"] != "gauge"}
+
+def label_key(names, labels):
+  return tuple(str(labels.get(name, "")) for name in names)
+
+def format_labels(names, values):
+  if not names:
+    return ""
+  escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+  return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+registry = Registry()
+
+messages = registry.counter("xray_messages_total", "Messages analysed")
+message_errors = registry.counter("xray_message_errors_total", "Messages whose analysis failed")
+rejected_recipients = registry.counter("xray_rejected_recipients_total", "Recipients rejected at RCPT because there is no such account")
+analysis_deferred = registry.counter("xray_analysis_deferred_total", "Messages deferred with a 4xx because the analysis queue was full")
+stage_duration = registry.histogram("xray_stage_duration_seconds", "Time spent in each analysis stage", ("stage",))
+check_timeouts = registry.counter("xray_check_timeouts_total", "Checks that ran out of time", ("check",))
+check_errors = registry.counter("xray_check_errors_total", "Checks that failed with an exception", ("check",))
+rbl_duration = registry.histogram("xray_rbl_query_duration_seconds", "RBL query time per zone", ("zone",))
+rbl_results = registry.counter("xray_rbl_results_total", "RBL query results per zone", ("zone", "result"))
+spamd_requests = registry.counter("xray_spamd_requests_total", "Messages scanned by spamd, by result (spam, ham, error)", ("result",))
+
+async def metrics_endpoint(request):
+  return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
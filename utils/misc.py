@@ -1,8 +1,142 @@
+import time
+import asyncio
+import ipaddress
+from collections import OrderedDict
+import dns.exception
+import dns.rdatatype
 import dns.resolver
 import dns.asyncresolver
+from utils import metrics
+from utils.resolver import HedgedResolver
+from utils.config import DNS_CACHE_SIZE, DNS_CACHE_MIN_TTL, DNS_CACHE_MAX_TTL, DNS_NEGATIVE_TTL
+
+# Process-wide cache shared by every check. Positive answers are kept for the
+# record TTL, NXDOMAIN/NoAnswer for the SOA minimum of the zone (RFC 2308),
+# and concurrent queries for the same name/type share a single lookup.
+# Misses go to the upstreams through the hedged resolver (utils/resolver.py).
+class DNSCache:
+  def __init__(self, max_size=DNS_CACHE_SIZE, min_ttl=DNS_CACHE_MIN_TTL, max_ttl=DNS_CACHE_MAX_TTL, negative_ttl=DNS_NEGATIVE_TTL, resolver=None):
+    self.resolver = resolver or HedgedResolver()
+    self.max_size = max_size
+    self.min_ttl = min_ttl
+    self.max_ttl = max_ttl
+    self.negative_ttl = negative_ttl
+    self.entries = OrderedDict()
+    self.in_flight = {}
+    self.stats = {"hits": 0, "misses": 0, "negative_hits": 0, "coalesced": 0, "evictions": 0}
+
+  async def resolve(self, name, record_type):
+    key = (str(name).lower().rstrip('.'), str(record_type).upper())
+
+    entry = self.entries.get(key)
+    if entry is not None:
+      expires, answer, error = entry
+      if expires > time.monotonic():
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        if error is not None:
+          self.stats["negative_hits"] += 1
+          raise error.with_traceback(None)
+        return answer
+      del self.entries[key]
+
+    # The lookup runs as its own task: callers that give up (timeouts) don't
+    # cancel it for everybody else, and its answer still ends up cached.
+    task = self.in_flight.get(key)
+    if task is not None:
+      self.stats["coalesced"] += 1
+    else:
+      self.stats["misses"] += 1
+      task = asyncio.create_task(self.lookup(key))
+      self.in_flight[key] = task
+      task.add_done_callback(lambda done: self.lookup_done(key, done))
+
+    return await asyncio.shield(task)
+
+  async def lookup(self, key):
+    try:
+      answer = await self.resolver.resolve(key[0], key[1])
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+      self.store(key, self.get_negative_ttl(e), None, e)
+      raise
+
+    self.store(key, answer.rrset.ttl if answer.rrset is not None else self.min_ttl, answer, None)
+    return answer
+
+  def lookup_done(self, key, task):
+    self.in_flight.pop(key, None)
+    # Nobody may be waiting anymore; avoid "exception was never retrieved" warnings.
+    if not task.cancelled():
+      task.exception()
+
+  def store(self, key, ttl, answer, error):
+    if self.max_size <= 0:
+      return
+
+    ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+    self.entries[key] = (time.monotonic() + ttl, answer, error)
+    self.entries.move_to_end(key)
+
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+      self.stats["evictions"] += 1
+
+  def get_negative_ttl(self, error):
+    # RFC 2308: negative answers are cached for min(SOA TTL, SOA MINIMUM).
+    try:
+      if isinstance(error, dns.resolver.NXDOMAIN):
+        responses = error.responses().values()
+      else:
+        responses = [error.response()]
+    except Exception:
+      return self.negative_ttl
+
+    for response in responses:
+      for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+          return min(rrset.ttl, rrset[0].minimum)
+
+    return self.negative_ttl
+
+  def get_stats(self):
+    lookups = self.stats["hits"] + self.stats["misses"]
+    return {
+      **self.stats,
+      "size": len(self.entries),
+      "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+    }
+
+  def clear(self):
+    self.entries.clear()
 
 class DNS:
-  
+  cache = DNSCache()
+
+  async def query(name_ip, record_type):
+    return await DNS.cache.resolve(name_ip, record_type)
+
+  # Forward-confirmed reverse DNS: PTR names for the IP, and the subset of
+  # them whose A/AAAA records point back to it. Both lookups are cached.
+  async def reverse(ip, limit=10):
+    address = ipaddress.ip_address(ip)
+    try:
+      answer = await DNS.query(address.reverse_pointer, 'PTR')
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+      return [], []
+
+    names = [rdata.target.to_text(omit_final_dot=True).lower() for rdata in answer][:limit]
+    confirmed = await asyncio.gather(*[DNS.confirm_address(name, address) for name in names])
+
+    return names, [name for name, is_confirmed in zip(names, confirmed) if is_confirmed]
+
+  async def confirm_address(name, address):
+    try:
+      answer = await DNS.query(name, 'A' if address.version == 4 else 'AAAA')
+    except dns.exception.DNSException:
+      return False
+
+    return any(ipaddress.ip_address(rdata.address) == address for rdata in answer)
+
   async def resolve(name_ip, record_type, check_type):
     custom_dns_messages = {
       "spf": {
@@ -24,7 +158,7 @@ class DNS:
 
     try:
       # Realiza la consulta DNS de forma asíncrona
-      result = await dns.asyncresolver.resolve(name_ip, record_type)
+      result = await DNS.query(name_ip, record_type)
       # Devuelve los resultados de manera estructurada
       return {"status": "success", "data": result}
     except dns.resolver.LifetimeTimeout:
@@ -36,4 +170,9 @@ class DNS:
     except dns.asyncresolver.NXDOMAIN:
       return {"status": "NXDOMAIN", "message": custom_dns_messages.get(check_type, {}).get("NXDOMAIN", "DNS RR does not exists") }
     except Exception as e:
-      return {"status": "Other", "message": str(e)}
\ No newline at end of file
+      return {"status": "Other", "message": str(e)}
+
+metrics.registry.gauge("xray_dns_cache_hits_total", "DNS lookups answered from the cache", lambda: DNS.cache.stats["hits"], "counter")
+metrics.registry.gauge("xray_dns_cache_misses_total", "DNS lookups sent upstream", lambda: DNS.cache.stats["misses"], "counter")
+metrics.registry.gauge("xray_dns_cache_coalesced_total", "DNS lookups that joined an in-flight query", lambda: DNS.cache.stats["coalesced"], "counter")
+metrics.registry.gauge("xray_dns_cache_entries", "DNS answers currently cached", lambda: len(DNS.cache.entries))
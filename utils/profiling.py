@@ -0,0 +1,192 @@
+import os
+import sys
+import time
+import random
+import signal
+import asyncio
+import cProfile
+import functools
+import threading
+import tracemalloc
+from utils import metrics
+from utils.http import Response, json_response
+from utils.config import log, PROFILE_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_DIR, PROFILE_KEEP, PROFILE_TRACEMALLOC_FRAMES, SLOW_CALLBACK_THRESHOLD
+
+TOP_ALLOCATIONS = 30
+STACK_FRAMES = 8
+
+loop_blocked = metrics.registry.counter("xray_loop_blocked_total", "Times the event loop was blocked for longer than SLOW_CALLBACK_THRESHOLD")
+
+# Detects callbacks that block the event loop. A task wakes up every half
+# threshold; a watchdog thread notices when it is late and records where the
+# loop thread is stuck, which is logged once the loop runs again.
+class LoopMonitor:
+  def __init__(self, loop, threshold=SLOW_CALLBACK_THRESHOLD):
+    self.loop = loop
+    self.threshold = threshold
+    self.interval = threshold / 2
+    self.thread_id = None
+    self.last_beat = time.monotonic()
+    self.stack = None
+    self.stopping = threading.Event()
+    self.task = None
+
+  def start(self):
+    self.thread_id = threading.get_ident()
+    self.task = self.loop.create_task(self.beat())
+    threading.Thread(target=self.watch, name="xray-loop-monitor", daemon=True).start()
+
+  def stop(self):
+    self.stopping.set()
+    if self.task is not None:
+      self.task.cancel()
+
+  async def beat(self):
+    while True:
+      self.last_beat = time.monotonic()
+      await asyncio.sleep(self.interval)
+      blocked = time.monotonic() - self.last_beat - self.interval
+      if blocked > self.threshold:
+        loop_blocked.inc()
+        log(f"Event loop blocked for {blocked:.3f} seconds", "warning", stack=self.stack or "unknown")
+      self.stack = None
+
+  def watch(self):
+    while not self.stopping.wait(self.interval):
+      if self.stack is None and time.monotonic() - self.last_beat > self.interval + self.threshold:
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is not None:
+          self.stack = format_stack(frame)
+
+# Opt-in profiling for production. While enabled, PROFILE_SAMPLE_RATE of the
+# messages are analysed under cProfile (one at a time, as there is a single
+# profiler per thread; the profile also covers whatever else the event loop
+# ran meanwhile) with tracemalloc snapshots taken before and after, and the
+# event loop is watched for blocking callbacks. Profiles go to PROFILE_DIR,
+# which keeps the last PROFILE_KEEP of them. Toggled with SIGUSR1/SIGUSR2 or
+# POST /profiling?enabled=1|0.
+class Profiler:
+  def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, directory=PROFILE_DIR, keep=PROFILE_KEEP, frames=PROFILE_TRACEMALLOC_FRAMES):
+    self.sample_rate = sample_rate
+    self.directory = directory
+    self.keep = keep
+    self.frames = frames
+    self.enabled = False
+    self.active = False
+    self.loop = None
+    self.monitor = None
+    self.stats = {"sampled": 0, "written": 0}
+
+  # Called on the event loop the messages are analysed on.
+  def attach(self, enabled=PROFILE_ENABLED):
+    self.loop = asyncio.get_running_loop()
+    self.set_enabled(enabled)
+
+  def set_enabled(self, enabled):
+    if enabled == self.enabled:
+      return
+    self.enabled = enabled
+
+    if enabled:
+      if not tracemalloc.is_tracing():
+        tracemalloc.start(self.frames)
+      self.monitor = LoopMonitor(self.loop)
+      self.monitor.start()
+      log(f"Profiling enabled, sampling {self.sample_rate:.1%} of messages into {self.directory}")
+    else:
+      tracemalloc.stop()
+      self.monitor.stop()
+      self.monitor = None
+      log("Profiling disabled")
+
+  # From signal handlers and other threads.
+  def set_enabled_threadsafe(self, enabled):
+    if self.loop is not None:
+      self.loop.call_soon_threadsafe(self.set_enabled, enabled)
+
+  def sampled(self, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+      if not self.enabled or self.active or random.random() >= self.sample_rate:
+        return await func(*args, **kwargs)
+      return await self.profile(func, *args, **kwargs)
+    return wrapper
+
+  async def profile(self, func, *args, **kwargs):
+    self.active = True
+    self.stats["sampled"] += 1
+    before = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+    profile = cProfile.Profile()
+    start = time.monotonic()
+
+    profile.enable()
+    try:
+      return await func(*args, **kwargs)
+    finally:
+      profile.disable()
+      elapsed = time.monotonic() - start
+      after = tracemalloc.take_snapshot() if before is not None and tracemalloc.is_tracing() else None
+      self.active = False
+      self.loop.run_in_executor(None, self.write, func.__name__, profile, before, after, elapsed)
+
+  def write(self, name, profile, before, after, elapsed):
+    path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.stats['sampled']}-{name}")
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      profile.dump_stats(path + ".prof")
+      if after is not None:
+        after.dump(path + ".tracemalloc")
+        with open(path + ".txt", "w") as summary:
+          summary.write(f"{name} took {elapsed:.3f} seconds\n\nTop allocations while it ran:\n")
+          ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+          for stat in after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")[:TOP_ALLOCATIONS]:
+            summary.write(f"{stat}\n")
+      self.stats["written"] += 1
+      self.rotate()
+    except OSError as e:
+      log(f"Could not write profile {path}: {e}", "warning")
+
+  # Files of a profile share their name up to the extension.
+  def rotate(self):
+    profiles = sorted(set(name.rsplit(".", 1)[0] for name in os.listdir(self.directory)))
+    for profile in profiles[:-self.keep] if self.keep else []:
+      for extension in (".prof", ".tracemalloc", ".txt"):
+        try:
+          os.remove(os.path.join(self.directory, profile + extension))
+        except FileNotFoundError:
+          pass
+
+  def get_status(self):
+    return {"enabled": self.enabled, "sample_rate": self.sample_rate, "directory": self.directory, **self.stats}
+
+def format_stack(frame):
+  frames = []
+  while frame is not None and len(frames) < STACK_FRAMES:
+    frames.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}")
+    frame = frame.f_back
+  return " < ".join(frames)
+
+def parse_enabled(request):
+  value = request.query.get("enabled", "").lower()
+  if value in ("1", "on", "true"):
+    return True
+  if value in ("0", "off", "false"):
+    return False
+  return None
+
+# SIGUSR1 enables profiling and SIGUSR2 disables it.
+def handle_signals(set_enabled):
+  signal.signal(signal.SIGUSR1, lambda *args: set_enabled(True))
+  signal.signal(signal.SIGUSR2, lambda *args: set_enabled(False))
+
+profiler = Profiler()
+
+metrics.registry.gauge("xray_profiles_written_total", "Message profiles written to PROFILE_DIR", lambda: profiler.stats["written"], "counter")
+
+async def profiling_endpoint(request):
+  if request.method == "POST":
+    enabled = parse_enabled(request)
+    if enabled is None:
+      return Response("Use enabled=1 or enabled=0\n", 400)
+    profiler.set_enabled(enabled)
+  return json_response(profiler.get_status())
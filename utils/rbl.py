@@ -1,63 +1,202 @@
 import time
+import json
+import ipaddress
 import dns
 import dns.resolver
 import dns.asyncresolver
 import asyncio
-from utils.config import log
-from utils.scoring import Score
+from utils.config import log, RBL_ZONES_FILE, RBL_TIMEOUT, RBL_BREAKER_THRESHOLD, RBL_BREAKER_COOLDOWN
+from utils.misc import DNS
+from utils import metrics
+
+DEFAULT_RBL_ZONES = [
+  {'name': 'SORBS 48h', 'zone': 'new.spam.dnsbl.sorbs.net', 'url': 'http://www.sorbs.net/lookup.shtml', 'codes': {'127.0.0.6': 'Spam source'}},
+  {'name': 'SORBS 28d', 'zone': 'recent.spam.dnsbl.sorbs.net', 'url': 'http://www.sorbs.net/lookup.shtml', 'codes': {'127.0.0.6': 'Spam source'}},
+  {'name': 'SPAMCOP', 'zone': 'bl.spamcop.net', 'url': 'https://www.spamcop.net/bl.shtml', 'codes': {'127.0.0.2': 'Reported spam source'}},
+  {'name': 'Spamhaus ZEN (SBL, CSS, XBL, BPL)', 'zone': 'zen.spamhaus.org', 'url': 'https://check.spamhaus.org/', 'ipv6': True, 'codes': {
+    '127.0.0.2': 'SBL - Spamhaus Block List',
+    '127.0.0.3': 'CSS - Snowshoe spam',
+    '127.0.0.4': 'XBL - Exploited host',
+    '127.0.0.5': 'XBL - Exploited host',
+    '127.0.0.6': 'XBL - Exploited host',
+    '127.0.0.7': 'XBL - Exploited host',
+    '127.0.0.9': 'DROP - Hijacked network',
+    '127.0.0.10': 'PBL - ISP policy',
+    '127.0.0.11': 'PBL - Spamhaus policy',
+    '127.255.255.252': 'error:Typing error in DNSBL name',
+    '127.255.255.254': 'error:Query via public/open resolver',
+    '127.255.255.255': 'error:Excessive number of queries',
+  }},
+  {'name': 'RATS-Spam', 'zone': 'spam.spamrats.com', 'url': 'https://spamrats.com/removal.php', 'codes': {'127.0.0.38': 'Spam source'}},
+  {'name': 'Barracuda', 'zone': 'b.barracudacentral.org', 'url': 'https://www.barracudacentral.org/lookups', 'codes': {'127.0.0.2': 'Poor reputation'}},
+  {'name': 'UCEPROTECT LVL1', 'zone': 'dnsbl-1.uceprotect.net', 'url': 'https://www.uceprotect.net/en/rblcheck.php', 'codes': {'127.0.0.2': 'Spam source'}},
+  {'name': 'UCEPROTECT LVL2', 'zone': 'dnsbl-2.uceprotect.net', 'url': 'https://www.uceprotect.net/en/rblcheck.php', 'codes': {'127.0.0.2': 'Network with spam sources'}},
+  {'name': 'UCEPROTECT LVL3', 'zone': 'dnsbl-3.uceprotect.net', 'url': 'https://www.uceprotect.net/en/rblcheck.php', 'codes': {'127.0.0.2': 'ASN with spam sources'}},
+  {'name': 'Backscatterer', 'zone': 'ips.backscatterer.org', 'url': 'https://www.backscatterer.org/?target=test', 'codes': {'127.0.0.2': 'Backscatter source'}},
+]
+
+class RBLZone:
+  def __init__(self, name, zone, url, timeout=RBL_TIMEOUT, ipv6=False, codes=None):
+    self.name = name
+    self.zone = zone
+    self.url = url
+    self.timeout = timeout
+    self.ipv6 = ipv6
+    self.codes = codes or {}
+
+    self.stats = {"queries": 0, "listed": 0, "timeouts": 0, "errors": 0, "skipped": 0, "total_time": 0.0, "max_time": 0.0}
+    self.consecutive_failures = 0
+    self.open_until = 0
+
+  def is_open(self):
+    # Circuit breaker: after repeated failures the zone is skipped until the
+    # cooldown is over, then a single query is let through to probe it.
+    if self.consecutive_failures < RBL_BREAKER_THRESHOLD:
+      return False
+    if time.monotonic() >= self.open_until:
+      self.open_until = time.monotonic() + RBL_BREAKER_COOLDOWN
+      return False
+    return True
+
+  def record(self, result, elapsed):
+    self.stats["queries"] += 1
+    self.stats["total_time"] += elapsed
+    self.stats["max_time"] = max(self.stats["max_time"], elapsed)
+
+    if result in ("Timeout", "NoNS"):
+      self.stats["timeouts" if result == "Timeout" else "errors"] += 1
+      self.consecutive_failures += 1
+      if self.consecutive_failures == RBL_BREAKER_THRESHOLD:
+        self.open_until = time.monotonic() + RBL_BREAKER_COOLDOWN
+        log(f"RBL {self.name} disabled for {RBL_BREAKER_COOLDOWN} seconds after {self.consecutive_failures} consecutive failures", "warning")
+    else:
+      self.consecutive_failures = 0
+      if result == "Listed":
+        self.stats["listed"] += 1
+      elif result == "Error":
+        self.stats["errors"] += 1
+
+  def get_stats(self):
+    return {
+      **self.stats,
+      "avg_time": self.stats["total_time"] / self.stats["queries"] if self.stats["queries"] else 0.0,
+      "circuit_open": self.consecutive_failures >= RBL_BREAKER_THRESHOLD and time.monotonic() < self.open_until,
+    }
+
+class RBLEngine:
+  def __init__(self, zones):
+    self.zones = [RBLZone(**zone) for zone in zones]
+
+  async def check(self, ip_address):
+    try:
+      address = ipaddress.ip_address(ip_address)
+    except ValueError:
+      return [{"name": zone.name, "url": zone.url, "result": "Unknown"} for zone in self.zones]
+    if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+      address = address.ipv4_mapped
+
+    return await asyncio.gather(*[self.check_zone(address, zone) for zone in self.zones])
+
+  async def check_zone(self, address, zone):
+    test = {
+      "name": zone.name,
+      "url": zone.url,
+    }
+
+    if address.version == 6 and not zone.ipv6:
+      test["result"] = "Not supported"
+      return test
+
+    if zone.is_open():
+      zone.stats["skipped"] += 1
+      metrics.rbl_results.inc(zone=zone.name, result="Skipped")
+      test["result"] = "Skipped"
+      return test
+
+    start = time.monotonic()
+    test["result"], codes = await self.query(address, zone)
+    elapsed = time.monotonic() - start
+
+    zone.record(test["result"], elapsed)
+    metrics.rbl_duration.observe(elapsed, zone=zone.name)
+    metrics.rbl_results.inc(zone=zone.name, result=test["result"])
+    test["time"] = elapsed
+    if codes:
+      test["codes"] = codes
+
+    return test
+
+  async def query(self, address, zone):
+    exception_to_result = {
+      dns.asyncresolver.NXDOMAIN: 'Not listed',
+      dns.exception.Timeout: 'Timeout',
+      dns.resolver.LifetimeTimeout: 'Timeout',
+      dns.asyncresolver.NoAnswer: 'Unknown',
+      dns.resolver.NoNameservers: 'NoNS'
+    }
+
+    try:
+      answer = await asyncio.wait_for(DNS.query(get_query_name(address, zone.zone), 'A'), zone.timeout)
+    except asyncio.TimeoutError:
+      return 'Timeout', []
+    except tuple(exception_to_result.keys()) as e:
+      return exception_to_result[type(e)], []
+
+    return interpret_codes(zone, [rdata.address for rdata in answer])
+
+  def get_stats(self):
+    return {zone.name: zone.get_stats() for zone in self.zones}
+
+def get_query_name(address, zone):
+  # 1.2.3.4 -> 4.3.2.1.zone, and IPv6 in reversed nibble format (RFC 5782).
+  suffix = '.in-addr.arpa' if address.version == 4 else '.ip6.arpa'
+  return address.reverse_pointer[:-len(suffix)] + '.' + zone
+
+def interpret_codes(zone, addresses):
+  codes = []
+  is_listed = False
+
+  for address in addresses:
+    meaning = zone.codes.get(address, "Listed")
+    if not address.startswith('127.'):
+      meaning = "error:Invalid response"
+
+    if meaning.startswith('error:'):
+      codes.append({"code": address, "meaning": meaning[6:], "error": True})
+    else:
+      is_listed = True
+      codes.append({"code": address, "meaning": meaning})
+
+  # Answers that only report a query error (e.g. rate limiting) don't mean the IP is listed.
+  return 'Listed' if is_listed else 'Error', codes
+
+def load_zones():
+  if not RBL_ZONES_FILE:
+    return DEFAULT_RBL_ZONES
+
+  with open(RBL_ZONES_FILE) as zones_file:
+    return json.load(zones_file)
+
+engine = RBLEngine(load_zones())
 
 async def check_rbl(ip_address, score):
   start = time.time()
-  rbl_list = {
-    'SORBS 48h': ['new.spam.dnsbl.sorbs.net', 'http://www.sorbs.net/lookup.shtml'],
-    'SORBS 28d': ["recent.spam.dnsbl.sorbs.net", 'http://www.sorbs.net/lookup.shtml'],
-    'SPAMCOP': ['bl.spamcop.net', 'https://www.spamcop.net/bl.shtml'],
-    'Spamhaus ZEN (SBL, CSS, XBL, BPL)': ['zen.spamhaus.org', 'https://check.spamhaus.org/'],
-    'RATS-Spam': ['spam.spamrats.com', 'https://spamrats.com/removal.php'],
-    'Barracuda': ['b.barracudacentral.org', 'https://www.barracudacentral.org/lookups'],
-    'UCEPROTECT LVL1': ['dnsbl-1.uceprotect.net', 'https://www.uceprotect.net/en/rblcheck.php'],
-    'UCEPROTECT LVL2': ['dnsbl-2.uceprotect.net', 'https://www.uceprotect.net/en/rblcheck.php'],
-    'UCEPROTECT LVL3': ['dnsbl-3.uceprotect.net', 'https://www.uceprotect.net/en/rblcheck.php'],
-    'Backscatterer': ['ips.backscatterer.org', 'https://www.backscatterer.org/?target=test']
-  }
 
-  tasks = [check_single_rbl(ip_address, rbl_name, rbl_data) for rbl_name, rbl_data in rbl_list.items()]
-  results = await asyncio.gather(*tasks)
+  results = await engine.check(ip_address)
 
   is_ip_listed = any(result['result'] == 'Listed' for result in results)
   check_result = {
     "tests": results,
     "message": "rbl:ok" if not is_ip_listed else "rbl:nok",
     "status": "success" if not is_ip_listed else "warning",
-    "count": len(rbl_list),
+    "count": len(results),
     "processed_in": time.time() - start
   }
 
   if is_ip_listed:
-    check_result["subtract"] = score.subtract("rbl", Score.RBL_ERR.value)
+    check_result["subtract"] = score.subtract("RBL_ERR")
 
-  log(f"RBL Check finished: {check_result['count']} lists in {check_result['processed_in']} seconds")
+  dns_stats = DNS.cache.get_stats()
+  log("RBL Check finished", ip=ip_address, lists=check_result['count'], time=check_result['processed_in'], dns_cache_hits=dns_stats['hits'], dns_cache_misses=dns_stats['misses'])
 
   return check_result
-
-async def check_single_rbl(ip_address, rbl_name, rbl_data):
-  query = '.'.join(reversed(str(ip_address).split('.'))) + '.' + rbl_data[0]
-  exception_to_result = {
-      dns.asyncresolver.NXDOMAIN: 'Not listed',
-      dns.exception.Timeout: 'Timeout',
-      dns.resolver.LifetimeTimeout: 'Timeout',
-      dns.asyncresolver.NoAnswer: 'Unknown',
-      dns.resolver.NoNameservers: 'NoNS'
-  }
-  
-  try:
-      await dns.asyncresolver.resolve(query, 'A')
-      result = 'Listed'
-  except tuple(exception_to_result.keys()) as e:
-      result = exception_to_result[type(e)]
-
-  return {
-      "name": rbl_name,
-      "url": rbl_data[1],
-      "result": result
-  }
\ No newline at end of file
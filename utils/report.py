@@ -1,44 +1,91 @@
 import re
 import asyncio
-from decimal import Decimal
 import time
-import email
-from email import policy
-from utils.config import VERSION
+from utils.config import log, VERSION
 
 import datetime
 
 from utils.rbl import check_rbl
 from utils.spamassassin import check_spamassassin
 from utils.authentication import check_authentication
-from utils.scoring import EmailScore
+from utils.scoring import EmailScore, get_header
+from utils.scheduler import CheckScheduler, Deadline, timeout_result
+from utils.store import store_message
+from utils.checkcache import cache as check_cache, fingerprint
+from utils.message import MessageView
+from utils.profiling import profiler
+from utils import metrics
 
+@profiler.sampled
 async def generate_reports(envelope):
   start_proc_time = time.time()
+  timings = {}
 
   score = EmailScore()
   mail_from = envelope.mail_from
   rcpt_tos = envelope.rcpt_tos
   data = envelope.content
-  received_msg = email.message_from_bytes(data, policy=email.policy.SMTP)
 
-  email_trace = get_trace(received_msg)
+  # Compressing and writing the raw message runs alongside the checks.
+  store_task = asyncio.create_task(store_message(data))
+  try:
+    stage_start = time.monotonic()
+    received_msg = MessageView(data)
+    timings['parse'] = time.monotonic() - stage_start
+
+    stage_start = time.monotonic()
+    email_trace = get_trace(received_msg)
+    timings['trace'] = time.monotonic() - stage_start
   
-  for item in email_trace:
-    if 'from' in item:
-      sender = item['from']
-      break
+    for item in email_trace:
+      if 'from' in item:
+        sender = item['from']
+        break
         
-  helo = sender[0]
-  ip = sender[1]
+    helo = sender[0]
+    ip = sender[1]
+
+    # Resent messages reuse the authentication and RBL results of the first
+    # analysis; their score outcomes are kept with them and applied again.
+    check_key = fingerprint(received_msg, ip, helo, mail_from) if check_cache.max_size > 0 else None
+    cached = check_cache.get(check_key) if check_key else None
+    checks_score = EmailScore()
+
+    # Ejecutar tareas en paralelo, todas con el mismo tiempo límite por mensaje
+    deadline = Deadline()
+    scheduler = CheckScheduler(deadline, timings)
+    scheduler.add("spamassassin", check_spamassassin, received_msg, score)
+    if cached is None:
+      scheduler.add("authentication", check_authentication, mail_from, data, received_msg, ip, helo, checks_score, deadline, timings, nested=True)
+      scheduler.add("rbl", check_rbl, ip, checks_score, on_timeout=lambda timeout: {**timeout_result("rbl", timeout), "count": 0, "processed_in": 0})
 
-  # Ejecutar tareas en paralelo
-  spam_task = asyncio.create_task(check_spamassassin(received_msg, score))
-  auth_task = asyncio.create_task(check_authentication(mail_from, data, received_msg, ip, helo, score))
-  rbl_task = asyncio.create_task(check_rbl(ip, score))
+    # Esperar resultados
+    results = await scheduler.run()
+    spamassassin_report = results["spamassassin"]
+    if cached is None:
+      authentication_report, rbl_report = results["authentication"], results["rbl"]
+      outcomes = checks_score.outcomes
+      if check_key:
+        check_cache.put(check_key, authentication_report, rbl_report, outcomes)
+    else:
+      authentication_report, cached_rbl_report, outcomes = cached
+      rbl_report = {**cached_rbl_report, "processed_in": 0}
+    for outcome in outcomes:
+      score.subtract(outcome)
+    message_digest = await store_task
+  except BaseException:
+    # Collected so a failed write is not reported as never retrieved; a write
+    # already under way finishes, and the message is purged as unused.
+    store_task.cancel()
+    store_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    raise
 
-  # Esperar resultados
-  spamassassin_report, authentication_report, rbl_report = await asyncio.gather(spam_task, auth_task, rbl_task)
+  for stage in ('parse', 'trace'):
+    metrics.stage_duration.observe(timings[stage], stage=stage)
+  if cached is None:
+    timings['rbl_zones'] = {test['name']: test['time'] for test in rbl_report.get('tests', []) if 'time' in test}
+
+  log("Checks finished", msgid=received_msg['Message-ID'], truncated=received_msg.truncated, check_cache_hit=cached is not None, **{f"{name}_time": timing for name, timing in timings.items() if name != 'rbl_zones'})
 
   general_report = {
     "message": "message:info",
@@ -46,33 +93,29 @@ async def generate_reports(envelope):
     "header": get_header(score),
     "score": score.email_score,
     "score_breakdown": score.email_score_breakdown,
+    "score_outcomes": score.outcomes,
+    "cached_checks": ["authentication", "rbl"] if cached is not None else [],
     "max_score": 10,
     "source_ip": ip,
     "source_helo": helo,
     "sent_from": mail_from,
     "sent_to": rcpt_tos[0],
-    "processed_in": (time.time() - start_proc_time) + rbl_report['processed_in'],
-    "spamassassin_version": spamassassin_report['version'],
+    "processed_in": time.time() - start_proc_time,
+    "timings": timings,
+    "spamassassin_version": spamassassin_report.get('version'),
     "tester_version": VERSION,
-    "complete_message": envelope.content.decode('utf8', errors='replace'),
+    "message_sha256": message_digest,
+    "message_size": received_msg.size,
+    "message_truncated": received_msg.truncated,
     "trace": email_trace
   }
 
+  metrics.messages.inc()
+  metrics.stage_duration.observe(general_report['processed_in'], stage="total")
+
   return general_report, spamassassin_report, authentication_report, rbl_report
 
 
-def get_header(score):
-  if Decimal(0) <= Decimal(score.email_score) <= Decimal(3.99):
-    return "Your message may never be delivered"
-  elif Decimal(4) <= Decimal(score.email_score) <= Decimal(5.99):
-    return "Your message may be discarded"
-  elif Decimal(6) <= Decimal(score.email_score) <= Decimal(7.99):
-    return "Your message may experience delivery problems"
-  elif Decimal(8) <= Decimal(score.email_score) <= Decimal(10.99):
-    return "Your message passed all tests and should be delivered"
-  else:
-    return f"Uhmm... Something unexpected happened"
-  
 def get_trace(email):
   received_headers = list(email.get_all('Received')) #list(reversed(email.get_all('Received')))
   trace = []
@@ -0,0 +1,220 @@
+import json
+import math
+import time
+import argparse
+from collections import Counter
+from utils.database import ConnectionPool
+from utils.scoring import EmailScore, WEIGHTS, get_header
+from utils.config import log, logger, check_db
+
+UPDATE_ROW = "SELECT %s AS id, %s AS created_at, %s AS score, %s AS breakdown, %s AS header, %s AS outcomes, %s AS outcomes_json"
+
+# Scores stored reports again with another set of weights, from the check
+# outcomes saved with each report, so no message has to be analysed again.
+# Reports are read in chunks in id order (keyset pagination, uuid7 ids sort
+# by date), each distinct combination of outcomes is scored once per run, and
+# the changed reports of a chunk are written back with a single UPDATE.
+# Reports saved before outcomes were stored get them derived from their
+# check results.
+class Rescorer:
+  def __init__(self, weights=WEIGHTS, batch_size=1000, batch_pause=0.1, dry_run=False):
+    self.weights = weights
+    self.batch_size = batch_size
+    self.batch_pause = batch_pause
+    self.dry_run = dry_run
+    self.pool = ConnectionPool(size=1)
+    self.scores = {}
+    self.stats = Counter()
+    self.before = Counter()
+    self.after = Counter()
+    self.headers = Counter()
+    self.total_before = 0
+    self.total_after = 0
+
+  def run(self, since=None, until=None):
+    connection = self.pool.acquire()
+    try:
+      with connection.cursor() as cursor:
+        cursor.execute("SET time_zone = '+00:00';")
+
+      last_id = ""
+      while True:
+        rows = self.fetch(connection, last_id, since, until)
+        if not rows:
+          break
+        last_id = rows[-1]["id"]
+
+        updates = [update for update in map(self.rescore_row, rows) if update is not None]
+        if updates and not self.dry_run:
+          self.update(connection, updates)
+        if len(rows) < self.batch_size:
+          break
+        time.sleep(self.batch_pause)
+    except Exception:
+      self.pool.discard(connection)
+      raise
+    self.pool.release(connection)
+
+  def fetch(self, connection, last_id, since, until):
+    conditions, params = ["id > %s"], [last_id]
+    if since:
+      conditions.append("created_at >= %s")
+      params.append(since)
+    if until:
+      conditions.append("created_at < %s")
+      params.append(until)
+
+    # The full check results are only read for reports that need them.
+    sql = ("SELECT id, created_at, score, score_outcomes, JSON_VALUE(general, '$.header') AS header, JSON_EXTRACT(general, '$.score_breakdown') AS breakdown, "
+           "IF(score_outcomes IS NULL, spamassassin, NULL) AS spamassassin, IF(score_outcomes IS NULL, authentication, NULL) AS authentication, IF(score_outcomes IS NULL, rbl, NULL) AS rbl "
+           f"FROM reports WHERE {' AND '.join(conditions)} ORDER BY id LIMIT %s;")
+    with connection.cursor() as cursor:
+      cursor.execute(sql, params + [self.batch_size])
+      rows = cursor.fetchall()
+    connection.commit()
+    return rows
+
+  def rescore_row(self, row):
+    if row["score_outcomes"] is None:
+      outcomes = derive_outcomes(json.loads(row["spamassassin"]), json.loads(row["authentication"]), json.loads(row["rbl"]))
+      self.stats["derived"] += 1
+    else:
+      outcomes = tuple(row["score_outcomes"].split(",")) if row["score_outcomes"] else ()
+
+    if any(outcome not in self.weights for outcome in outcomes):
+      self.stats["skipped"] += 1
+      return None
+
+    score, breakdown, header = self.score(outcomes)
+    old_score = float(row["score"]) if row["score"] is not None else None
+    self.track(old_score, score, row["header"], header)
+    if old_score != round(score, 2):
+      self.stats["score_changed"] += 1
+
+    if row["score_outcomes"] is not None and old_score == round(score, 2) and row["header"] == header and json.loads(row["breakdown"] or "null") == breakdown:
+      return None
+
+    self.stats["to_update"] += 1
+    return (row["id"], row["created_at"], float(score), json.dumps(breakdown), header, ",".join(outcomes), json.dumps(outcomes))
+
+  def score(self, outcomes):
+    if outcomes not in self.scores:
+      score = EmailScore(self.weights)
+      for outcome in outcomes:
+        score.subtract(outcome)
+      self.scores[outcomes] = (score.email_score, score.email_score_breakdown, get_header(score))
+    return self.scores[outcomes]
+
+  def update(self, connection, updates):
+    rows = " UNION ALL ".join([UPDATE_ROW] + ["SELECT %s, %s, %s, %s, %s, %s, %s"] * (len(updates) - 1))
+    sql = (f"UPDATE reports JOIN ({rows}) AS rescored ON reports.id = rescored.id AND reports.created_at = rescored.created_at "
+           "SET reports.score = rescored.score, reports.score_outcomes = rescored.outcomes, reports.updated_at = current_timestamp(), "
+           "reports.general = JSON_SET(reports.general, '$.score', rescored.score, '$.score_breakdown', JSON_EXTRACT(rescored.breakdown, '$'), "
+           "'$.header', rescored.header, '$.score_outcomes', JSON_EXTRACT(rescored.outcomes_json, '$'));")
+    with connection.cursor() as cursor:
+      cursor.execute(sql, [value for update in updates for value in update])
+    connection.commit()
+    self.stats["updated"] += len(updates)
+
+  def track(self, old_score, new_score, old_header, new_header):
+    self.stats["reports"] += 1
+    self.before[bucket(old_score)] += 1
+    self.after[bucket(new_score)] += 1
+    if old_score is not None:
+      self.total_before += old_score
+    self.total_after += new_score
+    if old_header != new_header:
+      self.headers[(old_header, new_header)] += 1
+
+  def summary(self):
+    reports = self.stats["reports"]
+    lines = [f"{reports} reports ({self.stats['derived']} with outcomes derived from their check results, {self.stats['skipped']} skipped)"]
+    if not reports:
+      return lines
+
+    lines.append(f"{self.stats['score_changed']} scores changed ({self.stats['score_changed'] / reports * 100:.1f}%), mean score {self.total_before / reports:.2f} -> {self.total_after / reports:.2f}, {self.stats['to_update']} reports to update")
+    lines.append(f"{'score':<8}{'before':>10}{'after':>10}")
+    for label in BUCKETS:
+      if self.before[label] or self.after[label]:
+        lines.append(f"{label:<8}{self.before[label]:>10}{self.after[label]:>10}")
+    for (old_header, new_header), count in self.headers.most_common():
+      lines.append(f"{count:>8} {old_header!r} -> {new_header!r}")
+    return lines
+
+BUCKETS = ["none", "<0"] + [str(number) for number in range(11)]
+
+def bucket(score):
+  if score is None:
+    return "none"
+  if score < 0:
+    return "<0"
+  return str(min(math.floor(score), 10))
+
+# Same outcomes the checks in utils/authentication.py, utils/rbl.py and
+# utils/spamassassin.py subtract points for, read back from their results.
+def derive_outcomes(spamassassin, authentication, rbl):
+  outcomes = []
+  if "subtract" in spamassassin:
+    outcomes.append("SPAMASSASSIN_SPAM")
+
+  spf = authentication.get("spf", {})
+  if spf.get("output") in (1, 2):
+    outcomes.append("SPF_ERR")
+  elif "subtract" in spf and spf.get("output", 0) > 3:
+    outcomes.append("SPF_WARN")
+  if spf.get("message") == "spf:moreThanOne":
+    records = next((test["result"] for test in spf.get("tests", []) if test.get("name") == "dns"), [])
+    outcomes.extend(["SPF_ERR"] * max(len(records) - 1, 1))
+
+  if "subtract" in authentication.get("rdns", {}):
+    outcomes.append("RDNS_WARN")
+  if "subtract" in authentication.get("domain_mx", {}):
+    outcomes.append("MX_WARN")
+
+  dkim_message = authentication.get("dkim", {}).get("message")
+  if dkim_message == "dkim:notSigned":
+    outcomes.append("DKIM_NO")
+  elif dkim_message == "dkim:nok":
+    outcomes.append("DKIM_ERR")
+
+  if "subtract" in rbl:
+    outcomes.append("RBL_ERR")
+  return tuple(outcomes)
+
+def load_weights(path):
+  weights = dict(WEIGHTS)
+  if path:
+    with open(path) as weights_file:
+      for outcome, points in json.load(weights_file).items():
+        if outcome not in WEIGHTS:
+          raise ValueError(f"Unknown outcome {outcome!r}, expected one of {', '.join(WEIGHTS)}")
+        weights[outcome] = float(points)
+  return weights
+
+# python3.11 -m utils.rescore [--weights FILE] [--dry-run]
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="python3.11 -m utils.rescore", description="Score stored reports again with a new set of weights")
+  parser.add_argument("--weights", help="JSON file with the points of each outcome, e.g. {\"SPF_ERR\": 2}; outcomes not in it use the SCORE_* values in .env")
+  parser.add_argument("--dry-run", action="store_true", help="only show how the scores would change")
+  parser.add_argument("--since", help="only reports created from this date (YYYY-MM-DD, UTC)")
+  parser.add_argument("--until", help="only reports created before this date (YYYY-MM-DD, UTC)")
+  parser.add_argument("--batch-size", type=int, default=1000, help="reports read and updated at a time")
+  parser.add_argument("--batch-pause", type=float, default=0.1, help="seconds to wait between batches")
+  args = parser.parse_args(argv)
+
+  check_db()
+  try:
+    weights = load_weights(args.weights)
+  except (OSError, ValueError) as e:
+    parser.error(str(e))
+
+  rescorer = Rescorer(weights, args.batch_size, args.batch_pause, args.dry_run)
+  rescorer.run(args.since, args.until)
+
+  print("\n".join(rescorer.summary()))
+  if not args.dry_run:
+    log(f"Rescored {rescorer.stats['reports']} reports, {rescorer.stats['updated']} updated")
+
+if __name__ == "__main__":
+  main()
+  logger.flush()
@@ -0,0 +1,219 @@
+import time
+import asyncio
+from collections import deque
+import dns.flags
+import dns.name
+import dns.rcode
+import dns.message
+import dns.exception
+import dns.resolver
+import dns.asyncquery
+import dns.rdataclass
+import dns.rdatatype
+from utils import metrics
+from utils.config import log, DNS_UPSTREAMS, DNS_TIMEOUT, DNS_MAX_ATTEMPTS, DNS_HEDGE_PERCENTILE, DNS_HEDGE_MIN_DELAY, DNS_HEDGE_MAX_DELAY
+
+# Response times of each upstream its hedge delay is computed from.
+RTT_SAMPLES = 200
+MIN_RTT_SAMPLES = 20
+# Weight of each new sample in an upstream's smoothed RTT and failure rate.
+SMOOTHING = 0.2
+# An upstream not queried for this long gets the next hedged query, so one
+# that was slow or failing can win its place back.
+PROBE_INTERVAL = 30
+
+upstream_queries = metrics.registry.counter("xray_dns_upstream_queries_total", "Queries sent to each DNS upstream, by result (answer, failure, timeout, cancelled)", ("upstream", "result"))
+upstream_rtt = metrics.registry.histogram("xray_dns_upstream_rtt_seconds", "Response time of each DNS upstream", ("upstream",))
+hedged_queries = metrics.registry.counter("xray_dns_hedged_queries_total", "Queries sent again to another upstream, by reason (delay, failure)", ("reason",))
+
+class Upstream:
+  def __init__(self, address, port=53):
+    self.address = address
+    self.port = port
+    self.name = f"[{address}]:{port}" if ":" in address else f"{address}:{port}"
+    self.srtt = None
+    self.rtts = deque(maxlen=RTT_SAMPLES)
+    self.failure_rate = 0.0
+    self.last_used = 0.0
+
+  # Expected time to get an answer from it: a failure costs about a hedge
+  # delay, after which the query goes to another upstream. Upstreams not
+  # measured yet keep their configured order.
+  def cost(self, penalty):
+    return (self.srtt or 0.0) + self.failure_rate * penalty
+
+  def record(self, rtt=None, failed=False):
+    self.last_used = time.monotonic()
+    if rtt is not None:
+      self.srtt = rtt if self.srtt is None else self.srtt + SMOOTHING * (rtt - self.srtt)
+      self.rtts.append(rtt)
+    self.failure_rate += SMOOTHING * (float(failed) - self.failure_rate)
+
+# Sends each query to the best upstream and, if it has not answered after a
+# hedge delay (a high percentile of its recent response times, so only the
+# slow tail is hedged), to the next one too; the first answer wins and the
+# other query is cancelled. Upstreams that fail or answer SERVFAIL/REFUSED
+# are skipped right away. Upstreams are ranked by their smoothed RTT and
+# failure rate (errors, timeouts and being beaten by a hedged query), so slow
+# ones end up only getting hedged queries. Answers and
+# errors are the ones dns.asyncresolver gives, so callers don't change.
+class HedgedResolver:
+  def __init__(self, upstreams=None, timeout=DNS_TIMEOUT, max_attempts=DNS_MAX_ATTEMPTS, percentile=DNS_HEDGE_PERCENTILE, min_delay=DNS_HEDGE_MIN_DELAY, max_delay=DNS_HEDGE_MAX_DELAY):
+    self.upstreams = upstreams or get_upstreams()
+    self.timeout = timeout
+    self.max_attempts = max(max_attempts, 1)
+    self.percentile = percentile
+    self.min_delay = min_delay
+    self.max_delay = max_delay
+    self.stats = {"queries": 0, "hedged": 0, "failed_over": 0}
+
+  async def resolve(self, name, record_type):
+    qname = dns.name.from_text(str(name))
+    rdtype = dns.rdatatype.RdataType.make(record_type)
+    request = dns.message.make_query(qname, rdtype)
+
+    response, upstream = await self.exchange(request)
+    if response.rcode() == dns.rcode.NXDOMAIN:
+      raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+
+    answer = dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response, upstream.address, upstream.port)
+    if answer.rrset is None:
+      raise dns.resolver.NoAnswer(response=response)
+    return answer
+
+  async def exchange(self, request):
+    self.stats["queries"] += 1
+    upstreams = self.order()
+    deadline = time.monotonic() + self.timeout
+    delay = self.hedge_delay(upstreams[0])
+    pending = {}
+    errors = []
+    answered_at = None
+
+    # With a single upstream, hedged queries go to it again (lost packets).
+    def send(attempt):
+      upstream = upstreams[attempt % len(upstreams)]
+      task = asyncio.create_task(self.query(request, upstream, deadline))
+      pending[task] = (upstream, time.monotonic())
+
+    send(0)
+    sent = 1
+    try:
+      while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        done, _ = await asyncio.wait(pending, timeout=min(delay, remaining) if sent < self.max_attempts else remaining, return_when=asyncio.FIRST_COMPLETED)
+
+        if not done:
+          if sent < self.max_attempts:
+            self.stats["hedged"] += 1
+            hedged_queries.inc(reason="delay")
+            send(sent)
+            sent += 1
+            delay *= 2
+          continue
+
+        for task in done:
+          upstream, start = pending.pop(task)
+          elapsed = time.monotonic() - start
+          try:
+            response = task.result()
+          except (OSError, EOFError, dns.exception.DNSException) as e:
+            response, error = None, e
+          else:
+            error = None if response.rcode() in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN) else dns.rcode.to_text(response.rcode())
+
+          if error is not None:
+            upstream.record(failed=True)
+            upstream_queries.inc(upstream=upstream.name, result="failure")
+            errors.append((upstream.address, False, upstream.port, error, response))
+            continue
+
+          upstream.record(elapsed)
+          answered_at = start
+          upstream_queries.inc(upstream=upstream.name, result="answer")
+          upstream_rtt.observe(elapsed, upstream=upstream.name)
+          return response, upstream
+
+        # Everything sent so far failed: no point in waiting for the delay.
+        if not pending and sent < self.max_attempts:
+          self.stats["failed_over"] += 1
+          hedged_queries.inc(reason="failure")
+          send(sent)
+          sent += 1
+
+      timed_out = bool(pending)
+      for task, (upstream, start) in pending.items():
+        task.cancel()
+        upstream.record(failed=True)
+        upstream_queries.inc(upstream=upstream.name, result="timeout")
+      pending.clear()
+    finally:
+      for task, (upstream, start) in pending.items():
+        task.cancel()
+        # Beaten by a query sent after it: slow or lost, either way a miss.
+        if answered_at is not None and start < answered_at:
+          upstream.record(failed=True)
+        upstream_queries.inc(upstream=upstream.name, result="cancelled")
+
+    if timed_out or not errors:
+      raise dns.resolver.LifetimeTimeout(timeout=self.timeout, errors=errors)
+    raise dns.resolver.NoNameservers(request=request, errors=errors)
+
+  async def query(self, request, upstream, deadline):
+    response = await dns.asyncquery.udp(request, upstream.address, max(deadline - time.monotonic(), 0), upstream.port, ignore_unexpected=True)
+    if response.flags & dns.flags.TC:
+      response = await dns.asyncquery.tcp(request, upstream.address, max(deadline - time.monotonic(), 0), upstream.port)
+    return response
+
+  def order(self):
+    upstreams = sorted(self.upstreams, key=lambda upstream: upstream.cost(self.hedge_delay(upstream)))
+    now = time.monotonic()
+    for upstream in upstreams[2:]:
+      if now - upstream.last_used > PROBE_INTERVAL:
+        upstreams.remove(upstream)
+        upstreams.insert(1, upstream)
+        break
+    return upstreams
+
+  def hedge_delay(self, upstream):
+    if upstream.srtt is None:
+      return self.max_delay
+    if len(upstream.rtts) < MIN_RTT_SAMPLES:
+      # Too few samples for a percentile yet.
+      rtt = 3 * upstream.srtt
+    else:
+      rtts = sorted(upstream.rtts)
+      rtt = rtts[min(int(len(rtts) * self.percentile / 100), len(rtts) - 1)]
+    return min(max(rtt, self.min_delay), self.max_delay)
+
+  def get_stats(self):
+    return {
+      **self.stats,
+      "upstreams": {upstream.name: {"srtt": upstream.srtt, "failure_rate": upstream.failure_rate, "hedge_delay": self.hedge_delay(upstream)} for upstream in self.upstreams},
+    }
+
+# DNS_UPSTREAMS, e.g. "1.1.1.1, 9.9.9.9, 127.0.0.1:5353, [2606:4700::1111]:53",
+# or the nameservers in /etc/resolv.conf.
+def get_upstreams(value=DNS_UPSTREAMS):
+  if not value:
+    try:
+      system = dns.resolver.Resolver()
+    except dns.resolver.NoResolverConfiguration:
+      log("No nameservers in /etc/resolv.conf, using 127.0.0.1", "warning")
+      return [Upstream("127.0.0.1")]
+    return [Upstream(address, system.port) for address in system.nameservers]
+
+  upstreams = []
+  for item in value.split(","):
+    item = item.strip()
+    if item.startswith("["):
+      address, _, port = item[1:].partition("]:")
+      address = address.rstrip("]")
+    elif item.count(":") == 1:
+      address, _, port = item.partition(":")
+    else:
+      address, port = item, ""
+    upstreams.append(Upstream(address, int(port) if port else 53))
+  return upstreams
@@ -0,0 +1,176 @@
+import time
+import asyncio
+import calendar
+import datetime
+from utils.database import ConnectionPool
+from utils.store import store
+from utils.config import log, logger, REPORT_RETENTION_DAYS, RETENTION_INTERVAL, RETENTION_BATCH_SIZE, RETENTION_BATCH_PAUSE
+
+PARTITION_MONTHS_AHEAD = 2
+# Stored messages newer than this are never purged: their reports may still
+# be queued or spooled, not in the table yet.
+STORE_GRACE_PERIOD = 86400
+
+# Keeps the reports table in shape. Monthly partitions are split off pmax
+# ahead of time, while pmax is still empty so it's instant (database.sql and
+# migrations/001 create the months up to then), months entirely
+# older than REPORT_RETENTION_DAYS are dropped as whole partitions, and the
+# rest of the expired rows (and reports of deleted accounts) are deleted in
+# small batches, each one its own short transaction, followed by the shared
+# check results none of the remaining reports refer to. None of that is done
+# when REPORT_RETENTION_DAYS is 0. Stored raw messages no report refers to
+# are always removed. Also works, with batch deletes only, on a reports table that was not
+# partitioned.
+class RetentionJob:
+  def __init__(self, retention_days=REPORT_RETENTION_DAYS, batch_size=RETENTION_BATCH_SIZE, batch_pause=RETENTION_BATCH_PAUSE):
+    self.retention_days = retention_days
+    self.batch_size = batch_size
+    self.batch_pause = batch_pause
+    self.pool = ConnectionPool(size=1)
+
+  def run(self):
+    connection = self.pool.acquire()
+    try:
+      self.execute(connection, "SET time_zone = '+00:00';")
+      now = datetime.datetime.utcnow()
+
+      partitions = self.get_partitions(connection)
+      if partitions:
+        self.add_partitions(connection, partitions, now)
+
+      if self.retention_days:
+        cutoff = now - datetime.timedelta(days=self.retention_days)
+        self.drop_partitions(connection, cutoff)
+        self.delete_batches(connection, "DELETE FROM reports WHERE created_at < %s LIMIT %s;", (cutoff.strftime("%Y-%m-%d %H:%M:%S"),), "expired reports")
+        self.delete_orphans(connection)
+        self.delete_batches(connection, "DELETE FROM report_results WHERE NOT EXISTS (SELECT 1 FROM reports WHERE reports.results_id = report_results.id) LIMIT %s;", (), "check results no longer used by any report")
+      self.purge_messages(connection)
+    except Exception:
+      self.pool.discard(connection)
+      raise
+    self.pool.release(connection)
+
+  def execute(self, connection, sql, params=None):
+    with connection.cursor() as cursor:
+      count = cursor.execute(sql, params)
+      rows = cursor.fetchall()
+    connection.commit()
+    return count, rows
+
+  def get_partitions(self, connection):
+    _, rows = self.execute(connection, "SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS bound FROM information_schema.PARTITIONS "
+                                       "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'reports' AND PARTITION_NAME IS NOT NULL "
+                                       "ORDER BY PARTITION_ORDINAL_POSITION;")
+    return [(row["name"], None if row["bound"] == "MAXVALUE" else int(row["bound"])) for row in rows]
+
+  def add_partitions(self, connection, partitions, now):
+    if partitions[-1] != ("pmax", None):
+      log("Reports table has no pmax partition, not adding monthly partitions", "warning")
+      return
+
+    bounds = [bound for _, bound in partitions if bound is not None]
+    if bounds:
+      month = datetime.datetime.utcfromtimestamp(max(bounds))
+    else:
+      # Only on tables partitioned by hand with pmax alone. Old reports get
+      # their own months too, but moving them out of pmax rebuilds the table.
+      _, rows = self.execute(connection, "SELECT MIN(created_at) AS oldest FROM reports;")
+      if rows[0]["oldest"] is not None:
+        log("Reports table has only a pmax partition, moving its reports to monthly partitions", "warning")
+      month = month_start(rows[0]["oldest"] or now)
+
+    last_month = month_start(now)
+    for _ in range(PARTITION_MONTHS_AHEAD):
+      last_month = next_month(last_month)
+
+    new_partitions = []
+    while month <= last_month:
+      new_partitions.append(f"PARTITION {month.strftime('p%Y%m')} VALUES LESS THAN ({timestamp(next_month(month))})")
+      month = next_month(month)
+    if not new_partitions:
+      return
+
+    self.execute(connection, f"ALTER TABLE reports REORGANIZE PARTITION pmax INTO ({', '.join(new_partitions)}, PARTITION pmax VALUES LESS THAN MAXVALUE);")
+    log(f"Added {len(new_partitions)} monthly partitions to reports")
+
+  def drop_partitions(self, connection, cutoff):
+    expired = [name for name, bound in self.get_partitions(connection) if bound is not None and bound <= timestamp(cutoff)]
+    if expired:
+      self.execute(connection, f"ALTER TABLE reports DROP PARTITION {', '.join(expired)};")
+      log(f"Dropped expired report partitions {', '.join(expired)}")
+
+  def delete_batches(self, connection, sql, params, description):
+    total = 0
+    while True:
+      count, _ = self.execute(connection, sql, params + (self.batch_size,))
+      total += count
+      if count < self.batch_size:
+        break
+      time.sleep(self.batch_pause)
+
+    if total:
+      log(f"Deleted {total} {description}")
+
+  # Reports of deleted accounts. Their account ids are read off the
+  # account_id index (one lookup per account, no rows locked) and checked
+  # against accounts; their reports are then deleted by primary key,
+  # batch_size at a time. Account ids are read before accounts, so a report
+  # of an account created meanwhile is never taken for an orphan.
+  def delete_orphans(self, connection):
+    _, rows = self.execute(connection, "SELECT DISTINCT account_id FROM reports;")
+    referenced = {row["account_id"] for row in rows}
+    _, rows = self.execute(connection, "SELECT id FROM accounts;")
+    deleted = referenced - {row["id"] for row in rows}
+
+    total = 0
+    for account_id in sorted(deleted):
+      while True:
+        _, rows = self.execute(connection, "SELECT id FROM reports WHERE account_id = %s LIMIT %s;", (account_id, self.batch_size))
+        if not rows:
+          break
+        count, _ = self.execute(connection, f"DELETE FROM reports WHERE id IN ({', '.join(['%s'] * len(rows))});", tuple(row["id"] for row in rows))
+        total += count
+        if len(rows) < self.batch_size:
+          break
+        time.sleep(self.batch_pause)
+
+    if total:
+      log(f"Deleted {total} reports of deleted accounts")
+
+  # The store is checked against the reports table batch_size digests at a
+  # time.
+  def purge_messages(self, connection):
+    digests = store.digests(time.time() - STORE_GRACE_PERIOD)
+    total = 0
+    while batch := [digest for _, digest in zip(range(self.batch_size), digests)]:
+      _, rows = self.execute(connection, f"SELECT DISTINCT message_sha256 FROM reports WHERE message_sha256 IN ({', '.join(['%s'] * len(batch))});", tuple(batch))
+      used = {row["message_sha256"] for row in rows}
+      total += sum(store.remove(digest) for digest in batch if digest not in used)
+      time.sleep(self.batch_pause)
+
+    if total:
+      log(f"Removed {total} stored messages no longer used by any report")
+
+def month_start(date):
+  return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month(date):
+  return month_start(date.replace(day=28) + datetime.timedelta(days=4))
+
+def timestamp(date):
+  return calendar.timegm(date.timetuple())
+
+async def run_periodically(interval=RETENTION_INTERVAL):
+  job = RetentionJob()
+  loop = asyncio.get_running_loop()
+  while True:
+    try:
+      await loop.run_in_executor(None, job.run)
+    except Exception as e:
+      log(f"Report retention job failed: {e}", "warning")
+    await asyncio.sleep(interval)
+
+# python3.11 -m utils.retention, e.g. from cron when RETENTION_INTERVAL is 0.
+if __name__ == "__main__":
+  RetentionJob().run()
+  logger.flush()
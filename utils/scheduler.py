@@ -0,0 +1,82 @@
+import time
+import asyncio
+from utils.config import CHECK_TIMEOUT, CHECK_TIMEOUTS, MESSAGE_DEADLINE
+from utils import metrics
+
+# Overall time budget for a message, shared by every check that runs for it.
+class Deadline:
+  def __init__(self, timeout=MESSAGE_DEADLINE):
+    self.expires = time.monotonic() + timeout
+
+  def remaining(self):
+    return max(0, self.expires - time.monotonic())
+
+# Runs independent checks concurrently. A check only waits for the checks it
+# depends on, and gets their results as keyword arguments. Each check is
+# bounded by its own timeout and by the message deadline; a check that runs
+# out of time is reported as timed out instead of failing the whole message.
+# A nested check runs a scheduler of its own on the same deadline; it is not
+# timed out as a whole, so each of its checks reports its own timeout and
+# the ones that finished are kept.
+class CheckScheduler:
+  def __init__(self, deadline=None, timings=None):
+    self.deadline = deadline or Deadline()
+    self.checks = {}
+    self.tasks = {}
+    self.timings = timings if timings is not None else {}
+
+  def add(self, name, func, *args, depends=(), timeout=None, on_timeout=None, nested=False):
+    self.checks[name] = {
+      "func": func,
+      "args": args,
+      "depends": depends,
+      "timeout": timeout if timeout is not None else CHECK_TIMEOUTS.get(name, CHECK_TIMEOUT),
+      "on_timeout": on_timeout,
+      "nested": nested,
+    }
+
+  async def run(self):
+    for name in self.checks:
+      self.get_task(name)
+
+    results = await asyncio.gather(*self.tasks.values())
+    return dict(zip(self.tasks.keys(), results))
+
+  def get_task(self, name):
+    if name not in self.tasks:
+      self.tasks[name] = asyncio.create_task(self.run_check(name))
+    return self.tasks[name]
+
+  async def run_check(self, name):
+    check = self.checks[name]
+    dependencies = {dependency: await self.get_task(dependency) for dependency in check["depends"]}
+
+    timeout = min(check["timeout"], self.deadline.remaining())
+    start = time.monotonic()
+
+    try:
+      if check["nested"]:
+        return await check["func"](*check["args"], **dependencies)
+      return await asyncio.wait_for(check["func"](*check["args"], **dependencies), timeout=timeout)
+    except asyncio.TimeoutError:
+      metrics.check_timeouts.inc(check=name)
+      if check["on_timeout"] is not None:
+        return check["on_timeout"](timeout)
+      return timeout_result(name, timeout)
+    except Exception:
+      metrics.check_errors.inc(check=name)
+      raise
+    finally:
+      self.timings[name] = time.monotonic() - start
+      metrics.stage_duration.observe(self.timings[name], stage=name)
+
+def timeout_result(name, timeout):
+  return {
+    "message": f"{name}:timeout",
+    "status": "warning",
+    "timed_out": True,
+    "tests": [{
+      "name": "scheduler",
+      "result": f"Check did not finish within {round(timeout, 3)} seconds"
+    }]
+  }
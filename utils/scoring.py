@@ -1,22 +1,54 @@
-from enum import Enum
+from decimal import Decimal
 from utils.config import SCORE_DKIM_ERR, SCORE_DKIM_NO, SCORE_MX_WARN, SCORE_RBL_ERR, SCORE_RDNS_WARN, SCORE_SPAMASSASSIN_SPAM, SCORE_SPF_ERR, SCORE_SPF_WARN
 
+# Points subtracted for each check outcome. Reports keep the list of outcomes
+# they got (score_outcomes), so they can be scored again with other weights
+# without analysing the message again (see utils/rescore.py).
+WEIGHTS = {
+	"SPAMASSASSIN_SPAM": SCORE_SPAMASSASSIN_SPAM,
+	"SPF_ERR": SCORE_SPF_ERR,
+	"SPF_WARN": SCORE_SPF_WARN,
+	"MX_WARN": SCORE_MX_WARN,
+	"RDNS_WARN": SCORE_RDNS_WARN,
+	"DKIM_NO": SCORE_DKIM_NO,
+	"DKIM_ERR": SCORE_DKIM_ERR,
+	"RBL_ERR": SCORE_RBL_ERR,
+}
+
+# Entry of the score breakdown each outcome is reported under.
+TESTS = {
+	"SPAMASSASSIN_SPAM": "spamassassin",
+	"SPF_ERR": "spf",
+	"SPF_WARN": "spf",
+	"MX_WARN": "mx",
+	"RDNS_WARN": "rdns",
+	"DKIM_NO": "dkim",
+	"DKIM_ERR": "dkim",
+	"RBL_ERR": "rbl",
+}
+
 class EmailScore:
-	def __init__(self):
+	def __init__(self, weights=WEIGHTS):
+		self.weights = weights
 		self.email_score = 10
 		self.email_score_breakdown = {}
+		self.outcomes = []
 
-	def subtract(self, test, number):
+	def subtract(self, outcome):
+		number = self.weights[outcome]
 		self.email_score = self.email_score - number
-		self.email_score_breakdown[test] = number
+		self.email_score_breakdown[TESTS[outcome]] = number
+		self.outcomes.append(outcome)
 		return number
-		
-class Score(Enum):
-	SPAMASSASSIN_SPAM = SCORE_SPAMASSASSIN_SPAM
-	SPF_ERR = SCORE_SPF_ERR
-	SPF_WARN = SCORE_SPF_WARN
-	MX_WARN = SCORE_MX_WARN
-	RDNS_WARN = SCORE_RDNS_WARN
-	DKIM_NO = SCORE_DKIM_NO
-	DKIM_ERR = SCORE_DKIM_ERR
-	RBL_ERR = SCORE_RBL_ERR
\ No newline at end of file
+
+def get_header(score):
+	if Decimal(0) <= Decimal(score.email_score) <= Decimal(3.99):
+		return "Your message may never be delivered"
+	elif Decimal(4) <= Decimal(score.email_score) <= Decimal(5.99):
+		return "Your message may be discarded"
+	elif Decimal(6) <= Decimal(score.email_score) <= Decimal(7.99):
+		return "Your message may experience delivery problems"
+	elif Decimal(8) <= Decimal(score.email_score) <= Decimal(10.99):
+		return "Your message passed all tests and should be delivered"
+	else:
+		return f"Uhmm... Something unexpected happened"
@@ -1,8 +1,55 @@
 import re
+import asyncio
 from decimal import Decimal
-from utils.scoring import Score
+from utils.spamd import SpamdError, get_client
+from utils.config import log, SPAMD_MAX_SIZE
+from utils import metrics
 
+# Scans the message with spamd when SPAMD_HOST is set. Without it, for
+# messages over SPAMD_MAX_SIZE (spamc skips those too) or if spamd fails,
+# the X-Spam-* headers added by a SpamAssassin content filter are used.
 async def check_spamassassin(email, score):
+  client = get_client()
+  if client is not None and email.size <= SPAMD_MAX_SIZE:
+    try:
+      result = await client.check(email.data)
+    except (OSError, asyncio.TimeoutError, SpamdError) as e:
+      metrics.spamd_requests.inc(result="error")
+      log(f"spamd check failed, using X-Spam headers instead: {e or type(e).__name__}", "warning", msgid=email['Message-ID'])
+    else:
+      metrics.spamd_requests.inc(result="spam" if result['is_spam'] else "ham")
+      return check_spamd(email, result, score)
+
+  return check_headers(email, score)
+
+def check_spamd(email, result, score):
+  check_result = {
+    "message": "sa:ok",
+    "status": "success",
+    "source": "spamd",
+    "is_spam": "YES" if result['is_spam'] else "NO",
+    "score": result['score'],
+    "required": result['threshold'],
+    "spam_status": "YES" if result['is_spam'] else "NO",
+    "tests": result['tests'],
+  }
+
+  if 'X-Spam-Checker-Version' in email:
+    match_version = re.search(r"SpamAssassin\s(?P<version>[\d.]+)\s", email['X-Spam-Checker-Version'])
+    if match_version:
+      check_result['version'] = match_version.group('version')
+
+  if result['is_spam']:
+    check_result['message'] = "sa:nok"
+    check_result['status'] = "warning"
+    check_result["subtract"] = score.subtract("SPAMASSASSIN_SPAM")
+  elif Decimal(3) <= Decimal(result['score']) <= Decimal(4.99):
+    check_result['message'] = "sa:shouldReview"
+    check_result['status'] = "warning"
+
+  return check_result
+
+def check_headers(email, score):
   check_result = {
     "message": "sa:ok",
     "status": "success",
@@ -24,7 +71,7 @@ async def check_spamassassin(email, score):
     if email['X-Spam-Status'] == "YES":
       check_result['message'] = "sa:nok"
       check_result['status'] = "warning"
-      check_result["subtract"] = score.subtract("spamassassin", Score.SPAMASSASSIN_SPAM.value)
+      check_result["subtract"] = score.subtract("SPAMASSASSIN_SPAM")
     else:
       if Decimal(3) <= Decimal(email['X-Spam-Score']) <= Decimal(4.99):
         check_result['message'] = "sa:shouldReview"
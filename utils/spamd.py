@@ -0,0 +1,114 @@
+import re
+import asyncio
+from utils.config import SPAMD_HOST, SPAMD_PORT, SPAMD_USER, SPAMD_COMMAND, SPAMD_TIMEOUT, SPAMD_MAX_CONNECTIONS
+
+pattern_status = re.compile(r"^SPAMD/(?P<version>[\d.]+)\s+(?P<code>\d+)\s+(?P<text>.*)$")
+pattern_spam = re.compile(r"^(?P<is_spam>True|False|Yes|No)\s*;\s*(?P<score>-?[\d.]+)\s*/\s*(?P<threshold>-?[\d.]+)", re.IGNORECASE)
+pattern_report_line = re.compile(r"^\s*(?P<score>-?\d+(?:\.\d+)?)\s+(?P<name>\w+)\s+(?P<description>.*)$")
+
+class SpamdError(Exception):
+  pass
+
+# Client for spamd's own protocol (what spamc speaks), so messages can be
+# scanned from the pipeline instead of an extra Postfix content filter pass.
+# spamd answers a single request per connection, so instead of keeping
+# connections open the client limits how many are open at the same time
+# (spamd only has a few children anyway). SPAMD_HOST may also be the path of
+# a unix socket.
+class SpamdClient:
+  def __init__(self, host=SPAMD_HOST, port=SPAMD_PORT, user=SPAMD_USER, command=SPAMD_COMMAND, timeout=SPAMD_TIMEOUT, max_connections=SPAMD_MAX_CONNECTIONS):
+    self.host = host
+    self.port = port
+    self.user = user
+    self.command = command.upper()
+    self.timeout = timeout
+    self.connections = asyncio.Semaphore(max_connections)
+
+  async def check(self, data):
+    async with self.connections:
+      response = await asyncio.wait_for(self.request(data), self.timeout)
+    return parse_response(response, self.command)
+
+  async def request(self, data):
+    if self.host.startswith("/"):
+      reader, writer = await asyncio.open_unix_connection(self.host)
+    else:
+      reader, writer = await asyncio.open_connection(self.host, self.port)
+
+    try:
+      headers = f"{self.command} SPAMC/1.5\r\nContent-length: {len(data)}\r\n"
+      if self.user:
+        headers += f"User: {self.user}\r\n"
+      writer.write(headers.encode("ascii") + b"\r\n" + data)
+      await writer.drain()
+      if writer.can_write_eof():
+        writer.write_eof()
+      return await reader.read()
+    finally:
+      writer.close()
+
+def parse_response(response, command):
+  head, _, body = response.partition(b"\r\n\r\n")
+  lines = head.decode("utf-8", errors="replace").split("\r\n")
+
+  match = pattern_status.match(lines[0])
+  if not match:
+    raise SpamdError(f"Unexpected response from spamd: {lines[0][:100]!r}")
+  if match.group("code") != "0":
+    raise SpamdError(f"spamd answered {match.group('code')} {match.group('text')}")
+
+  headers = {}
+  for line in lines[1:]:
+    name, _, value = line.partition(":")
+    headers[name.strip().lower()] = value.strip()
+
+  match = pattern_spam.match(headers.get("spam", ""))
+  if not match:
+    raise SpamdError("spamd response has no Spam header")
+
+  body = body.decode("utf-8", errors="replace")
+  return {
+    "is_spam": match.group("is_spam").lower() in ("true", "yes"),
+    "score": match.group("score"),
+    "threshold": match.group("threshold"),
+    "tests": parse_symbols(body) if command == "SYMBOLS" else parse_report(body),
+  }
+
+def parse_symbols(body):
+  return [{"name": name.strip()} for name in body.split(",") if name.strip()]
+
+# The REPORT body is the rules table of SpamAssassin's report template:
+#  pts rule name              description
+# ---- ---------------------- -----------------------------------------
+#  0.1 MISSING_MID            Missing Message-Id: header
+#                             (continuation of the description)
+def parse_report(body):
+  tests = []
+  in_table = False
+
+  for line in body.splitlines():
+    if line.startswith("----"):
+      in_table = True
+      continue
+    if not in_table or not line.strip():
+      continue
+
+    match = pattern_report_line.match(line)
+    if match:
+      tests.append({
+        "name": match.group("name"),
+        "score": match.group("score"),
+        "description": match.group("description").strip()
+      })
+    elif tests and line[:1].isspace():
+      tests[-1]["description"] += " " + line.strip()
+
+  return tests
+
+client = None
+
+def get_client():
+  global client
+  if client is None and SPAMD_HOST:
+    client = SpamdClient()
+  return client
@@ -0,0 +1,357 @@
+import re
+import time
+import ipaddress
+import urllib.parse
+import dns.exception
+import dns.resolver
+from utils.misc import DNS
+
+# In-process SPF (RFC 7208) evaluator. Results use the same names as
+# spfquery so they can be mapped to the codes the report already uses.
+SPF_RESULT_CODES = {
+  "pass": 0,
+  "fail": 1,
+  "softfail": 2,
+  "neutral": 3,
+  "permerror": 4,
+  "temperror": 5,
+  "none": 6,
+}
+
+MAX_DNS_LOOKUPS = 10
+MAX_VOID_LOOKUPS = 2
+MAX_MX_PTR_NAMES = 10
+
+QUALIFIERS = {"+": "pass", "-": "fail", "~": "softfail", "?": "neutral"}
+MECHANISMS = ("all", "include", "a", "mx", "ptr", "ip4", "ip6", "exists")
+
+pattern_term = re.compile(r"^(?P<qualifier>[+\-~?])?(?P<name>[a-z][a-z0-9_\-.]*)(?P<rest>.*)$", re.IGNORECASE)
+pattern_cidr = re.compile(r"^(?P<domain>.*?)(?:/(?P<cidr4>\d+))?(?://(?P<cidr6>\d+))?$")
+pattern_macro = re.compile(r"%(?:\{(?P<letter>[slodiphcrtv])(?P<digits>\d*)(?P<reverse>r?)(?P<delimiters>[.\-+,/_=]*)\}|(?P<literal>[%_\-]))", re.IGNORECASE)
+
+class SPFError(Exception):
+  def __init__(self, result, message):
+    super().__init__(message)
+    self.result = result
+
+class SPFCheck:
+  def __init__(self, ip, sender, helo):
+    self.ip = ipaddress.ip_address(ip)
+    if isinstance(self.ip, ipaddress.IPv6Address) and self.ip.ipv4_mapped:
+      self.ip = self.ip.ipv4_mapped
+
+    if not sender or "@" not in sender:
+      sender = "postmaster@" + (sender or helo)
+    elif sender.startswith("@"):
+      sender = "postmaster" + sender
+
+    self.sender = sender
+    self.local_part, self.sender_domain = sender.rsplit("@", 1)
+    self.helo = helo
+    self.lookups = 0
+    self.void_lookups = 0
+    self.validated_names = None
+
+  async def evaluate(self):
+    try:
+      result, explanation = await self.check_host(self.sender_domain)
+    except SPFError as e:
+      result, explanation = e.result, str(e)
+
+    return result, explanation
+
+  async def check_host(self, domain):
+    if not valid_domain(domain):
+      return "none", f"Invalid domain '{domain}'"
+
+    record = await self.get_record(domain)
+    if record is None:
+      return "none", f"No SPF record found for {domain}"
+
+    mechanisms = []
+    redirect = None
+    explanation = None
+
+    for term in record.split()[1:]:
+      if "=" in term and ":" not in term.split("=", 1)[0]:
+        name, value = term.split("=", 1)
+        name = name.lower()
+        if not re.match(r"^[a-z][a-z0-9_\-.]*$", name):
+          raise SPFError("permerror", f"Invalid modifier '{term}' in {domain}")
+        if name == "redirect":
+          if redirect is not None:
+            raise SPFError("permerror", f"Duplicate redirect modifier in {domain}")
+          redirect = value
+        elif name == "exp":
+          if explanation is not None:
+            raise SPFError("permerror", f"Duplicate exp modifier in {domain}")
+          explanation = value
+        continue
+
+      match = pattern_term.match(term)
+      if not match or match.group("name").lower() not in MECHANISMS:
+        raise SPFError("permerror", f"Unknown mechanism '{term}' in {domain}")
+      mechanisms.append((term, match))
+
+    for term, match in mechanisms:
+      qualifier = QUALIFIERS[match.group("qualifier") or "+"]
+      if await self.match_mechanism(domain, match.group("name").lower(), match.group("rest")):
+        if qualifier == "fail":
+          return qualifier, await self.get_explanation(domain, explanation)
+        return qualifier, f"Mechanism '{term}' matched in {domain}"
+
+    if redirect is not None:
+      self.count_lookup()
+      target = await self.expand(redirect, domain)
+      result, message = await self.check_host(target)
+      if result == "none":
+        raise SPFError("permerror", f"Redirect target {target} has no SPF record")
+      return result, message
+
+    return "neutral", f"No mechanism matched in {domain}"
+
+  async def match_mechanism(self, domain, name, rest):
+    if name == "all":
+      if rest:
+        raise SPFError("permerror", f"Invalid 'all' mechanism in {domain}")
+      return True
+
+    if name in ("ip4", "ip6"):
+      if not rest.startswith(":"):
+        raise SPFError("permerror", f"Missing network in '{name}' mechanism in {domain}")
+      try:
+        network = ipaddress.ip_network(rest[1:], strict=False)
+      except ValueError:
+        raise SPFError("permerror", f"Invalid network '{rest[1:]}' in {domain}")
+      if (name == "ip4") != (network.version == 4):
+        raise SPFError("permerror", f"Invalid network '{rest[1:]}' in {domain}")
+      return self.ip.version == network.version and self.ip in network
+
+    if name == "include":
+      if not rest.startswith(":"):
+        raise SPFError("permerror", f"Missing domain in 'include' mechanism in {domain}")
+      self.count_lookup()
+      target = await self.expand(rest[1:], domain)
+      result, message = await self.check_host(target)
+      if result == "pass":
+        return True
+      if result in ("fail", "softfail", "neutral"):
+        return False
+      if result == "temperror":
+        raise SPFError("temperror", message)
+      raise SPFError("permerror", f"Included domain {target} returned {result}")
+
+    if name == "exists":
+      if not rest.startswith(":"):
+        raise SPFError("permerror", f"Missing domain in 'exists' mechanism in {domain}")
+      self.count_lookup()
+      target = await self.expand(rest[1:], domain)
+      return len(await self.query(target, "A")) > 0
+
+    target, cidr4, cidr6 = await self.parse_domain_cidr(domain, name, rest)
+
+    if name == "a":
+      self.count_lookup()
+      return self.match_addresses(await self.get_addresses(target), cidr4, cidr6)
+
+    if name == "mx":
+      self.count_lookup()
+      exchanges = await self.query(target, "MX")
+      if len(exchanges) > MAX_MX_PTR_NAMES:
+        raise SPFError("permerror", f"Too many MX records for {target}")
+      for rdata in exchanges:
+        if self.match_addresses(await self.get_addresses(rdata.exchange.to_text(omit_final_dot=True)), cidr4, cidr6):
+          return True
+      return False
+
+    if name == "ptr":
+      self.count_lookup()
+      return await self.match_ptr(target)
+
+    return False
+
+  async def parse_domain_cidr(self, domain, name, rest):
+    match = pattern_cidr.match(rest)
+    target_spec = match.group("domain")
+    cidr4 = int(match.group("cidr4")) if match.group("cidr4") else 32
+    cidr6 = int(match.group("cidr6")) if match.group("cidr6") else 128
+
+    if cidr4 > 32 or cidr6 > 128:
+      raise SPFError("permerror", f"Invalid CIDR length in '{name}{rest}' in {domain}")
+
+    if target_spec:
+      if not target_spec.startswith(":"):
+        raise SPFError("permerror", f"Invalid mechanism '{name}{rest}' in {domain}")
+      return await self.expand(target_spec[1:], domain), cidr4, cidr6
+
+    return domain, cidr4, cidr6
+
+  def match_addresses(self, addresses, cidr4, cidr6):
+    for address in addresses:
+      if address.version != self.ip.version:
+        continue
+      prefix = cidr4 if address.version == 4 else cidr6
+      if self.ip in ipaddress.ip_network(f"{address}/{prefix}", strict=False):
+        return True
+    return False
+
+  async def get_addresses(self, target):
+    record_type = "A" if self.ip.version == 4 else "AAAA"
+    return [ipaddress.ip_address(rdata.address) for rdata in await self.query(target, record_type)]
+
+  async def match_ptr(self, target):
+    names = await self.get_validated_names()
+    target = target.lower().rstrip(".")
+    return any(name == target or name.endswith("." + target) for name in names)
+
+  async def get_validated_names(self):
+    if self.validated_names is not None:
+      return self.validated_names
+
+    try:
+      _, validated = await DNS.reverse(self.ip, MAX_MX_PTR_NAMES)
+    except dns.exception.DNSException:
+      validated = []
+
+    self.validated_names = validated
+    return validated
+
+  async def get_record(self, domain):
+    try:
+      answer = await DNS.query(domain, "TXT")
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+      return None
+    except (dns.exception.Timeout, dns.resolver.NoNameservers) as e:
+      raise SPFError("temperror", f"DNS error looking up SPF record for {domain}: {e}")
+
+    records = []
+    for rdata in answer:
+      text = b"".join(rdata.strings).decode("utf-8", errors="replace")
+      if text.lower() == "v=spf1" or text.lower().startswith("v=spf1 "):
+        records.append(text)
+
+    if len(records) > 1:
+      raise SPFError("permerror", f"More than one SPF record found for {domain}")
+
+    return records[0] if records else None
+
+  async def query(self, name, record_type, count_void=True):
+    try:
+      return list(await DNS.query(name, record_type))
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+      if count_void:
+        self.void_lookups += 1
+        if self.void_lookups > MAX_VOID_LOOKUPS:
+          raise SPFError("permerror", "Too many void DNS lookups")
+      return []
+    except (dns.exception.Timeout, dns.resolver.NoNameservers) as e:
+      raise SPFError("temperror", f"DNS error looking up {record_type} for {name}: {e}")
+    except dns.exception.DNSException as e:
+      raise SPFError("permerror", f"Invalid DNS name {name}: {e}")
+
+  def count_lookup(self):
+    self.lookups += 1
+    if self.lookups > MAX_DNS_LOOKUPS:
+      raise SPFError("permerror", f"Maximum of {MAX_DNS_LOOKUPS} DNS lookups exceeded")
+
+  async def get_explanation(self, domain, explanation):
+    default = f"{self.sender_domain} does not designate {self.ip} as permitted sender"
+    if explanation is None:
+      return default
+
+    # Failures retrieving the explanation never change the result (RFC 7208 6.2).
+    try:
+      target = await self.expand(explanation, domain)
+      answer = list(await DNS.query(target, "TXT"))
+      if len(answer) != 1:
+        return default
+      return await self.expand(b"".join(answer[0].strings).decode("utf-8", errors="replace"), domain, explanation=True)
+    except Exception:
+      return default
+
+  async def expand(self, spec, domain, explanation=False):
+    result = []
+    position = 0
+
+    for match in pattern_macro.finditer(spec):
+      result.append(spec[position:match.start()])
+      position = match.end()
+
+      literal = match.group("literal")
+      if literal:
+        result.append({"%": "%", "_": " ", "-": "%20"}[literal])
+        continue
+
+      letter = match.group("letter")
+      if letter.lower() in "crt" and not explanation:
+        raise SPFError("permerror", f"Macro '{match.group(0)}' only allowed in explanations")
+
+      value = await self.get_macro_value(letter.lower(), domain)
+      delimiters = match.group("delimiters") or "."
+      parts = re.split("[" + re.escape(delimiters) + "]", value)
+
+      if match.group("reverse"):
+        parts.reverse()
+      if match.group("digits"):
+        digits = int(match.group("digits"))
+        if digits == 0:
+          raise SPFError("permerror", f"Invalid macro '{match.group(0)}'")
+        parts = parts[-digits:]
+
+      value = ".".join(parts)
+      if letter.isupper():
+        value = urllib.parse.quote(value, safe="")
+      result.append(value)
+
+    remainder = spec[position:]
+    if "%" in remainder:
+      raise SPFError("permerror", f"Invalid macro in '{spec}'")
+    result.append(remainder)
+
+    expanded = "".join(result)
+    if not explanation:
+      # Domain specs longer than 253 characters drop labels from the left.
+      while len(expanded) > 253 and "." in expanded:
+        expanded = expanded.split(".", 1)[1]
+
+    return expanded
+
+  async def get_macro_value(self, letter, domain):
+    if letter == "s":
+      return self.sender
+    if letter == "l":
+      return self.local_part
+    if letter == "o":
+      return self.sender_domain
+    if letter == "d":
+      return domain
+    if letter == "i":
+      if self.ip.version == 4:
+        return str(self.ip)
+      return ".".join(self.ip.exploded.replace(":", ""))
+    if letter == "p":
+      names = await self.get_validated_names()
+      return names[0] if names else "unknown"
+    if letter == "v":
+      return "in-addr" if self.ip.version == 4 else "ip6"
+    if letter == "h":
+      return self.helo
+    if letter == "c":
+      return str(self.ip)
+    if letter == "r":
+      return "unknown"
+    if letter == "t":
+      return str(int(time.time()))
+    return ""
+
+def valid_domain(domain):
+  labels = domain.rstrip(".").split(".")
+  return len(labels) > 1 and all(0 < len(label) <= 63 for label in labels)
+
+async def check_spf(ip, sender, helo):
+  try:
+    check = SPFCheck(ip, sender, helo)
+  except ValueError as e:
+    return "permerror", f"Invalid client address: {e}"
+
+  return await check.evaluate()
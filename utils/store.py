@@ -0,0 +1,133 @@
+import os
+import gzip
+import asyncio
+import hashlib
+import tempfile
+from utils import metrics
+from utils.http import Response, write_head
+from utils.config import log, MESSAGE_STORE_DIR, MESSAGE_STORE_LEVEL
+
+CHUNK_SIZE = 64 * 1024
+
+pattern_digest = "[0-9a-f]{64}"
+
+# Raw messages are kept out of the reports table, gzip-compressed in a local
+# directory and named after the SHA-256 of their content, so a message that
+# is sent again is only stored once. Reports only keep the digest.
+class MessageStore:
+  def __init__(self, directory=MESSAGE_STORE_DIR, level=MESSAGE_STORE_LEVEL):
+    self.directory = directory
+    self.level = level
+    self.stats = {"stored": 0, "deduplicated": 0, "bytes_in": 0, "bytes_stored": 0}
+
+  def path(self, digest):
+    return os.path.join(self.directory, digest[:2], digest[2:4], f"{digest}.gz")
+
+  def exists(self, digest):
+    return os.path.exists(self.path(digest))
+
+  def put(self, data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = self.path(digest)
+    self.stats["bytes_in"] += len(data)
+
+    if os.path.exists(path):
+      # A recent mtime keeps it from being purged before the new report
+      # referring to it is written (see utils/retention.py).
+      try:
+        os.utime(path)
+      except FileNotFoundError:
+        pass
+      else:
+        self.stats["deduplicated"] += 1
+        return digest
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+      with os.fdopen(fd, "wb") as blob:
+        # mtime=0 keeps the compressed file identical for identical messages.
+        with gzip.GzipFile(fileobj=blob, mode="wb", compresslevel=self.level, mtime=0) as compressed:
+          compressed.write(data)
+        blob.flush()
+        os.fsync(blob.fileno())
+      os.replace(temp_path, path)
+    except BaseException:
+      os.unlink(temp_path)
+      raise
+
+    self.stats["stored"] += 1
+    self.stats["bytes_stored"] += os.path.getsize(path)
+    return digest
+
+  def open(self, digest, compressed=False):
+    if compressed:
+      return open(self.path(digest), "rb")
+    return gzip.open(self.path(digest), "rb")
+
+  def get(self, digest):
+    with self.open(digest) as blob:
+      return blob.read()
+
+  # Digests of the stored messages last written before older_than (a Unix
+  # time), one directory at a time.
+  def digests(self, older_than):
+    for directory, _, names in os.walk(self.directory):
+      for name in names:
+        if not name.endswith(".gz"):
+          continue
+        try:
+          if os.path.getmtime(os.path.join(directory, name)) < older_than:
+            yield name[:-len(".gz")]
+        except FileNotFoundError:
+          pass
+
+  def remove(self, digest):
+    try:
+      os.remove(self.path(digest))
+      return True
+    except FileNotFoundError:
+      return False
+
+store = MessageStore()
+
+metrics.registry.gauge("xray_messages_stored_total", "Raw messages written to the message store", lambda: store.stats["stored"], "counter")
+metrics.registry.gauge("xray_messages_deduplicated_total", "Raw messages already present in the message store", lambda: store.stats["deduplicated"], "counter")
+metrics.registry.gauge("xray_message_store_bytes_total", "Compressed bytes written to the message store", lambda: store.stats["bytes_stored"], "counter")
+
+async def store_message(data):
+  try:
+    return await asyncio.get_running_loop().run_in_executor(None, store.put, data)
+  except OSError as e:
+    log(f"Could not store raw message: {e}", "error")
+    return None
+
+# GET /messages/<digest>: streams a stored message back. Clients accepting
+# gzip get the stored file as is; the rest get it decompressed on the fly.
+async def message_endpoint(request, digest):
+  if not store.exists(digest):
+    return Response("Not found\n", 404)
+
+  etag = f'"{digest}"'
+  headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+  if request.headers.get("if-none-match") == etag:
+    return Response(status=304, headers=headers)
+
+  loop = asyncio.get_running_loop()
+  compressed = "gzip" in request.headers.get("accept-encoding", "")
+  blob = await loop.run_in_executor(None, store.open, digest, compressed)
+
+  try:
+    if compressed:
+      headers["Content-Encoding"] = "gzip"
+      headers["Content-Length"] = str(os.fstat(blob.fileno()).st_size)
+    write_head(request.writer, 200, "message/rfc822", headers)
+
+    if request.method != "HEAD":
+      while chunk := await loop.run_in_executor(None, blob.read, CHUNK_SIZE):
+        request.writer.write(chunk)
+        await request.writer.drain()
+    else:
+      await request.writer.drain()
+  finally:
+    blob.close()
@@ -0,0 +1,213 @@
+import os
+import time
+import signal
+import asyncio
+import threading
+import multiprocessing
+from aiosmtpd.controller import Controller
+from utils import metrics, database, analysis
+from utils.http import Response, json_response, server as http_server
+from utils.profiling import profiler, parse_enabled
+from utils.config import log, logger, HOSTNAME, PORT, HTTP_HOSTNAME, HTTP_PORT, DB_SPOOL_DIR, ANALYSIS_SPOOL_DIR, MESSAGE_DEADLINE, PROFILE_ENABLED
+
+METRICS_INTERVAL = 5
+STOP_TIMEOUT = 30
+# A worker that exits sooner than this after starting is restarted with an
+# increasing delay, so a broken setup doesn't turn into a fork loop.
+STABLE_AFTER = 10
+MAX_RESTART_DELAY = 60
+
+# Every worker listens on the same port and the kernel spreads incoming
+# connections between them.
+class ReusePortController(Controller):
+  def _create_server(self):
+    return self.loop.create_server(self._factory_invoker, host=self.hostname, port=self.port, ssl=self.ssl_context, reuse_port=True)
+
+  # The test connection Controller makes on start could be accepted by
+  # another worker, so the SMTP factory is invoked directly instead.
+  def _trigger_server(self):
+    self.loop.call_soon_threadsafe(self._factory_invoker)
+
+def run_worker(index, handler, snapshots, reports, profiling):
+  stopping = threading.Event()
+  signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+  # Ctrl-C reaches the whole process group; the supervisor stops the workers.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  parent = os.getppid()
+
+  if index:
+    database.spool_dir = os.path.join(DB_SPOOL_DIR, f"worker-{index}")
+    analysis.spool_dir = os.path.join(ANALYSIS_SPOOL_DIR, f"worker-{index}")
+  # Saved reports go to the supervisor, which serves the report API.
+  if HTTP_PORT:
+    database.listeners.append(reports.put)
+
+  controller = ReusePortController(handler, hostname=HOSTNAME, port=PORT)
+  controller.start()
+  asyncio.run_coroutine_threadsafe(handler.start(), controller.loop).result()
+  publisher = asyncio.run_coroutine_threadsafe(publish_metrics(index, snapshots), controller.loop)
+  log(f"Worker {index} started")
+
+  while not stopping.wait(1):
+    if os.getppid() != parent:
+      log(f"Supervisor exited, stopping worker {index}", "warning")
+      break
+    # Profiling is switched on and off from the supervisor.
+    if bool(profiling.value) != profiler.enabled:
+      profiler.set_enabled_threadsafe(bool(profiling.value))
+
+  publisher.cancel()
+  try:
+    asyncio.run_coroutine_threadsafe(shutdown_worker(controller, handler), controller.loop).result(STOP_TIMEOUT + MESSAGE_DEADLINE)
+  except Exception as e:
+    log(f"Worker {index} did not shut down cleanly: {e}", "error")
+  controller.stop()
+
+  snapshots.put((index, os.getpid(), metrics.registry.snapshot()))
+  log(f"Worker {index} stopped")
+  logger.flush()
+
+async def shutdown_worker(controller, handler):
+  controller.server.close()
+  await handler.stop()
+
+async def publish_metrics(index, snapshots):
+  while True:
+    snapshots.put((index, os.getpid(), metrics.registry.snapshot()))
+    await asyncio.sleep(METRICS_INTERVAL)
+
+# Starts WORKERS processes, each one with its own event loop, SMTP listener,
+# DNS cache, DKIM pool and database writer. Workers that exit are restarted.
+# They send their metrics here, and /metrics reports the sum of all of them.
+class Supervisor:
+  def __init__(self, handler, workers, jobs=()):
+    self.handler = handler
+    self.workers = workers
+    # Background coroutines that must run once, not in every worker.
+    self.jobs = jobs
+    self.context = multiprocessing.get_context("spawn")
+    self.snapshots = self.context.Queue()
+    self.reports = self.context.Queue()
+    self.profiling = self.context.Value("b", PROFILE_ENABLED, lock=False)
+    self.processes = {}
+    self.started = {}
+    self.failures = {}
+    self.restart_at = {}
+    self.worker_metrics = {}
+    # Counters of workers that exited, so totals don't go back on restarts.
+    self.retired = {}
+
+    self.restarts = metrics.registry.counter("xray_worker_restarts_total", "Worker processes restarted after exiting", ("worker",))
+    metrics.registry.gauge("xray_workers", "Worker processes running", lambda: sum(1 for process in self.processes.values() if process is not None and process.is_alive()))
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+      loop.add_signal_handler(signum, stopping.set)
+    loop.add_signal_handler(signal.SIGUSR1, self.set_profiling, True)
+    loop.add_signal_handler(signal.SIGUSR2, self.set_profiling, False)
+
+    threading.Thread(target=self.collect_metrics, args=(loop,), name="xray-metrics", daemon=True).start()
+    threading.Thread(target=self.collect_reports, args=(loop,), name="xray-reports", daemon=True).start()
+
+    for index in range(self.workers):
+      self.start_worker(index)
+    tasks = [asyncio.create_task(job()) for job in self.jobs]
+
+    if HTTP_PORT:
+      await database.accounts.start()
+      await http_server.start(HTTP_HOSTNAME, HTTP_PORT)
+      log(f"HTTP endpoints available on {HTTP_HOSTNAME}:{HTTP_PORT}.")
+
+    while not stopping.is_set():
+      self.check_workers()
+      try:
+        await asyncio.wait_for(stopping.wait(), 1)
+      except asyncio.TimeoutError:
+        pass
+
+    log("Stopping workers")
+    for task in tasks:
+      task.cancel()
+    await loop.run_in_executor(None, self.stop_workers)
+    await http_server.stop()
+    database.accounts.stop()
+
+  def start_worker(self, index):
+    process = self.context.Process(target=run_worker, args=(index, self.handler, self.snapshots, self.reports, self.profiling), name=f"xray-worker-{index}")
+    process.start()
+    self.processes[index] = process
+    self.started[index] = time.monotonic()
+
+  def check_workers(self):
+    now = time.monotonic()
+    for index, process in self.processes.items():
+      if process is None:
+        if now >= self.restart_at[index]:
+          self.restarts.inc(worker=index)
+          self.start_worker(index)
+        continue
+
+      if process.is_alive():
+        continue
+
+      self.retire(index, process.pid)
+      if now - self.started[index] < STABLE_AFTER:
+        self.failures[index] = self.failures.get(index, 0) + 1
+      else:
+        self.failures[index] = 0
+      delay = min(2 ** self.failures[index], MAX_RESTART_DELAY) if self.failures[index] else 0
+
+      log(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting in {delay}s", "error")
+      self.processes[index] = None
+      self.restart_at[index] = now + delay
+
+  def stop_workers(self):
+    processes = [process for process in self.processes.values() if process is not None]
+    for process in processes:
+      process.terminate()
+    for process in processes:
+      process.join(STOP_TIMEOUT + MESSAGE_DEADLINE)
+      if process.is_alive():
+        log(f"Worker pid {process.pid} did not stop in time, killing it", "warning")
+        process.kill()
+
+  def collect_metrics(self, loop):
+    while True:
+      index, pid, snapshot = self.snapshots.get()
+      loop.call_soon_threadsafe(self.update_metrics, index, pid, snapshot)
+
+  def collect_reports(self, loop):
+    while True:
+      loop.call_soon_threadsafe(self.report_saved, self.reports.get())
+
+  def report_saved(self, row):
+    for listener in database.listeners:
+      listener(row)
+
+  def update_metrics(self, index, pid, snapshot):
+    process = self.processes.get(index)
+    if process is not None and process.pid == pid:
+      self.worker_metrics[index] = (pid, snapshot)
+
+  def retire(self, index, pid):
+    entry = self.worker_metrics.pop(index, None)
+    if entry is not None and entry[0] == pid:
+      self.retired = metrics.merge([self.retired, metrics.cumulative(entry[1])])
+
+  def set_profiling(self, enabled):
+    self.profiling.value = enabled
+    log(f"Profiling {'enabled' if enabled else 'disabled'} in the workers")
+
+  async def profiling_endpoint(self, request):
+    if request.method == "POST":
+      enabled = parse_enabled(request)
+      if enabled is None:
+        return Response("Use enabled=1 or enabled=0\n", 400)
+      self.set_profiling(enabled)
+    return json_response({"enabled": bool(self.profiling.value), "sample_rate": profiler.sample_rate, "directory": profiler.directory})
+
+  async def metrics_endpoint(self, request):
+    snapshots = [metrics.registry.snapshot(), self.retired] + [snapshot for _, snapshot in self.worker_metrics.values()]
+    return Response(metrics.render(metrics.merge(snapshots)), content_type="text/plain; version=0.0.4; charset=utf-8")
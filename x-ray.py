@@ -2,12 +2,64 @@
 
 from aiosmtpd.controller import Controller
 
-import time
-from utils.config import log, check_db, VERSION, PORT, HOSTNAME
+import sys
+import signal
+import asyncio
+import threading
+from utils.config import log, logger, check_db, VERSION, PORT, HOSTNAME, HTTP_HOSTNAME, HTTP_PORT, WORKERS, ANALYSIS_QUEUE_SIZE, RETENTION_INTERVAL, MESSAGE_DEADLINE
 from utils.report import generate_reports
-from utils.database import save_report
+from utils.database import save_reports
+from utils.http import server as http_server
+from utils.store import message_endpoint, pattern_digest
+from utils.supervisor import Supervisor, shutdown_worker, STOP_TIMEOUT
+from utils.retention import run_periodically as run_retention
+from utils.analysis import start_queue
+from utils.api import add_routes as add_api_routes
+from utils.events import add_routes as add_event_routes
+from utils.profiling import profiler, profiling_endpoint, handle_signals
+from utils import metrics, analysis, database, dkimpool
 
 class CustomHandler:
+  def __init__(self):
+    # Messages being analysed before their 250 is sent; their reports are
+    # saved before the writer stops.
+    self.analysing = set()
+
+  # Called on the SMTP event loop once the Controller is running, and when
+  # the service stops.
+  async def start(self):
+    profiler.attach()
+    await database.accounts.start()
+    if ANALYSIS_QUEUE_SIZE:
+      start_queue(self.analyze)
+
+  async def stop(self):
+    database.accounts.stop()
+    if analysis.queue is not None:
+      await analysis.queue.stop()
+    if self.analysing:
+      await asyncio.wait(self.analysing)
+    if database.writer is not None:
+      await database.writer.stop()
+    await asyncio.get_running_loop().run_in_executor(None, dkimpool.shutdown)
+
+  # Mail for accounts that don't exist is rejected before DATA, instead of
+  # being analysed and then failing to save.
+  async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+    try:
+      known = await database.accounts.lookup(address) is not None
+    except Exception as e:
+      log(f"Could not look up account {address}, accepting it: {e}", "warning")
+      known = True
+
+    if not known:
+      metrics.rejected_recipients.inc()
+      log(f"Rejecting mail from {envelope.mail_from} to unknown account {address}")
+      return '550 5.1.1 Recipient address rejected: unknown account'
+
+    envelope.rcpt_tos.append(address)
+    return '250 OK'
+
   async def handle_DATA(self, server, session, envelope):
 
     log(f"Processing message from {envelope.mail_from}")
@@ -21,21 +73,81 @@ class CustomHandler:
 
     #ip = socket.gethostbyname(email_trace[-2]['from'][0])
 
-    general_report, spamassassin_report, authentication_report, rbl_report = await generate_reports(envelope)
-    
-    await save_report(general_report['sent_to'], general_report, spamassassin_report, authentication_report, rbl_report)
+    # Accept-then-analyze mode: the message is spooled and analysed later.
+    if ANALYSIS_QUEUE_SIZE:
+      return await start_queue(self.analyze).submit(envelope)
+
+    task = asyncio.ensure_future(self.analyze(envelope))
+    self.analysing.add(task)
+    task.add_done_callback(self.analysing.discard)
+    await task
 
     return '250 OK'
 
+  async def analyze(self, envelope):
+    try:
+      general_report, spamassassin_report, authentication_report, rbl_report = await generate_reports(envelope)
+    except Exception as e:
+      metrics.message_errors.inc()
+      log(f"Error processing message from {envelope.mail_from}: {e}", "error")
+      raise
+    
+    # One analysis, one report for each accepted recipient.
+    report_ids, saved = await save_reports(envelope.rcpt_tos, general_report, spamassassin_report, authentication_report, rbl_report)
+
+    log("Report generated", report=",".join(report_ids), sent_to=",".join(envelope.rcpt_tos), score=general_report['score'], time=general_report['processed_in'])
+    # Done once the reports are committed or spooled (see utils/analysis.py).
+    return saved
+
+def add_routes(metrics_endpoint, profiling_endpoint):
+  http_server.route("GET", "/metrics", metrics_endpoint)
+  http_server.route("GET", "/profiling", profiling_endpoint)
+  http_server.route("POST", "/profiling", profiling_endpoint)
+  http_server.route("GET", f"/messages/(?P<digest>{pattern_digest})", message_endpoint)
+  add_api_routes(http_server)
+  add_event_routes(http_server)
+
 if __name__ == '__main__':
   check_db()
   log(f"Requirements and config checked; Starting...")
 
   handler = CustomHandler()
+  jobs = (run_retention,) if RETENTION_INTERVAL else ()
+
+  # Several worker processes listening on the same port; the local HTTP
+  # endpoints are served by the supervisor.
+  if WORKERS > 1:
+    supervisor = Supervisor(handler, WORKERS, jobs)
+    add_routes(supervisor.metrics_endpoint, supervisor.profiling_endpoint)
+    log(f"Service started on {HOSTNAME}:{PORT} with {WORKERS} workers, version {VERSION}.")
+    asyncio.run(supervisor.run())
+    sys.exit(0)
+
   controller = Controller(handler, hostname=HOSTNAME, port=PORT)
   log(f"Service started on {HOSTNAME}:{PORT}, version {VERSION}.")
   # Run the event loop in a separate thread.
   controller.start()
+  asyncio.run_coroutine_threadsafe(handler.start(), controller.loop).result()
+  handle_signals(profiler.set_enabled_threadsafe)
+  for job in jobs:
+    asyncio.run_coroutine_threadsafe(job(), controller.loop)
+
+  # Local HTTP endpoints (Prometheus metrics, raw messages, report API and events) share the SMTP event loop.
+  if HTTP_PORT:
+    add_routes(metrics.metrics_endpoint, profiling_endpoint)
+    asyncio.run_coroutine_threadsafe(http_server.start(HTTP_HOSTNAME, HTTP_PORT), controller.loop).result()
+    log(f"HTTP endpoints available on {HTTP_HOSTNAME}:{HTTP_PORT}.")
+
+  # Reports still waiting to be written are flushed before exiting.
+  stopping = threading.Event()
+  for signum in (signal.SIGTERM, signal.SIGINT):
+    signal.signal(signum, lambda *args: stopping.set())
+  stopping.wait()
 
-  while True:
-    time.sleep(10)
\ No newline at end of file
+  log("Stopping")
+  try:
+    asyncio.run_coroutine_threadsafe(shutdown_worker(controller, handler), controller.loop).result(STOP_TIMEOUT + MESSAGE_DEADLINE)
+  except Exception as e:
+    log(f"Did not shut down cleanly: {e}", "error")
+  controller.stop()
+  logger.flush()